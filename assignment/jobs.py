@@ -0,0 +1,11 @@
+from .views import TplFlushRole
+
+
+def flush_roles(job, request):
+    """
+    后台任务，使用模版刷新所有所创的角色
+    :param job: job object, 任务对象
+    :param request: JobRequest object, 还原的请求对象
+    :return: dict, 新增、更新、删除的策略总数量
+    """
+    return TplFlushRole().flush_roles(request, job.get_params(), progress=job.set_progress)
@@ -1,4 +1,6 @@
 from op_keystone.base_model import BaseModel, ResourceModel
+from op_keystone.auth_cache import PolicyCache, ActionIndex
+from partition.models import DomainStats
 from django.db import models
 from utils.dao import DAO
 from op_keystone.exceptions import DatabaseError
@@ -12,6 +14,9 @@ class Role(ResourceModel):
         verbose_name = '角色'
         unique_together = ['name', 'domain']
         db_table = 'role'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='role_created_uuid_idx')
+        ]
         ordering = ('-builtin', '-created_time')
 
     # 必要字段
@@ -22,7 +27,7 @@ class Role(ResourceModel):
     builtin = models.BooleanField(default=False, verbose_name='是否内置')
     enable = models.BooleanField(default=True, verbose_name="是否启用")
     comment = models.CharField(max_length=64, null=True, verbose_name='备注')
-    tpl = models.CharField(max_length=32, null=True, verbose_name='使用的模版UUID')
+    tpl = models.CharField(max_length=32, null=True, db_index=True, verbose_name='使用的模版UUID')
     tpl_condition_values = models.CharField(max_length=512, null=True, verbose_name='使用的模版条件')
 
     def pre_create(self):
@@ -38,9 +43,15 @@ class Role(ResourceModel):
 
         self.tpl_condition_values = json_dumper(self.tpl_condition_values)
 
+    def post_create(self):
+        """
+        创建后，增加域的自定义角色计数
+        """
+        DomainStats.count_obj(self, 1)
+
     def pre_update(self):
         """
-        更新前，检查 domain 是否存在，以及是否内置
+        更新前，检查 domain 是否存在，以及是否内置，域或是否内置变化时转移计数
         """
         if self.builtin:
             self.domain = DAO('partition.models.Domain').get_obj(is_main=True).uuid
@@ -48,6 +59,7 @@ class Role(ResourceModel):
             DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
         self.tpl_condition_values = json_dumper(self.tpl_condition_values)
+        DomainStats.count_update(self)
 
     def pre_delete(self):
         """
@@ -59,6 +71,53 @@ class Role(ResourceModel):
             raise DatabaseError('role are referenced by groups', self.__class__.__name__)
         DAO(M2MRolePolicy).delete_obj_qs(role=self.uuid)
 
+    def post_update(self):
+        """
+        更新后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    def post_delete(self):
+        """
+        删除后，失效所有用户的策略缓存，减少域的自定义角色计数
+        """
+        PolicyCache.invalidate_all()
+        DomainStats.count_obj(self, -1)
+
+    @classmethod
+    def validate_bulk_delete(cls, obj_list):
+        """
+        批量删除前，一次性查询存在关联 user 或 group 的角色
+        """
+        role_uuid_list = [obj.uuid for obj in obj_list]
+        failed_dict = {}
+        for uuid in DAO('identity.models.M2MGroupRole').get_obj_qs(role__in=role_uuid_list) \
+                .values_list('role', flat=True).distinct():
+            failed_dict[uuid] = DatabaseError('role are referenced by groups', cls.__name__)
+        for uuid in DAO('identity.models.M2MUserRole').get_obj_qs(role__in=role_uuid_list) \
+                .values_list('role', flat=True).distinct():
+            failed_dict[uuid] = DatabaseError('role are referenced by users', cls.__name__)
+        return failed_dict
+
+    @classmethod
+    def pre_bulk_delete(cls, obj_list):
+        """
+        批量删除前，检查对象的对外关联，批量删除关联的策略关系
+        """
+        failed_dict = cls.validate_bulk_delete(obj_list)
+        if failed_dict:
+            raise next(iter(failed_dict.values()))
+        role_uuid_list = [obj.uuid for obj in obj_list]
+        DAO(M2MRolePolicy).delete_obj_qs(role__in=role_uuid_list)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效所有用户的策略缓存，合并减少域的自定义角色计数
+        """
+        PolicyCache.invalidate_all()
+        DomainStats.count_obj_list(obj_list, -1)
+
     @staticmethod
     def get_field_opts(create=True):
         """
@@ -78,13 +137,15 @@ class Role(ResourceModel):
     def get_default_query_keys(cls):
         return ['name', 'domain'] + super().get_default_query_keys()
 
-    def serialize(self):
+    def serialize(self, fields=None):
         """
         对象序列化，json 解析 tpl_condition_values
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
         :return: dict
         """
-        d = super().serialize()
-        d['tpl_condition_values'] = json_loader(d['tpl_condition_values'])
+        d = super().serialize(fields)
+        if 'tpl_condition_values' in d:
+            d['tpl_condition_values'] = json_loader(d['tpl_condition_values'])
 
         return d
 
@@ -95,12 +156,15 @@ class Policy(ResourceModel):
         verbose_name = '策略'
         unique_together = ['name', 'domain']
         db_table = 'policy'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='policy_created_uuid_idx')
+        ]
         ordering = ('-builtin', '-created_time')
 
     # 必要字段
     name = models.CharField(max_length=64, verbose_name='名字')
     domain = models.CharField(max_length=32, verbose_name='归属域UUID')
-    action = models.CharField(max_length=64, verbose_name='动作UUID')
+    action = models.CharField(max_length=64, db_index=True, verbose_name='动作UUID')
     res = models.TextField(verbose_name='资源列表')
     effect = models.CharField(max_length=16, verbose_name='效力')
 
@@ -109,7 +173,7 @@ class Policy(ResourceModel):
     builtin = models.BooleanField(default=False, verbose_name='是否内置')
     enable = models.BooleanField(default=True, verbose_name="是否启用")
     comment = models.CharField(max_length=64, null=True, verbose_name='备注')
-    role_based_tpl = models.CharField(max_length=64, null=True, verbose_name='基于模版的角色UUID')
+    role_based_tpl = models.CharField(max_length=64, null=True, db_index=True, verbose_name='基于模版的角色UUID')
 
     def pre_create(self):
         """
@@ -123,9 +187,15 @@ class Policy(ResourceModel):
         else:
             DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
+    def post_create(self):
+        """
+        创建后，增加域的自定义策略计数
+        """
+        DomainStats.count_obj(self, 1)
+
     def pre_update(self):
         """
-        更新前，检查 domain、action 是否存在，以及是否内置
+        更新前，检查 domain、action 是否存在，以及是否内置，域或是否内置变化时转移计数
         """
         DAO(Action).get_obj(uuid=self.action)
 
@@ -134,6 +204,8 @@ class Policy(ResourceModel):
         else:
             DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
+        DomainStats.count_update(self)
+
     def pre_delete(self):
         """
         删除前，检查对象的对外关联
@@ -142,6 +214,97 @@ class Policy(ResourceModel):
         if M2MRolePolicy.objects.filter(policy=self.uuid).count() > 0:
             raise DatabaseError('policy are referenced by roles', self.__class__.__name__)
 
+    def post_update(self):
+        """
+        更新后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    def post_delete(self):
+        """
+        删除后，失效所有用户的策略缓存，减少域的自定义策略计数
+        """
+        PolicyCache.invalidate_all()
+        DomainStats.count_obj(self, -1)
+
+    @classmethod
+    def pre_bulk_create(cls, obj_list):
+        """
+        批量创建前，一次性检查 domain、action 是否存在，以及是否内置
+        """
+        for obj in obj_list:
+            super(Policy, obj).pre_create()
+        cls.check_bulk_refs(obj_list)
+
+    @classmethod
+    def post_bulk_create(cls, obj_list):
+        """
+        批量创建后，按域合并增加自定义策略计数
+        """
+        DomainStats.count_obj_list(obj_list, 1)
+
+    @classmethod
+    def pre_bulk_update(cls, obj_list):
+        """
+        批量更新前，一次性检查 domain、action 是否存在，以及是否内置，域或是否内置变化时转移计数
+        """
+        cls.check_bulk_refs(obj_list)
+        DomainStats.count_update_list(obj_list)
+
+    @classmethod
+    def post_bulk_update(cls, obj_list):
+        """
+        批量更新后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    @classmethod
+    def check_bulk_refs(cls, obj_list):
+        """
+        一次性检查对象列表的 action、domain 是否存在，内置对象归属主域
+        :param obj_list: list, 对象列表
+        """
+        DAO(Action).get_field_dict([obj.action for obj in obj_list])
+
+        domain_model = DAO('partition.models.Domain')
+        domain_uuid_set = set()
+        main_domain_uuid = None
+        for obj in obj_list:
+            if obj.builtin:
+                if not main_domain_uuid:
+                    main_domain_uuid = domain_model.get_obj(is_main=True).uuid
+                obj.domain = main_domain_uuid
+            else:
+                domain_uuid_set.add(obj.domain)
+        domain_model.get_field_dict(domain_uuid_set)
+
+    @classmethod
+    def validate_bulk_delete(cls, obj_list):
+        """
+        批量删除前，一次性查询存在关联 role 的策略
+        """
+        policy_uuid_list = [obj.uuid for obj in obj_list]
+        referenced_set = set(M2MRolePolicy.objects.filter(policy__in=policy_uuid_list)
+                             .values_list('policy', flat=True).distinct())
+        return {uuid: DatabaseError('policy are referenced by roles', cls.__name__) for uuid in referenced_set}
+
+    @classmethod
+    def pre_bulk_delete(cls, obj_list):
+        """
+        批量删除前，检查对象的对外关联
+        """
+        failed_dict = cls.validate_bulk_delete(obj_list)
+        if failed_dict:
+            raise next(iter(failed_dict.values()))
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效所有用户的策略缓存，合并减少域的自定义策略计数
+        """
+        PolicyCache.invalidate_all()
+        DomainStats.count_obj_list(obj_list, -1)
+
     @staticmethod
     def get_field_opts(create=True):
         """
@@ -188,6 +351,9 @@ class Action(ResourceModel):
         unique_together = ['name', 'service']
         ordering = ('-created_time', )
         db_table = 'action'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='action_created_uuid_idx')
+        ]
 
     # 必要字段
     name = models.CharField(max_length=64, verbose_name='名字')
@@ -219,6 +385,24 @@ class Action(ResourceModel):
         if DAO(Policy).get_obj_qs(action=self.uuid).count() > 0:
             raise DatabaseError('action are referenced by policies', self.__class__.__name__)
 
+    def post_create(self):
+        """
+        创建后，失效动作索引
+        """
+        ActionIndex.invalidate()
+
+    def post_update(self):
+        """
+        更新后，失效动作索引
+        """
+        ActionIndex.invalidate()
+
+    def post_delete(self):
+        """
+        删除后，失效动作索引
+        """
+        ActionIndex.invalidate()
+
     @staticmethod
     def get_field_opts(create=True):
         """
@@ -249,7 +433,33 @@ class M2MRolePolicy(BaseModel):
         unique_together = ('role', 'policy')
 
     role = models.CharField(max_length=32, verbose_name='角色UUID')
-    policy = models.CharField(max_length=32, verbose_name='策略UUID')
+    policy = models.CharField(max_length=32, db_index=True, verbose_name='策略UUID')
+
+    def post_create(self):
+        """
+        创建后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    def post_delete(self):
+        """
+        删除后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    @classmethod
+    def post_bulk_create(cls, obj_list):
+        """
+        批量创建后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
 
 
 class RoleTpl(ResourceModel):
@@ -257,6 +467,9 @@ class RoleTpl(ResourceModel):
         verbose_name = '角色模版'
         unique_together = ['name', 'domain']
         db_table = 'role_tpl'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='role_tpl_created_uuid_idx')
+        ]
         ordering = ('-builtin', '-created_time')
 
     # 必要字段
@@ -282,9 +495,15 @@ class RoleTpl(ResourceModel):
 
         self.actions = json_dumper(self.actions)
 
+    def post_create(self):
+        """
+        创建后，增加域的自定义角色模版计数
+        """
+        DomainStats.count_obj(self, 1)
+
     def pre_update(self):
         """
-        更新前，检查 domain 是否存在，以及是否内置，序列化 actions 为 json
+        更新前，检查 domain 是否存在，以及是否内置，序列化 actions 为 json，域或是否内置变化时转移计数
         """
         if self.builtin:
             self.domain = DAO('partition.models.Domain').get_obj(is_main=True).uuid
@@ -292,14 +511,30 @@ class RoleTpl(ResourceModel):
             DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
         self.actions = json_dumper(self.actions)
+        DomainStats.count_update(self)
+
+    def post_delete(self):
+        """
+        删除后，减少域的自定义角色模版计数
+        """
+        DomainStats.count_obj(self, -1)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，合并减少域的自定义角色模版计数
+        """
+        DomainStats.count_obj_list(obj_list, -1)
 
-    def serialize(self):
+    def serialize(self, fields=None):
         """
         对象序列化，json 解析 actions
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
         :return: dict
         """
-        d = super().serialize()
-        d['actions'] = json_loader(d['actions'])
+        d = super().serialize(fields)
+        if 'actions' in d:
+            d['actions'] = json_loader(d['actions'])
 
         return d
 
@@ -0,0 +1,219 @@
+from django.test import TestCase, RequestFactory
+from django.core.cache import cache
+from op_keystone.auth_cache import Principal
+from catalog.models import Service
+from partition.models import Domain
+from identity.models import M2MUserRole, M2MGroupRole
+from job.models import Job
+from utils import tools
+from .models import Action, Role, RoleTpl, Policy, M2MRolePolicy
+from .views import TplFlushRole, MultiDeleteRoleView
+
+
+class TplFlushRoleMixin:
+    """
+    模版刷新角色视图的测试数据和请求
+    """
+
+    def setUp(self):
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                            is_main=True, created_by='test')
+        service = Service.objects.create(uuid=tools.generate_unique_uuid(), name='keystone', function='f',
+                                         created_by='test')
+        action_list = [
+            Action.objects.create(uuid=tools.generate_unique_uuid(), name='a%s' % i, service=service.uuid,
+                                  url='^/a%s/$' % i, method='get', created_by='test')
+            for i in range(2)
+        ]
+        self.role_tpl = RoleTpl.objects.create(
+            uuid=tools.generate_unique_uuid(), name='tpl', domain=self.domain.uuid, created_by='test',
+            actions=tools.json_dumper([{'uuid': action.uuid, 'effect': 'allow'} for action in action_list])
+        )
+        self.role = Role.objects.create(uuid=tools.generate_unique_uuid(), name='r', domain=self.domain.uuid,
+                                        tpl=self.role_tpl.uuid, created_by='test')
+        self.principal = Principal('0' * 32, 'admin', self.domain.uuid, True, 1)
+
+    def post(self, **params):
+        request = RequestFactory().post('/assignment/tpl-flush-role/', data=tools.json_dumper(params),
+                                        content_type='application/json')
+        request.user = self.principal
+        response = TplFlushRole.as_view()(request)
+        return tools.json_loader(response.content)
+
+    def get_policy_count(self):
+        policy_uuid_qs = M2MRolePolicy.objects.filter(role=self.role.uuid).values('policy')
+        return Policy.objects.filter(uuid__in=policy_uuid_qs, role_based_tpl=self.role.uuid).count()
+
+
+class TplFlushRoleTestCase(TplFlushRoleMixin, TestCase):
+    """
+    使用模版刷新角色，同步模式和后台任务模式
+    """
+
+    def test_post(self):
+        res = self.post(role_tpl=self.role_tpl.uuid)
+        self.assertEqual(res['code'], 200, res['message'])
+        self.assertEqual(self.get_policy_count(), 2)
+
+    def test_post_async(self):
+        res = self.post(role_tpl=self.role_tpl.uuid, **{'async': True})
+        self.assertEqual(res['code'], 202, res['message'])
+        self.assertEqual(res['data']['name'], 'assignment.jobs.flush_roles')
+        self.assertEqual(self.get_policy_count(), 0)
+
+        job_obj = Job.claim('worker')
+        self.assertEqual(job_obj.uuid, res['data']['uuid'])
+        self.assertTrue(job_obj.run())
+        self.assertEqual(job_obj.status, 'succeed', job_obj.message)
+        self.assertEqual(tools.json_loader(job_obj.result), {'created': 2, 'updated': 0, 'deleted': 0})
+        self.assertEqual(self.get_policy_count(), 2)
+
+
+class TplSyncTestCase(TplFlushRoleMixin, TestCase):
+    """
+    模版刷新角色时按差异同步策略：新增缺少的策略，更新与模版不一致的策略，删除多余的策略
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.flush(), {'created': 2, 'updated': 0, 'deleted': 0})
+        self.policy_dict = {p.action: p for p in Policy.objects.filter(role_based_tpl=self.role.uuid)}
+
+    def flush(self):
+        request = RequestFactory().post('/assignment/tpl-flush-role/')
+        request.user = self.principal
+        return TplFlushRole().flush_roles(request, {'role_tpl': self.role_tpl.uuid})
+
+    def get_linked_set(self):
+        return set(M2MRolePolicy.objects.filter(role=self.role.uuid).values_list('policy', flat=True))
+
+    def test_unchanged(self):
+        updated_time_list = list(Policy.objects.order_by('uuid').values_list('updated_time', flat=True))
+        self.assertEqual(self.flush(), {'created': 0, 'updated': 0, 'deleted': 0})
+        self.assertEqual(list(Policy.objects.order_by('uuid').values_list('updated_time', flat=True)),
+                         updated_time_list)
+
+    def test_update_drift(self):
+        # 模版生成的字段被修改后，刷新时原地恢复，并记录更新用户
+        drifted, commented = self.policy_dict.values()
+        origin_dict = Policy.objects.filter(pk=drifted.pk).values(*TplFlushRole.synced_policy_fields).get()
+        Policy.objects.filter(pk=drifted.pk).update(res='/x/', domain=tools.generate_unique_uuid(), enable=False)
+        Policy.objects.filter(pk=commented.pk).update(comment='changed')
+
+        self.assertEqual(self.flush(), {'created': 0, 'updated': 2, 'deleted': 0})
+        self.assertEqual(Policy.objects.filter(pk=drifted.pk).values(*TplFlushRole.synced_policy_fields).get(),
+                         origin_dict)
+        self.assertEqual(Policy.objects.get(pk=commented.pk).comment, commented.comment)
+        self.assertEqual(set(Policy.objects.filter(role_based_tpl=self.role.uuid).values_list('updated_by', flat=True)),
+                         {self.principal.uuid})
+        self.assertEqual(self.get_linked_set(), {p.uuid for p in self.policy_dict.values()})
+
+    def test_template_actions_changed(self):
+        # 模版去掉一个动作、加入一个新动作，只新增和删除对应的策略
+        actions = tools.json_loader(self.role_tpl.actions)
+        removed_action = actions.pop()['uuid']
+        kept_action = actions[0]['uuid']
+        service_uuid = Action.objects.get(uuid=kept_action).service
+        new_action = Action.objects.create(uuid=tools.generate_unique_uuid(), name='a2', service=service_uuid,
+                                           url='^/a2/$', method='get', created_by='test')
+        actions.append({'uuid': new_action.uuid, 'effect': 'deny'})
+        RoleTpl.objects.filter(uuid=self.role_tpl.uuid).update(actions=tools.json_dumper(actions))
+
+        self.assertEqual(self.flush(), {'created': 1, 'updated': 0, 'deleted': 1})
+        self.assertFalse(Policy.objects.filter(uuid=self.policy_dict[removed_action].uuid).exists())
+        new_policy = Policy.objects.get(role_based_tpl=self.role.uuid, action=new_action.uuid)
+        self.assertEqual(new_policy.effect, 'deny')
+        self.assertEqual(self.get_linked_set(), {self.policy_dict[kept_action].uuid, new_policy.uuid})
+
+    def test_duplicate_and_foreign_policies(self):
+        # 同一动作重复的模版策略删除，角色关联的非模版策略只解除关联
+        kept = next(iter(self.policy_dict.values()))
+        duplicate = Policy.objects.create(uuid=tools.generate_unique_uuid(), name='dup', action=kept.action,
+                                          res='*', effect='allow', domain=self.domain.uuid,
+                                          role_based_tpl=self.role.uuid, created_by='test')
+        foreign = Policy.objects.create(uuid=tools.generate_unique_uuid(), name='foreign', action=kept.action,
+                                        res='*', effect='allow', domain=self.domain.uuid, created_by='test')
+        for policy in (duplicate, foreign):
+            M2MRolePolicy.objects.create(role=self.role.uuid, policy=policy.uuid)
+
+        count_dict = self.flush()
+        self.assertEqual((count_dict['created'], count_dict['deleted']), (0, 1))
+        tpl_policy_qs = Policy.objects.filter(role_based_tpl=self.role.uuid)
+        self.assertEqual(tpl_policy_qs.filter(action=kept.action).count(), 1)
+        self.assertEqual(tpl_policy_qs.filter(action=kept.action).get().name, kept.name)
+        self.assertTrue(Policy.objects.filter(uuid=foreign.uuid).exists())
+        self.assertEqual(self.get_linked_set(), set(tpl_policy_qs.values_list('uuid', flat=True)))
+
+
+class MultiDeleteRoleViewTestCase(TestCase):
+    """
+    批量删除角色，部分删除模式返回每个角色的删除结果，非部分删除模式存在失败时不删除
+    """
+
+    def setUp(self):
+        cache.clear()
+        main_domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                            is_main=True, created_by='test')
+        domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='sub', company='c', agent='a',
+                                       created_by='test')
+        self.role_list = [self.create_role(domain, 'r%s' % i) for i in range(4)]
+        self.builtin_role = self.create_role(main_domain, 'builtin', builtin=True)
+
+        # 被用户和组引用的角色不能删除，角色关联的策略关系随角色删除
+        M2MUserRole.objects.create(user=tools.generate_unique_uuid(), role=self.role_list[2].uuid)
+        M2MGroupRole.objects.create(group=tools.generate_unique_uuid(), role=self.role_list[3].uuid)
+        M2MRolePolicy.objects.create(role=self.role_list[0].uuid, policy=tools.generate_unique_uuid())
+        self.principal = Principal('0' * 32, 'u', domain.uuid, False, 3)
+
+    @staticmethod
+    def create_role(domain, name, **field_opts):
+        return Role.objects.create(uuid=tools.generate_unique_uuid(), name=name, domain=domain.uuid,
+                                   created_by='test', **field_opts)
+
+    def post(self, **params):
+        request = RequestFactory().post('/assignment/multi-delete-roles/', data=tools.json_dumper(params),
+                                        content_type='application/json')
+        request.user = self.principal
+        response = MultiDeleteRoleView.as_view()(request)
+        return tools.json_loader(response.content)
+
+    def get_remain_set(self):
+        return set(Role.objects.values_list('uuid', flat=True))
+
+    def test_partial(self):
+        missing_uuid = tools.generate_unique_uuid()
+        uuid_list = [r.uuid for r in self.role_list] + [self.role_list[0].uuid, self.builtin_role.uuid, missing_uuid]
+        res = self.post(uuid_list=uuid_list, partial='true')
+        self.assertEqual(res['code'], 200, res['message'])
+        self.assertEqual(res['data']['deleted'], [self.role_list[0].uuid, self.role_list[1].uuid])
+
+        failed_dict = res['data']['failed']
+        self.assertEqual(set(failed_dict), {self.role_list[2].uuid, self.role_list[3].uuid, self.builtin_role.uuid,
+                                            missing_uuid})
+        self.assertIn('referenced by users', failed_dict[self.role_list[2].uuid])
+        self.assertIn('referenced by groups', failed_dict[self.role_list[3].uuid])
+        self.assertIn('PermissionDenied', failed_dict[self.builtin_role.uuid])
+        self.assertIn('ObjectNotExist', failed_dict[missing_uuid])
+
+        self.assertEqual(self.get_remain_set(), {self.role_list[2].uuid, self.role_list[3].uuid,
+                                                 self.builtin_role.uuid})
+        self.assertFalse(M2MRolePolicy.objects.exists())
+
+    def test_partial_all_failed(self):
+        res = self.post(uuid_list=[self.role_list[2].uuid], partial=True)
+        self.assertEqual(res['code'], 200, res['message'])
+        self.assertEqual(res['data']['deleted'], [])
+        self.assertEqual(list(res['data']['failed']), [self.role_list[2].uuid])
+        self.assertEqual(len(self.get_remain_set()), 5)
+
+    def test_not_partial(self):
+        # 存在失败时返回第一个失败原因，不删除任何角色
+        res = self.post(uuid_list=[r.uuid for r in self.role_list])
+        self.assertEqual(res['code'], 409)
+        self.assertIn('referenced by users', res['message'])
+        self.assertEqual(len(self.get_remain_set()), 5)
+
+        res = self.post(uuid_list=[r.uuid for r in self.role_list[:2]], partial='0')
+        self.assertEqual(res['code'], 200, res['message'])
+        self.assertEqual(self.get_remain_set(), {self.role_list[2].uuid, self.role_list[3].uuid,
+                                                 self.builtin_role.uuid})
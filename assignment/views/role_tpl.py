@@ -1,5 +1,6 @@
 from op_keystone.base_view import BaseView, ResourceView
-from op_keystone.exceptions import CustomException, RoutingParamsError, RequestParamsError
+from op_keystone.exceptions import CustomException, RoutingParamsError, RequestParamsError, ObjectNotExist
+from django.db import transaction
 from utils.dao import DAO
 from ..models import RoleTpl
 from utils.tools import json_loader
@@ -15,7 +16,129 @@ class RoleTplsView(ResourceView):
         super().__init__(model)
 
 
-class TplBasedRole(BaseView):
+class TplRoleMixin:
+    """
+    基于模版角色的策略同步，按差异新增、更新、删除模版生成的策略，使用批量写入
+    """
+
+    # 模版生成策略中，根据模版和角色计算、需要同步的字段，动作和模版角色用于匹配现有策略
+    synced_policy_fields = ('name', 'res', 'condition', 'effect', 'comment', 'domain', 'enable')
+
+    def get_action_dict(self, role_tpl):
+        """
+        一次性获取模版中所有动作对象，多个角色同步时复用
+        :param role_tpl: dict, 模版序列化字典
+        :return: dict, {action uuid: action object, ...}
+        """
+        action_uuid_set = set(a['uuid'] for a in role_tpl['actions'])
+        action_dict = {obj.uuid: obj for obj in self._action_model.get_obj_qs(uuid__in=action_uuid_set)}
+        if len(action_dict) != len(action_uuid_set):
+            raise ObjectNotExist('Action')
+        return action_dict
+
+    @staticmethod
+    def get_desired_dict(role_tpl, condition_values):
+        """
+        根据模版和条件值，计算角色期望的策略效果和条件
+        :param role_tpl: dict, 模版序列化字典
+        :param condition_values: list, 模版条件值列表
+        :return: dict, {action uuid: (effect, condition), ...}
+        """
+        desired_dict = {}
+        for a in role_tpl['actions']:
+            condition = ""
+            if a.get('enable_condition') and condition_values:
+                condition = a.get('condition_field') + ':' + '|'.join(condition_values)
+
+            if a.get('effect') and a.get('effect') in ['allow', 'deny']:
+                effect = a.get('effect')
+            else:
+                effect = 'allow'
+
+            desired_dict[a['uuid']] = (effect, condition)
+        return desired_dict
+
+    def sync_role_policies(self, role_obj, role_tpl, condition_values, action_dict, *opts_dicts):
+        """
+        同步角色的模版生成策略，只写入与期望不一致的策略，角色只关联模版生成的策略
+        :param role_obj: role object, 角色对象
+        :param role_tpl: dict, 模版序列化字典
+        :param condition_values: list, 模版条件值列表
+        :param action_dict: dict, 动作对象字典
+        :param opts_dicts: dict, 附加的选项字典
+        :return: dict, 新增、更新、删除的策略数量
+        """
+        # 期望的策略字段，按动作索引
+        self._policy_model.get_opts(create=True)
+        desired_opts_dict = {}
+        for action_uuid, (effect, condition) in self.get_desired_dict(role_tpl, condition_values).items():
+            policy_name = '%s 对于 %s 的策略' % (role_obj.name, action_dict[action_uuid].name)
+            policy_fields = {
+                'name': policy_name,
+                'action': action_uuid,
+                'res': '*',
+                'condition': condition,
+                'effect': effect,
+                'comment': policy_name,
+                'role_based_tpl': role_obj.uuid,
+                'domain': role_obj.domain,
+                'enable': True
+            }
+            desired_opts_dict[action_uuid] = self._policy_model.validate_opts_dict(policy_fields, *opts_dicts)
+
+        # 现有的模版生成策略，按动作匹配，不在模版中或者重复的策略删除
+        exist_dict = {}
+        del_policy_list = []
+        for p_obj in self._policy_model.get_obj_qs(role_based_tpl=role_obj.uuid):
+            if p_obj.action in desired_opts_dict and p_obj.action not in exist_dict:
+                exist_dict[p_obj.action] = p_obj
+            else:
+                del_policy_list.append(p_obj)
+
+        # 比较字段，不存在的策略新增，字段不一致的策略按修改内容分组更新，记录更新用户
+        operator = self._policy_model.user or self._policy_model.service
+        create_opts_list = []
+        update_group_dict = {}
+        for action_uuid, policy_opts in desired_opts_dict.items():
+            p_obj = exist_dict.get(action_uuid)
+            if not p_obj:
+                create_opts_list.append(policy_opts)
+                continue
+
+            changed = tuple((f, policy_opts[f]) for f in self.synced_policy_fields
+                            if getattr(p_obj, f) != policy_opts[f])
+            if changed:
+                update_group_dict.setdefault(changed, []).append(p_obj)
+
+        with transaction.atomic():
+            # 删除多余策略的关联和策略
+            if del_policy_list:
+                self._m2m_model.delete_obj_qs(role=role_obj.uuid, policy__in=[p.uuid for p in del_policy_list])
+                self._policy_model.bulk_delete_objs(del_policy_list)
+
+            # 更新和新增策略
+            for changed, obj_list in update_group_dict.items():
+                self._policy_model.bulk_update_objs(obj_list, updated_by=operator.uuid, **dict(changed))
+            created_list = self._policy_model.bulk_create_objs(create_opts_list)
+
+            # 同步关联，角色只关联模版生成的策略
+            desired_uuid_set = set(p.uuid for p in exist_dict.values()) | set(p.uuid for p in created_list)
+            linked_uuid_set = set(self._m2m_model.get_field_list('policy', role=role_obj.uuid))
+            unlink_uuid_list = list(linked_uuid_set - desired_uuid_set)
+            if unlink_uuid_list:
+                self._m2m_model.delete_obj_qs(role=role_obj.uuid, policy__in=unlink_uuid_list)
+            self._m2m_model.bulk_create_objs([
+                {'role': role_obj.uuid, 'policy': p_uuid} for p_uuid in desired_uuid_set - linked_uuid_set
+            ])
+
+        return {
+            'created': len(created_list),
+            'updated': sum(len(obj_list) for obj_list in update_group_dict.values()),
+            'deleted': len(del_policy_list)
+        }
+
+
+class TplBasedRole(BaseView, TplRoleMixin):
     """
     使用角色模版来生成角色、更新角色、删除角色模版生成的角色
     """
@@ -41,61 +164,31 @@ class TplBasedRole(BaseView):
             extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
 
             # 结合请求信息，设置到策略 model 属性，
-            self._role_tpl_model.combine_request(request)
-            self._policy_model.combine_request(request)
-            self._role_model.combine_request(request)
-            self._action_model.combine_request(request)
+            self._role_tpl_model = self._role_tpl_model.scoped(request)
+            self._policy_model = self._policy_model.scoped(request)
+            self._role_model = self._role_model.scoped(request)
+            self._action_model = self._action_model.scoped(request)
 
             # 参数和模版对象获取
             tpl_uuid = necessary_opts_dict['role_tpl']
             condition_values = necessary_opts_dict.get('condition_values')
             role_tpl = self._role_tpl_model.get_obj(uuid=tpl_uuid).serialize()
+            action_dict = self.get_action_dict(role_tpl)
 
-            # 角色创建
-            role_fields = {
-                'name': necessary_opts_dict['name'],
-                'tpl': tpl_uuid,
-                'tpl_condition_values': condition_values
-            }
-            self._role_model.get_opts(create=True)
-            role_opts = self._role_model.validate_opts_dict(role_fields, extra_opts_dict)
-            role_created = self._role_model.create_obj(**role_opts)
-
-            # 生成条件，策略创建
-            extra_opts_dict.pop('comment', None)
-            policy_uuid_list = []
-            for a in role_tpl['actions']:
-                condition = ""
-                if a.get('enable_condition') and condition_values:
-                        condition = a.get('condition_field') + ':' + '|'.join(condition_values)
-
-                if a.get('effect') and a.get('effect') in ['allow', 'deny'] :
-                    effect = a.get('effect')
-                else:
-                    effect = 'allow'
-
-                action_obj = self._action_model.get_obj(uuid=a['uuid'])
-
-                policy_fields = {
-                    'name': '%s 对于 %s 的策略' % (role_created.name, action_obj.name),
-                    'action': a['uuid'],
-                    'res': '*',
-                    'condition': condition,
-                    'effect': effect,
-                    'comment' : '%s 对于 %s 的策略' % (role_created.name, action_obj.name),
-                    'role_based_tpl': role_created.uuid,
+            with transaction.atomic():
+                # 角色创建
+                role_fields = {
+                    'name': necessary_opts_dict['name'],
+                    'tpl': tpl_uuid,
+                    'tpl_condition_values': condition_values
                 }
-                self._policy_model.get_opts(create=True)
-                policy_opts = self._policy_model.validate_opts_dict(policy_fields, extra_opts_dict)
-                policy_created = self._policy_model.create_obj(**policy_opts)
-                policy_uuid_list.append(policy_created.uuid)
-
-            # 策略绑定角色
-            for p in policy_uuid_list:
-                self._m2m_model.create_obj(**{
-                    'role': role_created.uuid,
-                    'policy': p
-                })
+                self._role_model.get_opts(create=True)
+                role_opts = self._role_model.validate_opts_dict(role_fields, extra_opts_dict)
+                role_created = self._role_model.create_obj(**role_opts)
+
+                # 生成条件，批量创建策略并绑定角色
+                extra_opts_dict.pop('comment', None)
+                self.sync_role_policies(role_created, role_tpl, condition_values, action_dict, extra_opts_dict)
 
             # 返回角色信息
             return self.standard_response(role_created.serialize())
@@ -105,7 +198,7 @@ class TplBasedRole(BaseView):
 
     def put(self, request, uuid):
         """
-        相当于删除并重新生成基于模版角色的策略
+        按模版重新计算角色的策略，只新增、更新、删除有差异的模版生成策略
         """
         try:
             # 参数提取
@@ -119,10 +212,10 @@ class TplBasedRole(BaseView):
             extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
 
             # 结合请求信息，设置 model 查询参数
-            self._role_tpl_model.combine_request(request)
-            self._policy_model.combine_request(request)
-            self._role_model.combine_request(request)
-            self._action_model.combine_request(request)
+            self._role_tpl_model = self._role_tpl_model.scoped(request)
+            self._policy_model = self._policy_model.scoped(request)
+            self._role_model = self._role_model.scoped(request)
+            self._action_model = self._action_model.scoped(request)
 
             # 若 uuid 不存在，发生路由参数异常，否则获取对象，并校验对象权限
             if not uuid:
@@ -137,66 +230,27 @@ class TplBasedRole(BaseView):
             if not role_tpl_uuid:
                 role_tpl_uuid = role_obj.tpl
             role_tpl = self._role_tpl_model.get_obj(uuid=role_tpl_uuid).serialize()
+            action_dict = self.get_action_dict(role_tpl)
 
             # 模版条件获取
             condition_values = extra_opts_dict.pop('condition_values', None)
             if not condition_values:
                 condition_values = json_loader(role_obj.tpl_condition_values)
 
-            # 获取 role 关联 policy 对象的 uuid 列表，删除关联
-            del_policy_uuid_list = self._m2m_model.get_field_list('policy', role=uuid)
-            self._m2m_model.delete_obj_qs(role=uuid)
-
-            # 判断策略是否是模版生成，是则删除策略
-            for p_uuid in del_policy_uuid_list:
-                p_obj = self._policy_model.get_obj(uuid=p_uuid)
-                if p_obj.role_based_tpl == uuid:
-                    self._policy_model.delete_obj(p_obj)
+            with transaction.atomic():
+                # 生成条件，按差异同步策略和关联
+                self.sync_role_policies(
+                    role_obj, role_tpl, condition_values, action_dict, necessary_opts_dict, extra_opts_dict
+                )
 
-            # 生成条件，策略创建
-            policy_uuid_list = []
-            for a in role_tpl['actions']:
-                condition = ""
-                if a.get('enable_condition') and condition_values:
-                    condition = a.get('condition_field') + ':' + '|'.join(condition_values)
-
-                if a.get('effect') and a.get('effect') in ['allow', 'deny']:
-                    effect = a.get('effect')
-                else:
-                    effect = 'allow'
-
-                action_obj = self._action_model.get_obj(uuid=a['uuid'])
-
-                policy_fields = {
-                    'name': '%s 对于 %s 的策略' % (role_obj.name, action_obj.name),
-                    'action': a['uuid'],
-                    'res': '*',
-                    'condition': condition,
-                    'effect': effect,
-                    'comment': '%s 对于 %s 的策略' % (role_obj.name, action_obj.name),
-                    'role_based_tpl': role_obj.uuid,
-                    'domain': role_obj.domain
+                # 更新角色
+                role_fields = {
+                    'tpl': role_tpl_uuid,
+                    'tpl_condition_values': condition_values,
                 }
-                self._policy_model.get_opts(create=True)
-                policy_opts = self._policy_model.validate_opts_dict(policy_fields, necessary_opts_dict, extra_opts_dict)
-                policy_created = self._policy_model.create_obj(**policy_opts)
-                policy_uuid_list.append(policy_created.uuid)
-
-            # 策略绑定角色
-            for p in policy_uuid_list:
-                self._m2m_model.create_obj(**{
-                    'role': role_obj.uuid,
-                    'policy': p
-                })
-
-            # 更新角色
-            role_fields = {
-                'tpl': role_tpl_uuid,
-                'tpl_condition_values': condition_values,
-            }
-            self._role_model.get_opts()
-            role_opts = self._role_model.validate_opts_dict(role_fields, necessary_opts_dict, extra_opts_dict)
-            updated_role_obj = self._role_model.update_obj(role_obj, **role_opts)
+                self._role_model.get_opts()
+                role_opts = self._role_model.validate_opts_dict(role_fields, necessary_opts_dict, extra_opts_dict)
+                updated_role_obj = self._role_model.update_obj(role_obj, **role_opts)
 
             # 返回角色信息
             return self.standard_response(updated_role_obj.serialize())
@@ -207,8 +261,8 @@ class TplBasedRole(BaseView):
     def delete(self, request, uuid):
         try:
             # 结合请求信息，设置 model 查询参数
-            self._role_model.combine_request(request)
-            self._policy_model.combine_request(request)
+            self._role_model = self._role_model.scoped(request)
+            self._policy_model = self._policy_model.scoped(request)
 
             # 若 uuid 不存在，发生路由参数异常，否则获取对象，并校验对象权限
             if not uuid:
@@ -238,7 +292,7 @@ class TplBasedRole(BaseView):
             return self.exception_to_response(e)
 
 
-class TplFlushRole(BaseView):
+class TplFlushRole(BaseView, TplRoleMixin):
     """
     使用模版刷新所有所创的角色
     """
@@ -260,80 +314,54 @@ class TplFlushRole(BaseView):
             request_params = self.get_params_dict(request)
             necessary_opts_dict = self.extract_opts(request_params, necessary_opts)
 
-            # 结合请求信息，设置到策略 model 属性，
-            self._role_tpl_model.combine_request(request)
-            self._policy_model.combine_request(request)
-            self._role_model.combine_request(request)
-            self._action_model.combine_request(request)
-
-            # 模版对象获取
-            role_tpl_uuid = necessary_opts_dict.pop('role_tpl')
-            role_tpl = self._role_tpl_model.get_obj(uuid=role_tpl_uuid).serialize()
-
-            # 获取所有模版角色
-            role_obj_qs = self._role_model.get_obj_qs(tpl=role_tpl['uuid'])
-
-            for role_obj in role_obj_qs:
-                # 模版条件获取
-                condition_values = json_loader(role_obj.tpl_condition_values)
-
-                # 获取 role 关联 policy 对象的 uuid 列表，删除关联
-                del_policy_uuid_list = self._m2m_model.get_field_list('policy', role=role_obj.uuid)
-                self._m2m_model.delete_obj_qs(role=role_obj.uuid)
-
-                # 判断策略是否是模版生成，是则删除策略
-                for p_uuid in del_policy_uuid_list:
-                    p_obj = self._policy_model.get_obj(uuid=p_uuid)
-                    if p_obj.role_based_tpl == role_obj.uuid:
-                        self._policy_model.delete_obj(p_obj)
-
-                # 生成条件，策略创建
-                policy_uuid_list = []
-                for a in role_tpl['actions']:
-                    condition = ""
-                    if a.get('enable_condition') and condition_values:
-                        condition = a.get('condition_field') + ':' + '|'.join(condition_values)
-
-                    if a.get('effect') and a.get('effect') in ['allow', 'deny']:
-                        effect = a.get('effect')
-                    else:
-                        effect = 'allow'
-
-                    action_obj = self._action_model.get_obj(uuid=a['uuid'])
-
-                    policy_fields = {
-                        'name': '%s 对于 %s 的策略' % (role_obj.name, action_obj.name),
-                        'action': a['uuid'],
-                        'res': '*',
-                        'condition': condition,
-                        'effect': effect,
-                        'comment': '%s 对于 %s 的策略' % (role_obj.name, action_obj.name),
-                        'role_based_tpl': role_obj.uuid,
-                        'domain': role_obj.domain
-                    }
-                    self._policy_model.get_opts(create=True)
-                    policy_opts = self._policy_model.validate_opts_dict(policy_fields, necessary_opts_dict)
-                    print(policy_opts)
-                    policy_created = self._policy_model.create_obj(**policy_opts)
-                    policy_uuid_list.append(policy_created.uuid)
-
-                # 策略绑定角色
-                for p in policy_uuid_list:
-                    self._m2m_model.create_obj(**{
-                        'role': role_obj.uuid,
-                        'policy': p
-                    })
+            extra_opts = ['async']
+            extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
 
-                # 更新角色
-                role_fields = {
-                    'tpl': role_tpl_uuid,
-                    'tpl_condition_values': condition_values,
-                }
-                self._role_model.get_opts()
-                role_opts = self._role_model.validate_opts_dict(role_fields, necessary_opts_dict)
-                self._role_model.update_obj(role_obj, **role_opts)
+            # 后台任务模式，提交任务后返回任务信息
+            if self.is_async(extra_opts_dict):
+                self._role_tpl_model = self._role_tpl_model.scoped(request)
+                self._role_tpl_model.get_obj(uuid=necessary_opts_dict['role_tpl'])
+                return self.submit_job(request, 'assignment.jobs.flush_roles', necessary_opts_dict)
 
+            self.flush_roles(request, necessary_opts_dict)
             return self.standard_response("succeed to flush roles through tpl")
 
         except CustomException as e:
-            return self.exception_to_response(e)
\ No newline at end of file
+            return self.exception_to_response(e)
+
+    def flush_roles(self, request, necessary_opts_dict, progress=None):
+        """
+        使用模版刷新所有所创的角色，每个角色只写入与模版不一致的策略
+        :param request: request object, 请求
+        :param necessary_opts_dict: dict, 必要参数字典
+        :param progress: function, 进度回调，参数为已完成数量和总数量
+        :return: dict, 新增、更新、删除的策略总数量
+        """
+        # 结合请求信息，设置到策略 model 属性，
+        self._role_tpl_model = self._role_tpl_model.scoped(request)
+        self._policy_model = self._policy_model.scoped(request)
+        self._role_model = self._role_model.scoped(request)
+        self._action_model = self._action_model.scoped(request)
+
+        # 模版对象获取，所有角色复用一份动作字典
+        role_tpl_uuid = necessary_opts_dict.pop('role_tpl')
+        role_tpl = self._role_tpl_model.get_obj(uuid=role_tpl_uuid).serialize()
+        action_dict = self.get_action_dict(role_tpl)
+
+        # 获取所有模版角色
+        role_obj_list = list(self._role_model.get_obj_qs(tpl=role_tpl['uuid']))
+
+        count_dict = {'created': 0, 'updated': 0, 'deleted': 0}
+        for index, role_obj in enumerate(role_obj_list):
+            # 模版条件获取，按差异同步策略和关联，角色的模版和条件不变，无需更新角色
+            condition_values = json_loader(role_obj.tpl_condition_values)
+            role_count_dict = self.sync_role_policies(
+                role_obj, role_tpl, condition_values, action_dict, necessary_opts_dict
+            )
+            for k, v in role_count_dict.items():
+                count_dict[k] += v
+
+            if progress:
+                progress(index + 1, len(role_obj_list))
+
+        return count_dict
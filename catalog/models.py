@@ -1,4 +1,5 @@
 from op_keystone.base_model import ResourceModel
+from op_keystone.auth_cache import ActionIndex
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.db import models
@@ -14,6 +15,9 @@ class Service(ResourceModel):
     class Meta:
         verbose_name = '服务'
         db_table = 'service'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='service_created_uuid_idx')
+        ]
 
     # 必要字段
     name = models.CharField(max_length=64, unique=True, verbose_name='服务名')
@@ -26,8 +30,9 @@ class Service(ResourceModel):
 
     def post_create(self):
         """
-        创建后，生成一个永久服务 token 并返回到响应，，通知 channels
+        创建后，生成一个永久服务 token 并返回到响应，失效服务索引，通知 channels
         """
+        ActionIndex.invalidate()
         now = tools.get_datetime_with_tz()
         service_token = tools.generate_mapping_uuid(self.uuid, tools.datetime_to_humanized(now))
         DAO('credence.models.Token').create_obj(carrier=self.uuid, token=service_token,
@@ -41,8 +46,9 @@ class Service(ResourceModel):
 
     def post_update(self):
         """
-        更新后，通知 channels
+        更新后，失效服务索引，通知 channels
         """
+        ActionIndex.invalidate()
         async_to_sync(channel_layer.group_send)("catalog_notice", {
             'type': 'chat.message',
             'notice': 'service_updated'
@@ -57,9 +63,10 @@ class Service(ResourceModel):
 
     def post_delete(self):
         """
-        删除后，删除服务 token，通知 channels
+        删除后，删除服务 token，失效服务索引，通知 channels
         :return:
         """
+        ActionIndex.invalidate()
         DAO('credence.models.Token').delete_obj_qs(carrier=self.uuid, type=2)
         async_to_sync(channel_layer.group_send)("catalog_notice", {
             'type': 'chat.message',
@@ -91,6 +98,9 @@ class Endpoint(ResourceModel):
     class Meta:
         verbose_name = '端点'
         db_table = 'endpoint'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='endpoint_created_uuid_idx')
+        ]
         unique_together = ('ip', 'port')
 
     # 必要字段
@@ -1,4 +1,5 @@
 from op_keystone.base_model import BaseModel
+from op_keystone.auth_cache import PrincipalCache
 from django.db import models
 
 
@@ -11,7 +12,24 @@ class Token(BaseModel):
 
     # 必要字段
     carrier = models.CharField(max_length=32, verbose_name='载体UUID')
-    token = models.CharField(max_length=32, verbose_name='TOKEN')
+    token = models.CharField(max_length=32, db_index=True, verbose_name='TOKEN')
     expire_date = models.DateTimeField(verbose_name='过期时间')
     type = models.IntegerField(verbose_name='类型，0:access_token，1:refresh_token，2:service_token')
 
+    def pre_update(self):
+        """
+        更新前，记录原 token，用于失效其用户快照缓存
+        """
+        self._origin_token = Token.objects.filter(pk=self.pk).values_list('token', flat=True).first()
+
+    def post_update(self):
+        """
+        更新后，失效原 token 和新 token 的用户快照缓存，使过期时间和 token 的变更立即生效
+        """
+        PrincipalCache.invalidate_tokens(getattr(self, '_origin_token', None), self.token)
+
+    def post_delete(self):
+        """
+        删除后，失效 token 的用户快照缓存
+        """
+        PrincipalCache.invalidate_tokens(self.token)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from identity.models import UserArchive
+
+
+class Command(BaseCommand):
+    """
+    将删除超过指定天数的用户分批移动到归档表，保持用户表和索引的大小与有效用户数量一致，可定期执行
+    """
+    help = 'Move soft deleted users into the user_archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.USER_ARCHIVE_DAYS,
+                            help='archive users deleted more than these days ago')
+        parser.add_argument('--batch-size', type=int, default=settings.USER_ARCHIVE_BATCH_SIZE,
+                            help='users moved in one transaction')
+
+    def handle(self, *args, **options):
+        archived_count = UserArchive.archive(options['days'], options['batch_size'])
+        self.stdout.write('archived %s deleted users' % archived_count)
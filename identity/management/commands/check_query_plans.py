@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from op_keystone import query_plans
+
+
+class Command(BaseCommand):
+    """
+    使用 EXPLAIN 检查鉴权、DAO 热点查询的执行计划，存在全表扫描时失败，用于检查线上数据库的索引，
+    测试数据库上的同一检查见 op_keystone.tests.QueryPlanTestCase
+    """
+    help = 'Explain the hot path queries and fail on full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plan', action='store_true', help='print the plan of every query')
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('mysql', 'sqlite'):
+            raise CommandError('unsupported database vendor %s' % connection.vendor)
+
+        failed_list = []
+        for name, obj_qs in query_plans.get_hot_queries():
+            plan_list = query_plans.explain(obj_qs)
+            scan_list = [plan for plan in plan_list if query_plans.is_full_scan(plan)]
+
+            if options['verbose_plan'] or scan_list:
+                self.stdout.write('%s:' % name)
+                for plan in plan_list:
+                    self.stdout.write('    %s' % (plan,))
+            if scan_list:
+                failed_list.append(name)
+
+        if failed_list:
+            raise CommandError('full table scan in queries: %s' % ', '.join(failed_list))
+        self.stdout.write('no full table scan in hot path queries')
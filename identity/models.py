@@ -1,8 +1,12 @@
 from op_keystone.base_model import BaseModel, ResourceModel
-from django.db import models
+from django.db import models, transaction
+from django.db.utils import Error
 from op_keystone.exceptions import *
 from django.contrib.auth.password_validation import validate_password as v_password
 from django.core.exceptions import ValidationError
+from op_keystone.auth_cache import PolicyCache, PrincipalCache, TokenRevocation
+from partition.models import DomainStats
+from search.models import SearchSuffix
 from utils.dao import DAO
 from utils import tools
 
@@ -18,6 +22,10 @@ class User(ResourceModel):
             ('phone', 'deleted_time'),
             ('email', 'deleted_time')
         ]
+        indexes = [
+            models.Index(fields=['deleted_time', 'domain'], name='user_deleted_time_domain_idx'),
+            models.Index(fields=['deleted_time', 'created_time', 'uuid'], name='user_deleted_created_idx')
+        ]
         ordering = ('-domain', '-is_main')
 
     # 必要字段
@@ -38,6 +46,9 @@ class User(ResourceModel):
     # 软删除字段
     deleted_time = models.DateTimeField(default=tools.timestamp_to_datetime(0), verbose_name='删除时间')
 
+    # 签名 token 中用户快照包含的字段，变化时需要吊销已签发的 token
+    snapshot_fields = ('domain', 'is_main', 'enable')
+
     def pre_create(self):
         """
         创建前，进行密码校验、字段检查
@@ -60,14 +71,19 @@ class User(ResourceModel):
 
     def post_create(self):
         """
-        创建后，创建对应的 behavior 对象
+        创建后，创建对应的 behavior 对象，增加域的用户计数，启用查询后缀索引时建立索引
         """
         DAO('identity.models.UserBehavior').create_obj(user=self.uuid)
+        DomainStats.count_obj(self, 1)
+        SearchSuffix.index_obj_list([self])
 
     def pre_update(self):
         """
-        更新前，进行 user 字段的检查
+        更新前，进行 user 字段的检查，记录用户快照字段和查询索引字段的原值
         """
+        self.snapshot_origin_dict = User.objects.filter(pk=self.pk) \
+            .values(*self.snapshot_fields, *self.get_search_index_keys()).first() or {}
+
         # 检查 domain 是否存在
         domain_obj = DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
@@ -90,6 +106,9 @@ class User(ResourceModel):
             raise DatabaseError('more than one main user of domain %s'
                                 % domain_obj.name, self.__class__.__name__)
 
+        # 域变化时转移用户计数
+        DomainStats.count_update(self)
+
     def pre_delete(self):
         """
         删除前，检查是否为主用户，删除对象的关联 group 和 role
@@ -99,21 +118,117 @@ class User(ResourceModel):
         DAO('identity.models.M2MUserGroup').delete_obj_qs(user=self.uuid)
         DAO('identity.models.M2MUserRole').delete_obj_qs(user=self.uuid)
 
-    def serialize(self):
+    def post_update(self):
+        """
+        更新后，失效用户 token 的用户快照缓存，域、是否主用户或启用状态变化时吊销签名 token，
+        查询索引字段变化时重建查询后缀索引
+        """
+        PrincipalCache.invalidate_users(self.uuid)
+        changed_fields = self.get_changed_fields()
+        if changed_fields.intersection(self.snapshot_fields):
+            TokenRevocation.revoke_user(self.uuid)
+        if changed_fields.intersection(self.get_search_index_keys()):
+            SearchSuffix.index_obj_list([self])
+
+    def get_changed_fields(self):
+        """
+        对比更新前记录的原值，获取发生变化的字段
+        :return: set
+        """
+        origin_dict = getattr(self, 'snapshot_origin_dict', {})
+        return {k for k, v in origin_dict.items() if getattr(self, k) != v}
+
+    def post_delete(self):
+        """
+        删除后，失效用户的策略缓存和 token 的用户快照缓存，吊销签名 token，减少域的用户计数，删除查询后缀索引
+        """
+        PolicyCache.invalidate_user(self.uuid)
+        PrincipalCache.invalidate_users(self.uuid)
+        TokenRevocation.revoke_user(self.uuid)
+        DomainStats.count_obj(self, -1)
+        SearchSuffix.remove_obj_list([self])
+
+    @classmethod
+    def validate_bulk_delete(cls, obj_list):
+        """
+        批量删除前，检查是否为主用户
+        """
+        return {obj.uuid: DatabaseError('this is the main user', cls.__name__) for obj in obj_list if obj.is_main}
+
+    @classmethod
+    def pre_bulk_delete(cls, obj_list):
+        """
+        批量删除前，检查是否包含主用户，批量删除对象的关联 group 和 role
+        """
+        failed_dict = cls.validate_bulk_delete(obj_list)
+        if failed_dict:
+            raise next(iter(failed_dict.values()))
+        user_uuid_list = [obj.uuid for obj in obj_list]
+        DAO('identity.models.M2MUserGroup').delete_obj_qs(user__in=user_uuid_list)
+        DAO('identity.models.M2MUserRole').delete_obj_qs(user__in=user_uuid_list)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效用户的策略缓存和 token 的用户快照缓存，吊销签名 token，合并减少域的用户计数，删除查询后缀索引
+        """
+        user_uuid_list = [obj.uuid for obj in obj_list]
+        for user_uuid in user_uuid_list:
+            PolicyCache.invalidate_user(user_uuid)
+            TokenRevocation.revoke_user(user_uuid)
+        PrincipalCache.invalidate_users(*user_uuid_list)
+        DomainStats.count_obj_list(obj_list, -1)
+        SearchSuffix.remove_obj_list(obj_list)
+
+    def serialize(self, fields=None, behavior=None):
         """
         对象序列化
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :param behavior: dict, 已查询的用户行为序列化字典，为空时单独查询
         :return: dict
         """
-        d = super().serialize()
-        del d['password']
+        d = super().serialize(fields)
+        d.pop('password', None)
 
-        if not d['deleted_time'] is None:
+        if d.get('deleted_time') is not None:
             d['deleted_time'] = tools.datetime_to_humanized(d['deleted_time'])
 
-        # 附加信息
-        d['behavior'] = DAO('identity.models.UserBehavior').get_obj(user=self.uuid).serialize()
+        # 附加信息，仅在需要时查询
+        if fields is None or 'behavior' in fields:
+            if behavior is None:
+                behavior = DAO('identity.models.UserBehavior').get_obj(user=self.uuid).serialize()
+            d['behavior'] = behavior
         return d
 
+    @classmethod
+    def serialize_list(cls, obj_list, fields=None):
+        """
+        对象列表序列化，分批一次性查询所有用户的行为信息
+        :param obj_list: list|query set, 对象列表
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: list, [dict, ...]
+        """
+        if fields is not None and 'behavior' not in fields:
+            return super().serialize_list(obj_list, fields)
+
+        obj_list = list(obj_list)
+        behavior_dict = {}
+        for i in range(0, len(obj_list), 1000):
+            user_uuid_list = [obj.uuid for obj in obj_list[i:i + 1000]]
+            for behavior_obj in UserBehavior.objects.filter(user__in=user_uuid_list):
+                behavior_dict[behavior_obj.user] = behavior_obj.serialize()
+
+        dict_list = []
+        for obj in obj_list:
+            if obj.uuid not in behavior_dict:
+                raise ObjectNotExist(UserBehavior.__name__)
+            dict_list.append(obj.serialize(fields, behavior=behavior_dict[obj.uuid]))
+        return dict_list
+
+    @classmethod
+    def get_extra_fields(cls):
+        return ['behavior']
+
     def check_password(self, password):
         """
         检查密码是否正确
@@ -157,6 +272,10 @@ class User(ResourceModel):
         return ['username', 'name', 'email',
                 'phone', 'domain', 'title'] + super().get_default_query_keys()
 
+    @classmethod
+    def get_search_index_keys(cls):
+        return ['username', 'name', 'email', 'phone']
+
 
 class UserBehavior(BaseModel):
 
@@ -170,9 +289,10 @@ class UserBehavior(BaseModel):
     last_ip = models.CharField(max_length=16, null=True, verbose_name='上次登陆IP')
     last_location = models.CharField(max_length=32, null=True, verbose_name='上次登陆地址')
 
-    def serialize(self):
+    def serialize(self, fields=None):
         """
         对象序列化
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
         :return: dict
         """
         d = self.__dict__.copy()
@@ -181,14 +301,127 @@ class UserBehavior(BaseModel):
 
         if not d['last_time'] is None:
             d['last_time'] = tools.datetime_to_humanized(d['last_time'])
+
+        if fields is not None:
+            d = {k: v for k, v in d.items() if k in fields}
         return d
 
 
+class UserArchive(ResourceModel):
+
+    class Meta:
+        verbose_name = '归档用户'
+        db_table = 'user_archive'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='user_archive_created_uuid_idx')
+        ]
+        ordering = ('-archived_time',)
+
+    # 原用户的时间字段，归档时原样复制
+    created_time = models.DateTimeField(verbose_name='创建时间')
+    updated_time = models.DateTimeField(null=True, verbose_name='更新时间')
+
+    # 原用户字段，不归档密码
+    email = models.CharField(max_length=64, verbose_name='邮箱')
+    phone = models.CharField(max_length=16, verbose_name='手机')
+    username = models.CharField(max_length=64, verbose_name='登陆名')
+    domain = models.CharField(max_length=32, db_index=True, verbose_name='归属域UUID')
+    name = models.CharField(max_length=64, verbose_name='用户姓名')
+    is_main = models.BooleanField(default=False, verbose_name='是否主用户')
+    title = models.CharField(max_length=2048, null=True, verbose_name='头衔')
+    enable = models.BooleanField(default=True, verbose_name='是否可用')
+    qq = models.CharField(max_length=16, null=True, verbose_name='QQ')
+    comment = models.CharField(max_length=256, null=True, verbose_name='备注')
+
+    # 逻辑生成字段
+    removed_time = models.DateTimeField(verbose_name='用户删除时间')
+    behavior = models.TextField(null=True, verbose_name='用户行为')
+    archived_time = models.DateTimeField(verbose_name='归档时间')
+
+    # 从用户对象复制的字段
+    archived_fields = ('uuid', 'created_by', 'created_time', 'updated_by', 'updated_time', 'email', 'phone',
+                       'username', 'domain', 'name', 'is_main', 'title', 'enable', 'qq', 'comment')
+
+    def serialize(self, fields=None):
+        """
+        对象序列化，json 解析用户行为
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: dict
+        """
+        d = super().serialize(fields)
+        for i in ('removed_time', 'archived_time'):
+            if d.get(i) is not None:
+                d[i] = tools.datetime_to_humanized(d[i])
+        if 'behavior' in d:
+            d['behavior'] = tools.json_loader(d['behavior']) or None
+        return d
+
+    @classmethod
+    def from_user(cls, user_obj, behavior, archived_time):
+        """
+        由已删除的用户对象生成归档对象
+        :param user_obj: user object, 用户对象
+        :param behavior: dict, 用户行为序列化字典
+        :param archived_time: datetime, 归档时间
+        :return: user archive object
+        """
+        field_opts = {f: getattr(user_obj, f) for f in cls.archived_fields}
+        return cls(removed_time=user_obj.deleted_time, behavior=tools.json_dumper(behavior),
+                   archived_time=archived_time, **field_opts)
+
+    @classmethod
+    def archive(cls, days, batch_size=1000):
+        """
+        将删除超过指定天数的用户分批移动到归档表，一并移除其用户行为和 token，每批在一个事务中完成
+        :param days: int, 用户删除的天数
+        :param batch_size: int, 每批移动的用户数量
+        :return: int, 归档的用户数量
+        """
+        valid_datetime = tools.timestamp_to_datetime(0)
+        deleted_before = tools.get_datetime_with_tz(days=-days)
+        archived_count = 0
+
+        while True:
+            try:
+                with transaction.atomic():
+                    user_list = list(User.objects.select_for_update().filter(
+                        deleted_time__gt=valid_datetime, deleted_time__lt=deleted_before
+                    ).order_by('deleted_time')[:batch_size])
+                    if not user_list:
+                        break
+
+                    user_uuid_list = [obj.uuid for obj in user_list]
+                    behavior_qs = UserBehavior.objects.filter(user__in=user_uuid_list)
+                    behavior_dict = {obj.user: obj.serialize() for obj in behavior_qs}
+
+                    archived_time = tools.get_datetime_with_tz()
+                    cls.objects.bulk_create([
+                        cls.from_user(obj, behavior_dict.get(obj.uuid), archived_time) for obj in user_list
+                    ])
+                    behavior_qs.delete()
+                    tools.import_string('credence.models.Token').objects.filter(carrier__in=user_uuid_list).delete()
+                    User.objects.filter(pk__in=user_uuid_list).delete()
+            except Error as e:
+                msg = e.args[1]
+                raise DatabaseError(msg, cls.__name__) from e
+
+            archived_count += len(user_list)
+        return archived_count
+
+    @classmethod
+    def get_default_query_keys(cls):
+        return ['username', 'name', 'email',
+                'phone', 'domain'] + super().get_default_query_keys()
+
+
 class Group(ResourceModel):
 
     class Meta:
         verbose_name = '用户组'
         db_table = 'group'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='group_created_uuid_idx')
+        ]
         unique_together = ('domain', 'name')
         ordering = ('-domain',)
 
@@ -207,11 +440,18 @@ class Group(ResourceModel):
         super().pre_create()
         DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
+    def post_create(self):
+        """
+        创建后，增加域的用户组计数
+        """
+        DomainStats.count_obj(self, 1)
+
     def pre_update(self):
         """
-        更新前，检查 domain 是否存在
+        更新前，检查 domain 是否存在，域变化时转移用户组计数
         """
         DAO('partition.models.Domain').get_obj(uuid=self.domain)
+        DomainStats.count_update(self)
 
     def pre_delete(self):
         """
@@ -221,6 +461,48 @@ class Group(ResourceModel):
             raise DatabaseError('group are referenced by users', self.__class__.__name__)
         DAO('identity.models.M2MGroupRole').delete_obj_qs(group=self.uuid)
 
+    def post_update(self):
+        """
+        更新后，失效所有用户的策略缓存，组的启用状态影响策略
+        """
+        PolicyCache.invalidate_all()
+
+    def post_delete(self):
+        """
+        删除后，失效所有用户的策略缓存，减少域的用户组计数
+        """
+        PolicyCache.invalidate_all()
+        DomainStats.count_obj(self, -1)
+
+    @classmethod
+    def validate_bulk_delete(cls, obj_list):
+        """
+        批量删除前，一次性查询存在关联 user 的用户组
+        """
+        group_uuid_list = [obj.uuid for obj in obj_list]
+        referenced_set = set(DAO('identity.models.M2MUserGroup').get_obj_qs(group__in=group_uuid_list)
+                             .values_list('group', flat=True).distinct())
+        return {uuid: DatabaseError('group are referenced by users', cls.__name__) for uuid in referenced_set}
+
+    @classmethod
+    def pre_bulk_delete(cls, obj_list):
+        """
+        批量删除前，检查是否存在关联的 user，批量删除关联的 role
+        """
+        failed_dict = cls.validate_bulk_delete(obj_list)
+        if failed_dict:
+            raise next(iter(failed_dict.values()))
+        group_uuid_list = [obj.uuid for obj in obj_list]
+        DAO('identity.models.M2MGroupRole').delete_obj_qs(group__in=group_uuid_list)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效所有用户的策略缓存，合并减少域的用户组计数
+        """
+        PolicyCache.invalidate_all()
+        DomainStats.count_obj_list(obj_list, -1)
+
     @staticmethod
     def get_field_opts(create=True):
         """
@@ -249,7 +531,7 @@ class M2MUserGroup(BaseModel):
         unique_together = ('user', 'group')
 
     user = models.CharField(max_length=32, verbose_name='用户UUID')
-    group = models.CharField(max_length=32, verbose_name='组UUID')
+    group = models.CharField(max_length=32, db_index=True, verbose_name='组UUID')
 
     def pre_create(self):
         """
@@ -260,6 +542,53 @@ class M2MUserGroup(BaseModel):
         if user_obj.domain != group_obj.domain:
             raise DatabaseError('user and group is not in a common domain', self.__class__.__name__)
 
+    def post_create(self):
+        """
+        创建后，失效用户的策略缓存
+        """
+        PolicyCache.invalidate_user(self.user)
+
+    def get_changed_fields(self):
+        """
+        对比更新前记录的原值，获取发生变化的字段
+        :return: set
+        """
+        origin_dict = getattr(self, 'snapshot_origin_dict', {})
+        return {k for k, v in origin_dict.items() if getattr(self, k) != v}
+
+    def post_delete(self):
+        """
+        删除后，失效用户的策略缓存
+        """
+        PolicyCache.invalidate_user(self.user)
+
+    @classmethod
+    def pre_bulk_create(cls, obj_list):
+        """
+        批量创建前，一次性查询所有 user 和 group，检查是否同属一个 domain
+        """
+        user_dict = DAO(User).get_field_dict([obj.user for obj in obj_list], 'domain')
+        group_dict = DAO(Group).get_field_dict([obj.group for obj in obj_list], 'domain')
+        for obj in obj_list:
+            if user_dict[obj.user]['domain'] != group_dict[obj.group]['domain']:
+                raise DatabaseError('user and group is not in a common domain', cls.__name__)
+
+    @classmethod
+    def post_bulk_create(cls, obj_list):
+        """
+        批量创建后，失效相关用户的策略缓存
+        """
+        for user_uuid in set(obj.user for obj in obj_list):
+            PolicyCache.invalidate_user(user_uuid)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效相关用户的策略缓存
+        """
+        for user_uuid in set(obj.user for obj in obj_list):
+            PolicyCache.invalidate_user(user_uuid)
+
 
 class M2MUserRole(BaseModel):
 
@@ -269,7 +598,7 @@ class M2MUserRole(BaseModel):
         unique_together = ('user', 'role')
 
     user = models.CharField(max_length=32, verbose_name='用户UUID')
-    role = models.CharField(max_length=32, verbose_name='角色UUID')
+    role = models.CharField(max_length=32, db_index=True, verbose_name='角色UUID')
 
     def pre_create(self):
         """
@@ -281,6 +610,55 @@ class M2MUserRole(BaseModel):
             raise DatabaseError('user and role is not in a common domain, and role is not builtin',
                                 self.__class__.__name__)
 
+    def post_create(self):
+        """
+        创建后，失效用户的策略缓存
+        """
+        PolicyCache.invalidate_user(self.user)
+
+    def get_changed_fields(self):
+        """
+        对比更新前记录的原值，获取发生变化的字段
+        :return: set
+        """
+        origin_dict = getattr(self, 'snapshot_origin_dict', {})
+        return {k for k, v in origin_dict.items() if getattr(self, k) != v}
+
+    def post_delete(self):
+        """
+        删除后，失效用户的策略缓存
+        """
+        PolicyCache.invalidate_user(self.user)
+
+    @classmethod
+    def pre_bulk_create(cls, obj_list):
+        """
+        批量创建前，一次性查询所有 user 和 role，检查是否同属一个 domain，或者 role 是内置
+        """
+        user_dict = DAO(User).get_field_dict([obj.user for obj in obj_list], 'domain')
+        role_dict = DAO('assignment.models.Role').get_field_dict([obj.role for obj in obj_list], 'domain', 'builtin')
+        for obj in obj_list:
+            role = role_dict[obj.role]
+            if user_dict[obj.user]['domain'] != role['domain'] and not role['builtin']:
+                raise DatabaseError('user and role is not in a common domain, and role is not builtin',
+                                    cls.__name__)
+
+    @classmethod
+    def post_bulk_create(cls, obj_list):
+        """
+        批量创建后，失效相关用户的策略缓存
+        """
+        for user_uuid in set(obj.user for obj in obj_list):
+            PolicyCache.invalidate_user(user_uuid)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效相关用户的策略缓存
+        """
+        for user_uuid in set(obj.user for obj in obj_list):
+            PolicyCache.invalidate_user(user_uuid)
+
 
 class M2MGroupRole(BaseModel):
 
@@ -290,7 +668,7 @@ class M2MGroupRole(BaseModel):
         unique_together = ('group', 'role')
 
     group = models.CharField(max_length=32, verbose_name='用户组UUID')
-    role = models.CharField(max_length=32, verbose_name='角色UUID')
+    role = models.CharField(max_length=32, db_index=True, verbose_name='角色UUID')
 
     def pre_create(self):
         """
@@ -301,3 +679,43 @@ class M2MGroupRole(BaseModel):
         if group_obj.domain != role_obj.domain and not role_obj.builtin:
             raise DatabaseError('group and role is not in a common domain, and role is not builtin',
                                 self.__class__.__name__)
+
+    def post_create(self):
+        """
+        创建后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    def post_delete(self):
+        """
+        删除后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    @classmethod
+    def pre_bulk_create(cls, obj_list):
+        """
+        批量创建前，一次性查询所有 group 和 role，检查是否同属一个 domain，或者 role 是内置
+        """
+        group_dict = DAO(Group).get_field_dict([obj.group for obj in obj_list], 'domain')
+        role_dict = DAO('assignment.models.Role').get_field_dict([obj.role for obj in obj_list], 'domain', 'builtin')
+        for obj in obj_list:
+            role = role_dict[obj.role]
+            if group_dict[obj.group]['domain'] != role['domain'] and not role['builtin']:
+                raise DatabaseError('group and role is not in a common domain, and role is not builtin',
+                                    cls.__name__)
+
+    @classmethod
+    def post_bulk_create(cls, obj_list):
+        """
+        批量创建后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，失效所有用户的策略缓存
+        """
+        PolicyCache.invalidate_all()
+
@@ -0,0 +1,381 @@
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.db import transaction, connection
+from op_keystone.auth_cache import Principal, PolicyCache, TokenRevocation
+from op_keystone.exceptions import ObjectNotExist
+from partition.models import Domain
+from assignment.models import Role, Policy, Action, M2MRolePolicy
+from catalog.models import Service
+from credence.models import Token
+from job.models import Job
+from utils.dao import DAO
+from utils import tools
+from unittest import mock
+from .models import User, UserBehavior, Group, M2MUserGroup, M2MUserRole
+from .views import UsersView, UserToGroupView, UserArchivesView, Auth, AuthBatch
+
+
+class UserToGroupMixin:
+    """
+    用户关联组视图的测试数据和请求
+    """
+
+    def setUp(self):
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                            is_main=True, created_by='test')
+        self.user = User.objects.create(uuid=tools.generate_unique_uuid(), email='u@test.com', phone='1',
+                                        username='u', domain=self.domain.uuid, password='p', name='u',
+                                        is_main=True, created_by='test')
+        self.group_uuid_list = [
+            Group.objects.create(uuid=tools.generate_unique_uuid(), name='g%s' % i, domain=self.domain.uuid,
+                                 created_by='test').uuid
+            for i in range(2)
+        ]
+        self.principal = Principal(self.user.uuid, self.user.name, self.domain.uuid, True, 1)
+
+    def put(self, **params):
+        request = RequestFactory().put('/identity/users/%s/groups/' % self.user.uuid,
+                                       data=tools.json_dumper(params), content_type='application/json')
+        request.user = self.principal
+        response = UserToGroupView.as_view()(request, uuid=self.user.uuid)
+        return tools.json_loader(response.content)
+
+    def get_group_set(self):
+        return set(M2MUserGroup.objects.filter(user=self.user.uuid).values_list('group', flat=True))
+
+
+class UserToGroupViewTestCase(UserToGroupMixin, TestCase):
+    """
+    用户关联组的替换，同步模式和后台任务模式
+    """
+
+    def test_put(self):
+        res = self.put(uuid_list=self.group_uuid_list)
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(res['data']['total'], 2)
+        self.assertEqual(self.get_group_set(), set(self.group_uuid_list))
+
+    def test_put_async(self):
+        res = self.put(uuid_list=self.group_uuid_list, **{'async': 'true'})
+        self.assertEqual(res['code'], 202)
+        self.assertEqual(res['data']['status'], 'pending')
+        self.assertEqual(res['data']['name'], 'op_keystone.jobs.replace_relations')
+        self.assertEqual(self.get_group_set(), set())
+
+        job_obj = Job.claim('worker')
+        self.assertEqual(job_obj.uuid, res['data']['uuid'])
+        self.assertTrue(job_obj.run())
+        self.assertEqual(job_obj.status, 'succeed', job_obj.message)
+        self.assertEqual(self.get_group_set(), set(self.group_uuid_list))
+
+
+class UserToGroupPolicyCacheTestCase(UserToGroupMixin, TransactionTestCase):
+    """
+    关联变更的策略缓存失效在事务提交后进行
+    """
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+
+    def test_put_commit(self):
+        versions = PolicyCache._get_versions(self.user.uuid)
+        with transaction.atomic():
+            self.put(uuid_list=self.group_uuid_list)
+            self.assertEqual(PolicyCache._get_versions(self.user.uuid), versions)
+        self.assertNotEqual(PolicyCache._get_versions(self.user.uuid), versions)
+
+    def test_put_rollback(self):
+        versions = PolicyCache._get_versions(self.user.uuid)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.put(uuid_list=self.group_uuid_list)
+                raise RuntimeError()
+        self.assertEqual(PolicyCache._get_versions(self.user.uuid), versions)
+
+
+class UserRevocationTestCase(TestCase):
+    """
+    用户快照字段变化时吊销签名 token
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.domain_uuid_list = []
+        for i in range(2):
+            domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='d%s' % i, company='c',
+                                           agent='a', is_main=not i, created_by='test')
+            User.objects.create(uuid=tools.generate_unique_uuid(), email='m%s@test.com' % i, phone='m%s' % i,
+                                username='m%s' % i, domain=domain.uuid, password='p', name='m%s' % i,
+                                is_main=True, created_by='test')
+            self.domain_uuid_list.append(domain.uuid)
+        self.user = User.objects.create(uuid=tools.generate_unique_uuid(), email='u@test.com', phone='1',
+                                        username='u', domain=self.domain_uuid_list[0], password='p', name='u',
+                                        created_by='test')
+        self.issued_timestamp = tools.datetime_to_timestamp() - 1
+
+    def update(self, **field_opts):
+        DAO(User).update_obj(self.user, **field_opts)
+        return TokenRevocation.is_revoked(self.user.uuid, self.domain_uuid_list[0], self.issued_timestamp)
+
+    def test_comment_changed(self):
+        self.assertFalse(self.update(comment='c'))
+
+    def test_enable_changed(self):
+        self.assertTrue(self.update(enable=False))
+
+    def test_domain_changed(self):
+        self.assertTrue(self.update(domain=self.domain_uuid_list[1]))
+
+
+class UserBulkDeleteTestCase(TestCase):
+    """
+    用户的批量软删除，钩子与删除语句在同一事务中
+    """
+
+    def setUp(self):
+        domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                       is_main=True, created_by='test')
+        self.user = User.objects.create(uuid=tools.generate_unique_uuid(), email='u@test.com', phone='1',
+                                        username='u', domain=domain.uuid, password='p', name='u',
+                                        created_by='test')
+        User.objects.filter(uuid=self.user.uuid).update(updated_time=tools.timestamp_to_datetime(0))
+
+    def test_bulk_delete(self):
+        DAO(User).bulk_delete_objs([self.user])
+        user_obj = User.objects.get(uuid=self.user.uuid)
+        self.assertEqual(user_obj.deleted_time, user_obj.updated_time)
+        self.assertNotEqual(user_obj.deleted_time, tools.timestamp_to_datetime(0))
+
+    def test_bulk_delete_hook_failed(self):
+        with mock.patch.object(User, 'post_bulk_delete', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                DAO(User).bulk_delete_objs([self.user])
+        self.assertTrue(DAO(User).get_obj_qs(uuid=self.user.uuid).exists())
+
+
+class UserArchivesViewTestCase(TestCase):
+    """
+    归档用户视图只读，其他方法返回 405
+    """
+
+    def setUp(self):
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                            is_main=True, created_by='test')
+        self.principal = Principal(tools.generate_unique_uuid(), 'admin', self.domain.uuid, True, 1)
+
+    def request(self, method):
+        request = getattr(RequestFactory(), method)('/identity/user-archives/')
+        request.user = self.principal
+        response = UserArchivesView.as_view()(request)
+        return tools.json_loader(response.content)
+
+    def test_get(self):
+        res = self.request('get')
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(res['data']['total'], 0)
+
+    def test_method_not_allowed(self):
+        for method in ('post', 'put', 'delete'):
+            res = self.request(method)
+            self.assertEqual(res['code'], 405, method)
+            self.assertIn('not allowed', res['message'])
+
+
+class UsersMixin:
+    """
+    用户列表的测试数据和请求
+    """
+
+    def setUp(self):
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                            is_main=True, created_by='test')
+        self.user_list = []
+        for i in range(3):
+            user = User.objects.create(uuid=tools.generate_unique_uuid(), email='u%s@test.com' % i, phone=str(i),
+                                       username='u%s' % i, domain=self.domain.uuid, password='p', name='u%s' % i,
+                                       is_main=not i, created_by='test')
+            UserBehavior.objects.create(user=user.uuid, last_ip='10.0.0.%s' % i)
+            self.user_list.append(user)
+        self.principal = Principal(self.user_list[0].uuid, 'u0', self.domain.uuid, True, 1)
+
+    def get(self, uuid=None, **params):
+        path = '/identity/users/%s' % ('%s/' % uuid if uuid else '')
+        request = RequestFactory().get(path, params)
+        request.user = self.principal
+        response = UsersView.as_view()(request, uuid=uuid)
+        return tools.json_loader(response.content)
+
+
+class UsersFieldsTestCase(UsersMixin, TestCase):
+    """
+    查询用户时的字段投影，只返回并读取指定字段，附加信息只在指定时查询
+    """
+
+    def test_list_fields(self):
+        # 不分页时只有用户列表一条查询，不查询用户行为
+        with self.assertNumQueries(1):
+            res = self.get(fields='uuid,name')
+        self.assertEqual(res['code'], 200, res['message'])
+        self.assertEqual(res['data']['total'], 3)
+        self.assertEqual([set(d) for d in res['data']['data']], [{'uuid', 'name'}] * 3)
+
+    def test_extra_field(self):
+        res = self.get(fields='name,behavior')
+        behavior_dict = {d['name']: d['behavior']['last_ip'] for d in res['data']['data']}
+        self.assertEqual(behavior_dict, {'u0': '10.0.0.0', 'u1': '10.0.0.1', 'u2': '10.0.0.2'})
+
+    def test_detail_fields(self):
+        res = self.get(self.user_list[1].uuid, fields='email')
+        self.assertEqual(res['data'], {'email': 'u1@test.com'})
+
+    def test_deferred_columns(self):
+        obj = DAO(User).only_fields(User.objects.filter(pk=self.user_list[0].pk), ['name']).get()
+        self.assertEqual(obj.get_deferred_fields() & {'uuid', 'created_time', 'name'}, set())
+        self.assertIn('email', obj.get_deferred_fields())
+
+    def test_invalid_fields(self):
+        for fields in ('unknown', 'name,unknown', ',', 'behavior__user'):
+            res = self.get(fields=fields)
+            self.assertEqual(res['code'], 400, fields)
+            self.assertIn('fields', res['message'])
+
+
+class UserSerializeListTestCase(UsersMixin, TestCase):
+    """
+    用户列表序列化时批量查询用户行为，结果与逐个序列化一致
+    """
+
+    def test_same_as_serialize(self):
+        user_list = list(User.objects.order_by('username'))
+        with self.assertNumQueries(1):
+            dict_list = User.serialize_list(user_list)
+        self.assertEqual(dict_list, [user.serialize() for user in user_list])
+
+    def test_list_queries(self):
+        # 用户列表和用户行为各一条查询，与用户数量无关
+        with self.assertNumQueries(2):
+            res = self.get()
+        self.assertEqual(res['data']['total'], 3)
+        self.assertTrue(all('behavior' in d for d in res['data']['data']))
+
+    def test_chunks(self):
+        # 用户行为按每 1000 个用户分批查询
+        user_list = User.objects.bulk_create([
+            User(uuid=tools.generate_unique_uuid(), email='b%s@test.com' % i, phone='b%s' % i, username='b%s' % i,
+                 domain=self.domain.uuid, password='p', name='b%s' % i, created_by='test')
+            for i in range(1001)
+        ])
+        UserBehavior.objects.bulk_create([UserBehavior(user=user.uuid) for user in user_list], batch_size=500)
+        with self.assertNumQueries(2):
+            dict_list = User.serialize_list(user_list)
+        self.assertEqual(len(dict_list), 1001)
+
+    def test_missing_behavior(self):
+        UserBehavior.objects.filter(user=self.user_list[1].uuid).delete()
+        with self.assertRaises(ObjectNotExist):
+            User.serialize_list(self.user_list)
+
+
+class AuthBatchTestCase(TestCase):
+    """
+    批量鉴权与逐个鉴权的结果一致，同一 token 的用户和策略只获取一次
+    """
+
+    def setUp(self):
+        main_domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c',
+                                            agent='a', is_main=True, created_by='test')
+        domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='sub', company='c', agent='a',
+                                       created_by='test')
+        self.service = Service.objects.create(uuid=tools.generate_unique_uuid(), name='s', function='f',
+                                              created_by='test')
+
+        # 全域用户，以及通过角色允许查询用户列表的单域用户
+        self.admin_token = self.create_token(self.create_user(main_domain, 'admin', is_main=True))
+        user = self.create_user(domain, 'u')
+        self.token = self.create_token(user)
+        self.expired_token = self.create_token(self.create_user(domain, 'expired'), minutes=-1)
+        action = Action.objects.create(uuid=tools.generate_unique_uuid(), name='list users',
+                                       service=self.service.uuid, url='^/users/$', method='get', created_by='test')
+        role = Role.objects.create(uuid=tools.generate_unique_uuid(), name='r', domain=domain.uuid, created_by='test')
+        policy = Policy.objects.create(uuid=tools.generate_unique_uuid(), name='p', domain=domain.uuid,
+                                       action=action.uuid, res='*', effect='allow', condition='domain:x',
+                                       created_by='test')
+        M2MRolePolicy.objects.create(role=role.uuid, policy=policy.uuid)
+        M2MUserRole.objects.create(user=user.uuid, role=role.uuid)
+
+        # 重建动作索引
+        cache.clear()
+
+    @staticmethod
+    def create_user(domain, username, is_main=False):
+        return User.objects.create(uuid=tools.generate_unique_uuid(), email='%s@test.com' % username,
+                                   phone=username, username=username, domain=domain.uuid, password='p',
+                                   name=username, is_main=is_main, created_by='test')
+
+    @staticmethod
+    def create_token(user, minutes=10):
+        token = tools.generate_unique_uuid()
+        Token.objects.create(carrier=user.uuid, token=token, type=0,
+                             expire_date=tools.get_datetime_with_tz(minutes=minutes))
+        return token
+
+    @staticmethod
+    def get_request_info(token=None, url='/users/', method='get'):
+        request_info = {'url': url, 'method': method, 'routing_params': {}}
+        if token:
+            request_info['token'] = token
+        return request_info
+
+    def post(self, view, service=True, **params):
+        request = RequestFactory().post('/identity/auth/', data=tools.json_dumper(params),
+                                        content_type='application/json')
+        request.service = self.service if service else None
+        response = view.as_view()(request)
+        return tools.json_loader(response.content)
+
+    def test_same_as_auth(self):
+        request_info_list = [
+            self.get_request_info(self.admin_token, method='delete'),
+            self.get_request_info(self.token),
+            self.get_request_info(self.token, method='delete'),
+            self.get_request_info(self.token, url='/groups/'),
+            self.get_request_info('invalid'),
+            self.get_request_info(self.expired_token),
+        ]
+        res = self.post(AuthBatch, request_info_list=request_info_list)
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(res['data'], [self.post(Auth, **request_info) for request_info in request_info_list])
+        self.assertEqual([d['code'] for d in res['data']], [200, 200, 200, 200, 403, 403])
+        self.assertEqual([d['data']['access'] for d in res['data'][:4]], [True, True, False, False])
+        self.assertEqual(res['data'][1]['data']['allow_condition_list'], ['domain:x'])
+
+    def test_common_token(self):
+        res = self.post(AuthBatch, token=self.token, request_info_list=[
+            self.get_request_info(), self.get_request_info(self.admin_token, method='delete')])
+        self.assertEqual([d['data']['access'] for d in res['data']], [True, True])
+
+    def test_invalid_items(self):
+        # 单个请求信息无效时只影响该项的结果
+        res = self.post(AuthBatch, request_info_list=[
+            self.get_request_info(), 'x', {'token': self.token}, self.get_request_info(self.token)])
+        self.assertEqual(res['code'], 200)
+        self.assertEqual([d['code'] for d in res['data']], [403, 400, 400, 200])
+
+    def test_invalid(self):
+        self.assertEqual(self.post(AuthBatch, request_info_list={})['code'], 400)
+        self.assertEqual(self.post(AuthBatch)['code'], 400)
+        self.assertEqual(self.post(AuthBatch, service=False, request_info_list=[])['code'], 403)
+
+    def count_queries(self, count):
+        cache.clear()
+        request_info_list = [self.get_request_info(self.token, url='/users/%s/' % i) for i in range(count)]
+        with CaptureQueriesContext(connection) as context:
+            res = self.post(AuthBatch, request_info_list=request_info_list)
+        self.assertEqual(len(res['data']), count)
+        return len(context.captured_queries)
+
+    def test_queries(self):
+        # 查询数与同一 token 的请求信息数量无关
+        self.assertEqual(self.count_queries(10), self.count_queries(1))
@@ -5,6 +5,7 @@ from .views import *
 urlpatterns = [
     re_path(r'^users/((?P<uuid>\w+)/)?$', UsersView.as_view()),
     re_path(r'^groups/((?P<uuid>\w+)/)?$', GroupsView.as_view()),
+    re_path(r'^user-archives/((?P<uuid>\w+)/)?$', UserArchivesView.as_view()),
     re_path(r'^users/(?P<uuid>\w+)/groups/', UserToGroupView.as_view()),
     re_path(r'^groups/(?P<uuid>\w+)/users/', GroupToUserView.as_view()),
     re_path(r'^users/(?P<uuid>\w+)/roles/', UserToRoleView.as_view()),
@@ -17,6 +18,7 @@ urlpatterns = [
     path(r'phone-captcha/', PhoneCaptcha.as_view()),
     path(r'email-captcha/', PhoneCaptcha.as_view()),
     path(r'auth/', Auth.as_view()),
+    path(r'auth-batch/', AuthBatch.as_view()),
     path(r'privilege-for-manage-actions/', PrivilegeForManageActions.as_view()),
     path(r'privilege-for-describe-actions/', PrivilegeForDescribeActions.as_view())
 ]
\ No newline at end of file
@@ -1,4 +1,5 @@
 from .user import *
+from .user_archive import *
 from .group import *
 from .operation import *
 from .security import *
@@ -7,6 +7,7 @@ from django.http.response import HttpResponse
 from io import BytesIO
 from django.core.cache import cache
 from op_keystone.middleware import AuthTools
+from op_keystone.auth_cache import ActionIndex, TokenRevocation
 
 
 class LoginView(BaseView):
@@ -18,6 +19,7 @@ class LoginView(BaseView):
     _user_model = DAO('identity.models.User')
     _behavior_model = DAO('identity.models.UserBehavior')
     _token_model = DAO('credence.models.Token')
+    _auth_tools = AuthTools()
 
     def post(self, request):
         try:
@@ -98,26 +100,39 @@ class LoginView(BaseView):
                 }
                 self._behavior_model.update_obj(behavior_obj, **behavior_dict)
 
-                # 生成 access_token 和 access_expire_date
-                access_mapping_str = 'access' + user_obj.username + tools.datetime_to_humanized(now)
-                access_token = tools.generate_mapping_uuid(user_obj.domain, access_mapping_str)
+                # 获取用户的权限级别
+                if domain_obj.is_main:
+                    if user_obj.is_main:
+                        privilege_level = 1
+                    else:
+                        privilege_level = 2
+                else:
+                    privilege_level = 3
+
+                # 生成 access_token 和 access_expire_date，签名模式下签发自校验 token，无需保存
                 access_expire_date = tools.get_datetime_with_tz(minutes=settings.ACCESS_TOKEN_VALID_TIME)
+                if settings.ACCESS_TOKEN_MODE == 'signed':
+                    user_obj.level = privilege_level
+                    access_token = self._auth_tools.generate_signed_token(user_obj, access_expire_date)
+                else:
+                    access_mapping_str = 'access' + user_obj.username + tools.datetime_to_humanized(now)
+                    access_token = tools.generate_mapping_uuid(user_obj.domain, access_mapping_str)
+
+                    # 获取用户 access_token 对象，不存在新建，存在则更新
+                    try:
+                        access_token_obj = self._token_model.get_obj(carrier=user_obj.uuid, type=0)
+                    except CustomException:
+                        self._token_model.create_obj(carrier=user_obj.uuid, token=access_token,
+                                                    expire_date=access_expire_date, type=0)
+                    else:
+                        self._token_model.update_obj(access_token_obj, token=access_token,
+                                                    expire_date=access_expire_date)
 
                 # 生成 refresh_token 和 refresh_expire_date
                 refresh_mapping_str = 'token' + user_obj.username + tools.datetime_to_humanized(now)
                 refresh_token = tools.generate_mapping_uuid(user_obj.domain, refresh_mapping_str)
                 refresh_expire_date = tools.get_datetime_with_tz(minutes=settings.REFRESH_TOKEN_VALID_TIME)
 
-                # 获取用户 access_token 对象，不存在新建，存在则更新
-                try:
-                    access_token_obj = self._token_model.get_obj(carrier=user_obj.uuid, type=0)
-                except CustomException:
-                    self._token_model.create_obj(carrier=user_obj.uuid, token=access_token,
-                                                expire_date=access_expire_date, type=0)
-                else:
-                    self._token_model.update_obj(access_token_obj, token=access_token,
-                                                expire_date=access_expire_date)
-
                 # 获取用户 fresh_token 对象，不存在新建，存在则更新
                 try:
                     refresh_token_obj = self._token_model.get_obj(carrier=user_obj.uuid, type=1)
@@ -128,16 +143,6 @@ class LoginView(BaseView):
                     self._token_model.update_obj(refresh_token_obj, token=refresh_token,
                                                 expire_date=refresh_expire_date)
 
-                # 获取用户的权限级别
-                domain = self._domain_model.get_obj(uuid=user_obj.domain)
-                if domain.is_main:
-                    if user_obj.is_main:
-                        privilege_level = 1
-                    else:
-                        privilege_level = 2
-                else:
-                    privilege_level = 3
-
                 # 生成浏览器 cookie 所需数据并返回
                 data = {
                     'access_token': access_token,
@@ -164,6 +169,7 @@ class RefreshView(BaseView):
     """
 
     token_model = DAO('credence.models.Token')
+    _auth_tools = AuthTools()
 
     def post(self, request):
         try:
@@ -184,16 +190,26 @@ class RefreshView(BaseView):
             refresh_expire_date = tools.get_datetime_with_tz(minutes=settings.REFRESH_TOKEN_VALID_TIME)
             self.token_model.update_obj(refresh_token_obj, expire_date=refresh_expire_date)
 
-            # 获取 access_token，并刷新过期时间
-            access_token_obj = self.token_model.get_obj(carrier=refresh_token_obj.carrier, type=0)
-            access_expire_date = tools.get_datetime_with_tz(minutes=settings.ACCESS_TOKEN_VALID_TIME)
-            self.token_model.update_obj(access_token_obj, expire_date=access_expire_date)
-
             # 返回刷新成功的新信息
+            access_expire_date = tools.get_datetime_with_tz(minutes=settings.ACCESS_TOKEN_VALID_TIME)
             data = {
                 'access_expire_date': tools.datetime_to_timestamp(access_expire_date),
                 'refresh_expire_date': tools.datetime_to_timestamp(refresh_expire_date)
             }
+
+            # 签名模式下，重新判定用户有效性和级别，签发新的 access_token
+            if settings.ACCESS_TOKEN_MODE == 'signed':
+                try:
+                    user_obj = self._auth_tools.get_user_of_token(refresh_token_obj)
+                except CustomException:
+                    raise CredenceInvalid(refresh=True)
+                data['access_token'] = self._auth_tools.generate_signed_token(user_obj, access_expire_date)
+
+            # 否则获取 access_token，并刷新过期时间
+            else:
+                access_token_obj = self.token_model.get_obj(carrier=refresh_token_obj.carrier, type=0)
+                self.token_model.update_obj(access_token_obj, expire_date=access_expire_date)
+
             return self.standard_response(data)
 
         except CustomException as e:
@@ -209,14 +225,18 @@ class LogoutView(BaseView):
 
     def post(self, request):
         try:
-            # 通过用户获取 token 对象
+            # 吊销用户已签发的签名 token
             user = request.user
-            access_token_ins = self._token_model.get_obj(carrier=user.uuid, type=0)
+            TokenRevocation.revoke_user(user.uuid)
+
+            # 通过用户获取 token 对象，签名模式下不存在 access_token 对象
             refresh__token_ins = self._token_model.get_obj(carrier=user.uuid, type=1)
+            expire_date = tools.get_datetime_with_tz()
+            if settings.ACCESS_TOKEN_MODE != 'signed':
+                access_token_ins = self._token_model.get_obj(carrier=user.uuid, type=0)
+                self._token_model.update_obj(access_token_ins, expire_date=expire_date)
 
             # 更新 token 对象
-            expire_date = tools.get_datetime_with_tz()
-            self._token_model.update_obj(access_token_ins, expire_date=expire_date)
             self._token_model.update_obj(refresh__token_ins, expire_date=expire_date)
 
             # 返回登出成功
@@ -320,7 +340,6 @@ class Auth(BaseView):
     """
 
     _auth_tools = AuthTools()
-    _token_model = DAO('credence.models.Token')
 
     def post(self, request):
         try:
@@ -332,9 +351,11 @@ class Auth(BaseView):
             request_params = self.get_params_dict(request)
             necessary_opts_dict = self.extract_opts(request_params, necessary_opts)
 
-            # 用户获取
-            token_obj = self._token_model.get_obj(token=necessary_opts_dict.pop('token'))
-            user_obj = self._auth_tools.get_user_of_token(token_obj)
+            # 用户快照获取
+            try:
+                user_obj = self._auth_tools.get_principal_of_access_token(necessary_opts_dict.pop('token'))
+            except CustomException:
+                raise CredenceInvalid()
             if user_obj.level == 1:
                 return self.standard_response({
                     'access': True,
@@ -357,6 +378,84 @@ class Auth(BaseView):
             return self.exception_to_response(e)
 
 
+class AuthBatch(BaseView):
+    """
+    用于提供批量接口给服务进行请求鉴权，同一 token 的用户和策略只获取一次
+    """
+
+    _auth_tools = AuthTools()
+
+    def post(self, request):
+        try:
+            if not getattr(request, 'service', None):
+                raise PermissionDenied()
+
+            # 参数提取，每个请求信息可以单独指定 token，否则使用公共 token
+            necessary_opts = ['request_info_list']
+            extra_opts = ['token']
+            request_params = self.get_params_dict(request)
+            necessary_opts_dict = self.extract_opts(request_params, necessary_opts)
+            extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
+            if not isinstance(necessary_opts_dict['request_info_list'], list):
+                raise RequestParamsError(opt='request_info_list', invalid=True)
+
+            # 逐个判定请求信息，用户快照和策略列表按 token 缓存
+            policies_dict = {}
+            result_list = []
+            for request_info in necessary_opts_dict['request_info_list']:
+                try:
+                    if not isinstance(request_info, dict):
+                        raise RequestParamsError(opt='request_info_list', invalid=True)
+                    info_opts_dict = self.extract_opts(request_info, ['url', 'method', 'routing_params'])
+                    rq_token = request_info.get('token') or extra_opts_dict.get('token')
+                    if not rq_token:
+                        raise CredenceInvalid(empty=True)
+
+                    # 获取 token 对应的用户快照和策略列表，失败时记录异常
+                    if rq_token not in policies_dict:
+                        try:
+                            user_obj = self._auth_tools.get_principal_of_access_token(rq_token)
+                        except CustomException:
+                            policies_dict[rq_token] = (None, CredenceInvalid())
+                        else:
+                            if user_obj.level == 1:
+                                policies_dict[rq_token] = (user_obj, None)
+                            else:
+                                policies_dict[rq_token] = (user_obj, self._auth_tools.get_policies_of_user(user_obj))
+                    user_obj, policy_obj_list = policies_dict[rq_token]
+                    if isinstance(policy_obj_list, CustomException):
+                        raise policy_obj_list
+
+                    # 全域用户直接通过，其他用户进行 policy 判定后获取通过标记和条件
+                    if user_obj.level == 1:
+                        access, allow_condition_list, deny_condition_list = True, [], []
+                    else:
+                        access, allow_condition_list, deny_condition_list = self._auth_tools.judge_policies(
+                            policy_obj_list, request.service.uuid, info_opts_dict)
+
+                    result_list.append({
+                        'code': 200,
+                        'data': {
+                            'access': access,
+                            'allow_condition_list': allow_condition_list,
+                            'deny_condition_list': deny_condition_list
+                        },
+                        'message': None
+                    })
+
+                except CustomException as e:
+                    result_list.append({
+                        'code': e.code,
+                        'data': None,
+                        'message': e.__message__()
+                    })
+
+            return self.standard_response(result_list)
+
+        except CustomException as e:
+            return self.exception_to_response(e)
+
+
 class PrivilegeForManageActions(BaseView):
     """
     用于提供给前端关于该用户关于动作的修改权限数据，附带详细条件，用于展示按钮
@@ -364,8 +463,6 @@ class PrivilegeForManageActions(BaseView):
 
     _auth_tools = AuthTools()
     _token_model = DAO('credence.models.Token')
-    _action_model = DAO('assignment.models.Action')
-    _service_model = DAO('catalog.models.Service')
 
     def get(self, request):
         try:
@@ -391,7 +488,9 @@ class PrivilegeForManageActions(BaseView):
 
             # 其他用户根据生成默认权限和具体动作对应的权限数据
             for policy_obj in policy_obj_qs:
-                action_obj = self._action_model.get_obj(uuid=policy_obj.action)
+                action_obj = ActionIndex.get_action(policy_obj.action)
+                if not action_obj:
+                    continue
                 action_pri = privilege_data['privileges'].get(action_obj.name)
                 if not action_pri:
                     action_pri = {
@@ -410,7 +509,7 @@ class PrivilegeForManageActions(BaseView):
                 if policy_obj.res != '*':
                     res_c = 'uuid:' + policy_obj.res.replace(',', '|')
                 if action_obj.url == '*' and action_obj.method == '*':
-                    service_obj = self._service_model.get_obj(uuid=action_obj.service)
+                    service_name = ActionIndex.get_service_name(action_obj.service)
                     service_pri['access'] = True
 
                     if policy_obj.effect == 'allow' and policy_obj.condition:
@@ -423,7 +522,7 @@ class PrivilegeForManageActions(BaseView):
                         if res_c:
                             service_pri['deny_condition_list'].append(res_c)
 
-                    privilege_data['default_privileges'][service_obj.name] = service_pri
+                    privilege_data['default_privileges'][service_name] = service_pri
 
                 # 具体管理权限的动作修改到具体动作上，排除查询的权限
                 elif action_obj.method != 'get':
@@ -453,8 +552,6 @@ class PrivilegeForDescribeActions(BaseView):
 
     _auth_tools = AuthTools()
     _token_model = DAO('credence.models.Token')
-    _action_model = DAO('assignment.models.Action')
-    _service_model = DAO('catalog.models.Service')
 
     def get(self, request):
         try:
@@ -478,14 +575,16 @@ class PrivilegeForDescribeActions(BaseView):
 
             # 其他用户根据生成默认权限和具体动作对应的权限数据
             for policy_obj in policy_obj_qs:
-                action_obj = self._action_model.get_obj(uuid=policy_obj.action)
+                action_obj = ActionIndex.get_action(policy_obj.action)
+                if not action_obj:
+                    continue
 
                 action_pri = privilege_data['privileges'].get(action_obj.name)
                 if not action_pri:
                     action_pri = {
                         'access': False,
                     }
-                service_obj = self._service_model.get_obj(uuid=action_obj.service)
+                service_name = ActionIndex.get_service_name(action_obj.service)
                 service_pri = {
                     'access': False,
                 }
@@ -493,7 +592,7 @@ class PrivilegeForDescribeActions(BaseView):
                 # 全部管理权限的查看修改到 default 权限上
                 if action_obj.url == '*' and (action_obj.method == '*' or action_obj.method == 'get'):
                     service_pri['access'] = True
-                    privilege_data['default_privileges'][service_obj.name] = service_pri
+                    privilege_data['default_privileges'][service_name] = service_pri
 
                 # 具体管理权限的查看修改到具体动作上，排除修改的权限
                 elif action_obj.method == 'get' or action_obj.method == '*':
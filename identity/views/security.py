@@ -2,6 +2,7 @@ from op_keystone.base_view import BaseView
 from op_keystone.exceptions import CustomException
 from utils.dao import DAO
 from utils import tools
+from op_keystone.auth_cache import TokenRevocation
 
 
 class PasswordView(BaseView):
@@ -19,8 +20,8 @@ class PasswordView(BaseView):
             request_params = self.get_params_dict(request)
             necessary_opts_dict = self.extract_opts(request_params, necessary_opts)
 
-            # 对象获取和原密码校验
-            user = request.user
+            # 对象获取和原密码校验，请求的 user 为用户快照，需获取 user 对象
+            user = self.user_model.get_obj(uuid=request.user.uuid)
             origin_password = necessary_opts_dict.pop('origin_password')
             user.check_password(origin_password)
 
@@ -32,8 +33,8 @@ class PasswordView(BaseView):
             }
             self.user_model.update_obj(user, **updated_opts)
 
-            # 获取和失效 token 对象
-            user = request.user
+            # 吊销签名 token，获取和失效 token 对象
+            TokenRevocation.revoke_user(user.uuid)
             token_obj_qs = self.token_model.get_obj_qs(carrier=user.uuid)
             expire_date = tools.get_datetime_with_tz()
             for obj in token_obj_qs:
@@ -0,0 +1,14 @@
+from op_keystone.base_view import ResourceView
+from ..models import UserArchive
+
+
+class UserArchivesView(ResourceView):
+    """
+    归档用户的查询，只读
+    """
+
+    http_method_names = ['get']
+
+    def __init__(self):
+        model = UserArchive
+        super().__init__(model)
@@ -0,0 +1,110 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.utils import Error
+from job.models import Job
+from identity.models import UserArchive
+import os
+import socket
+import threading
+import time
+
+
+class Command(BaseCommand):
+    """
+    后台任务 worker，轮询数据库领取并执行等待中的任务，可启动多个进程并行执行
+    """
+    help = 'Poll the job table and run pending jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.JOB_WORKER_POLL_INTERVAL,
+                            help='seconds to sleep when there is no pending job')
+        parser.add_argument('--once', action='store_true', help='run pending jobs and exit')
+        parser.add_argument('--heartbeat-interval', type=float, default=settings.JOB_HEARTBEAT_INTERVAL,
+                            help='seconds between heartbeats of the running job, 0 to disable')
+        parser.add_argument('--requeue-after', type=int, default=settings.JOB_STALE_TIMEOUT,
+                            help='requeue running jobs without heartbeat for these seconds, 0 to disable')
+        parser.add_argument('--archive-interval', type=int, default=settings.USER_ARCHIVE_INTERVAL,
+                            help='seconds between archiving soft deleted users, 0 to disable')
+
+    def handle(self, *args, **options):
+        worker = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.stdout.write('job worker %s started' % worker)
+        self.archived_at = 0
+
+        while True:
+            close_old_connections()
+
+            # 数据库异常时记录错误，关闭失效的连接并等待下一轮轮询，避免 worker 退出
+            try:
+                claimed = self.run_once(worker, options)
+            except Error as e:
+                self.stderr.write('job worker %s database error: %s' % (worker, e))
+                close_old_connections()
+                claimed = False
+
+            if claimed:
+                continue
+            if options['once']:
+                return
+            time.sleep(options['interval'])
+
+    def run_once(self, worker, options):
+        """
+        执行一轮轮询：定时归档已删除的用户，重新排队心跳超时的任务，领取并执行一个等待中的任务
+        :param worker: str, worker 标识
+        :param options: dict, 命令参数
+        :return: bool, 是否领取到任务
+        """
+        # 定时归档已删除的用户
+        if options['archive_interval'] and time.time() - self.archived_at >= options['archive_interval']:
+            self.archived_at = time.time()
+            archived_count = UserArchive.archive(settings.USER_ARCHIVE_DAYS, settings.USER_ARCHIVE_BATCH_SIZE)
+            if archived_count:
+                self.stdout.write('archived %s deleted users' % archived_count)
+
+        if options['requeue_after']:
+            requeued_count = Job.requeue_stale(options['requeue_after'])
+            if requeued_count:
+                self.stdout.write('requeued %s stale jobs' % requeued_count)
+
+        job_obj = Job.claim(worker)
+        if not job_obj:
+            return False
+
+        self.stdout.write('running job %s %s' % (job_obj.uuid, job_obj.name))
+        if self.run_job(job_obj, options['heartbeat_interval']):
+            self.stdout.write('job %s %s' % (job_obj.uuid, job_obj.status))
+        else:
+            self.stderr.write('job %s lost to another worker, result discarded' % job_obj.uuid)
+        return True
+
+    def run_job(self, job_obj, heartbeat_interval):
+        """
+        执行任务，执行期间在后台线程中定时更新任务心跳，避免长时间执行的任务被重新排队
+        :param job_obj: job object, 任务对象
+        :param heartbeat_interval: float, 心跳间隔秒数，为 0 时不更新心跳
+        :return: bool, 执行结果是否已记录
+        """
+        if not heartbeat_interval:
+            return job_obj.run()
+
+        stop_event = threading.Event()
+
+        def beat():
+            try:
+                while not stop_event.wait(heartbeat_interval):
+                    try:
+                        job_obj.heartbeat()
+                    except Error as e:
+                        self.stderr.write('job %s heartbeat failed: %s' % (job_obj.uuid, e))
+            finally:
+                connection.close()
+
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            return job_obj.run()
+        finally:
+            stop_event.set()
+            heartbeat_thread.join()
@@ -0,0 +1,218 @@
+from op_keystone.base_model import ResourceModel
+from op_keystone.auth_cache import Principal
+from op_keystone.exceptions import CustomException
+from django.db import models, transaction, connection
+from utils.dao import DAO
+from utils import tools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobRequest:
+    """
+    后台任务执行时使用的请求对象，还原提交任务时请求的用户或服务，以及策略条件
+    """
+
+    def __init__(self, operator, condition_tuple=None):
+        """
+        初始化请求对象
+        :param operator: dict, 提交任务的用户快照 {'user': {...}} 或服务 {'service': uuid}
+        :param condition_tuple: list, 提交任务时请求的允许和拒绝条件
+        """
+        if 'user' in operator:
+            self.user = Principal(**operator['user'])
+        else:
+            self.service = DAO('catalog.models.Service').get_obj(uuid=operator['service'])
+
+        if condition_tuple:
+            self.condition_tuple = tuple(condition_tuple)
+
+
+class Job(ResourceModel):
+
+    class Meta:
+        verbose_name = '后台任务'
+        db_table = 'job'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='job_created_uuid_idx')
+        ]
+        ordering = ('-created_time',)
+
+    # 必要字段
+    name = models.CharField(max_length=128, verbose_name='任务处理函数路径')
+    operator = models.TextField(verbose_name='提交任务的用户快照或服务')
+
+    # 附加字段
+    domain = models.CharField(max_length=32, null=True, verbose_name='提交用户的归属域UUID')
+    params = models.TextField(null=True, verbose_name='任务参数')
+    condition = models.TextField(null=True, verbose_name='提交时请求的策略条件')
+
+    # 逻辑生成字段
+    status = models.CharField(max_length=16, default='pending', verbose_name='状态，pending、running、succeed、failed')
+    progress = models.IntegerField(default=0, verbose_name='进度百分比')
+    result = models.TextField(null=True, verbose_name='任务结果')
+    message = models.TextField(null=True, verbose_name='错误信息')
+    worker = models.CharField(max_length=128, null=True, verbose_name='执行的 worker')
+    started_time = models.DateTimeField(null=True, verbose_name='开始时间')
+    finished_time = models.DateTimeField(null=True, verbose_name='结束时间')
+
+    def serialize(self, fields=None):
+        """
+        对象序列化，json 解析 params、result，不返回提交者快照和策略条件
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: dict
+        """
+        d = super().serialize(fields)
+        d.pop('operator', None)
+        d.pop('condition', None)
+
+        for i in ('params', 'result'):
+            if i in d:
+                d[i] = tools.json_loader(d[i]) or None
+        for i in ('started_time', 'finished_time'):
+            if d.get(i) is not None:
+                d[i] = tools.datetime_to_humanized(d[i])
+        return d
+
+    @classmethod
+    def submit(cls, name, params, request):
+        """
+        提交后台任务，记录请求的用户快照或服务，以及策略条件，用于执行时还原权限
+        :param name: str, 任务处理函数路径，函数接收任务对象和请求对象
+        :param params: dict, 任务参数
+        :param request: request object, 请求
+        :return: job object
+        """
+        if hasattr(request, 'user'):
+            user = request.user
+            operator = {'user': {
+                'uuid': user.uuid, 'name': user.name, 'domain': user.domain,
+                'is_main': user.is_main, 'level': user.level
+            }}
+            created_by = user.uuid
+            domain = user.domain
+        else:
+            operator = {'service': request.service.uuid}
+            created_by = request.service.uuid
+            domain = None
+
+        return DAO(cls).create_obj(
+            name=name,
+            operator=tools.json_dumper(operator),
+            domain=domain,
+            params=tools.json_dumper(params),
+            condition=tools.json_dumper(getattr(request, 'condition_tuple', None)),
+            created_by=created_by
+        )
+
+    @staticmethod
+    def supports_skip_locked():
+        """
+        判断数据库是否支持 SELECT ... FOR UPDATE SKIP LOCKED，mysql 需要 8.0.1 及以上，mariadb 不使用
+        :return: bool
+        """
+        if connection.vendor == 'mysql' and connection.mysql_is_mariadb:
+            return False
+        return connection.features.has_select_for_update_skip_locked
+
+    @classmethod
+    def claim(cls, worker):
+        """
+        领取一个等待中的任务并标记为执行中，数据库支持时跳过被其他 worker 锁定的任务，
+        否则使用普通行锁，多个 worker 依次等待领取
+        :param worker: str, worker 标识
+        :return: job object，没有等待中的任务时为 None
+        """
+        with transaction.atomic():
+            job_obj = cls.objects.select_for_update(skip_locked=cls.supports_skip_locked()) \
+                .filter(status='pending').order_by('created_time').first()
+            if not job_obj:
+                return None
+
+            job_obj.status = 'running'
+            job_obj.worker = worker
+            job_obj.started_time = tools.get_datetime_with_tz()
+            job_obj.save(update_fields=['status', 'worker', 'started_time', 'updated_time'])
+        return job_obj
+
+    @classmethod
+    def requeue_stale(cls, seconds):
+        """
+        将心跳超时的执行中任务重新标记为等待中，用于 worker 异常退出后恢复任务，
+        执行中的任务通过更新时间记录心跳，长时间执行但心跳正常的任务不受影响
+        :param seconds: int, 心跳超时秒数
+        :return: int, 重新排队的任务数量
+        """
+        stale_time = tools.get_datetime_with_tz(seconds=-seconds)
+        return cls.objects.filter(status='running', updated_time__lt=stale_time) \
+            .update(status='pending', worker=None, started_time=None)
+
+    def get_params(self):
+        """
+        获取任务参数
+        :return: dict
+        """
+        return tools.json_loader(self.params)
+
+    def get_request(self):
+        """
+        还原提交任务时的请求对象
+        :return: JobRequest object
+        """
+        return JobRequest(tools.json_loader(self.operator), tools.json_loader(self.condition))
+
+    def set_progress(self, done, total):
+        """
+        更新任务进度，可作为处理函数的进度回调
+        :param done: int, 已完成数量
+        :param total: int, 总数量
+        """
+        self.progress = int(done * 100 / total) if total else 100
+        Job.objects.filter(pk=self.pk).update(progress=self.progress, updated_time=tools.get_datetime_with_tz())
+
+    def heartbeat(self):
+        """
+        更新执行中任务的心跳时间，由 worker 在任务执行期间定时调用
+        :return: bool, 任务是否仍由当前 worker 执行
+        """
+        updated_count = Job.objects.filter(pk=self.pk, status='running', worker=self.worker) \
+            .update(updated_time=tools.get_datetime_with_tz())
+        return bool(updated_count)
+
+    def run(self):
+        """
+        执行任务处理函数，记录执行结果或错误信息，
+        任务已被重新排队或由其他 worker 领取时不覆盖任务状态
+        :return: bool, 执行结果是否已记录
+        """
+        try:
+            handler = tools.import_string(self.name)
+            if not handler:
+                raise ValueError('job handler %s does not exist' % self.name)
+            result = handler(self, self.get_request())
+        except CustomException as e:
+            self.status = 'failed'
+            self.message = e.__message__()
+        except Exception as e:
+            logger.exception('job %s failed', self.uuid)
+            self.status = 'failed'
+            self.message = '%s: %s' % (e.__class__.__name__, e)
+        else:
+            self.status = 'succeed'
+            self.progress = 100
+            self.result = tools.json_dumper(result)
+
+        # 仅在任务仍由当前 worker 执行时记录结果
+        self.finished_time = tools.get_datetime_with_tz()
+        updated_count = Job.objects.filter(pk=self.pk, status='running', worker=self.worker).update(
+            status=self.status,
+            progress=self.progress,
+            result=self.result,
+            message=self.message,
+            finished_time=self.finished_time,
+            updated_time=self.finished_time
+        )
+        if not updated_count:
+            logger.warning('job %s is no longer owned by worker %s, result discarded', self.uuid, self.worker)
+        return bool(updated_count)
@@ -0,0 +1,94 @@
+from django.test import TestCase
+from django.core.management import call_command
+from django.db.utils import OperationalError
+from unittest import mock
+from io import StringIO
+from utils import tools
+from .models import Job
+
+
+def handler(job_obj, request):
+    return {'user': request.user.uuid}
+
+
+class JobHeartbeatTestCase(TestCase):
+    """
+    执行中任务的心跳和超时重新排队
+    """
+
+    def setUp(self):
+        Job.objects.create(uuid=tools.generate_unique_uuid(), name='job.tests.handler',
+                           operator=tools.json_dumper({'user': {
+                               'uuid': 'user', 'name': 'user', 'domain': 'domain', 'is_main': True, 'level': 1
+                           }}),
+                           created_by='test')
+        self.job_obj = Job.claim('worker')
+
+        # 任务在超时时间之前开始执行，最近一次心跳也在超时时间之前
+        stale_time = tools.get_datetime_with_tz(seconds=-120)
+        Job.objects.filter(pk=self.job_obj.pk).update(started_time=stale_time, updated_time=stale_time)
+
+    def test_claim(self):
+        self.assertEqual(self.job_obj.status, 'running')
+        self.assertEqual(self.job_obj.worker, 'worker')
+        self.assertIsNone(Job.claim('worker'))
+
+    def test_requeue_without_heartbeat(self):
+        self.assertEqual(Job.requeue_stale(60), 1)
+        self.assertEqual(Job.objects.get(pk=self.job_obj.pk).status, 'pending')
+
+    def test_heartbeat(self):
+        self.assertTrue(self.job_obj.heartbeat())
+        self.assertEqual(Job.requeue_stale(60), 0)
+        self.assertEqual(Job.objects.get(pk=self.job_obj.pk).status, 'running')
+
+    def test_progress_heartbeat(self):
+        self.job_obj.set_progress(1, 2)
+        self.assertEqual(Job.requeue_stale(60), 0)
+        self.assertEqual(Job.objects.get(pk=self.job_obj.pk).progress, 50)
+
+    def test_heartbeat_after_requeue(self):
+        Job.requeue_stale(60)
+        self.assertFalse(self.job_obj.heartbeat())
+
+    def test_run(self):
+        self.assertTrue(self.job_obj.run())
+        job_obj = Job.objects.get(pk=self.job_obj.pk)
+        self.assertEqual(job_obj.status, 'succeed')
+        self.assertEqual(job_obj.result, tools.json_dumper({'user': 'user'}))
+
+    def test_run_after_requeue(self):
+        # 心跳超时后任务被其他 worker 领取，原 worker 执行完成时不覆盖任务状态
+        Job.requeue_stale(60)
+        Job.claim('other')
+        self.assertFalse(self.job_obj.run())
+        job_obj = Job.objects.get(pk=self.job_obj.pk)
+        self.assertEqual(job_obj.status, 'running')
+        self.assertEqual(job_obj.worker, 'other')
+        self.assertIsNone(job_obj.finished_time)
+
+
+class JobWorkerTestCase(TestCase):
+    """
+    worker 轮询时的数据库异常处理
+    """
+
+    def test_database_error(self):
+        stdout, stderr = StringIO(), StringIO()
+        with mock.patch.object(Job, 'claim', side_effect=OperationalError('server has gone away')), \
+                mock.patch('job.management.commands.run_job_worker.close_old_connections') as close_mock:
+            call_command('run_job_worker', once=True, archive_interval=0, requeue_after=0,
+                         stdout=stdout, stderr=stderr)
+        self.assertIn('server has gone away', stderr.getvalue())
+        self.assertEqual(close_mock.call_count, 2)
+
+    def test_run_pending_jobs(self):
+        Job.objects.create(uuid=tools.generate_unique_uuid(), name='job.tests.handler',
+                           operator=tools.json_dumper({'service': 'service'}), created_by='test')
+        stdout, stderr = StringIO(), StringIO()
+        call_command('run_job_worker', once=True, archive_interval=0, heartbeat_interval=0,
+                     stdout=stdout, stderr=stderr)
+
+        # 找不到提交任务的服务时任务失败，worker 继续执行直到没有等待中的任务
+        self.assertEqual(Job.objects.get().status, 'failed')
+        self.assertIn('failed', stdout.getvalue())
@@ -0,0 +1,7 @@
+from django.urls import re_path
+from .views import *
+
+
+urlpatterns = [
+    re_path(r'^jobs/((?P<uuid>\w+)/)?$', JobsView.as_view())
+]
@@ -0,0 +1 @@
+from .job import *
@@ -0,0 +1,37 @@
+from op_keystone.base_view import BaseView
+from op_keystone.exceptions import CustomException
+from utils.dao import DAO
+from ..models import Job
+
+
+class JobsView(BaseView):
+    """
+    后台任务的状态和进度查询
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._model = DAO(Job)
+
+    def get(self, request, uuid=None):
+        try:
+            # 结合请求信息，设置到 model 属性
+            self._model = self._model.scoped(request)
+
+            # 存在 uuid 路由参数，返回单个任务
+            if uuid:
+                obj = self._model.get_obj(uuid=uuid)
+                return self.standard_response(obj.serialize())
+
+            # 参数提取，返回当前页任务
+            extra_opts = ['page', 'page-size', 'status']
+            request_params = self.get_params_dict(request, nullable=True)
+            extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
+            status_dict = {'status': extra_opts_dict.pop('status')} if 'status' in extra_opts_dict else {}
+            page_list = self._model.get_page_dict(**extra_opts_dict, **status_dict)
+
+            # 返回数据
+            return self.standard_response(page_list)
+
+        except CustomException as e:
+            return self.exception_to_response(e)
@@ -0,0 +1,446 @@
+import re
+from collections import OrderedDict
+from threading import Lock
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from utils import tools
+from . import instrumentation
+
+
+class LRUCache:
+    """
+    进程内的 LRU 缓存，线程安全
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        获取缓存值，并将其标记为最近使用
+        :param key: str, 缓存键
+        :return: 缓存值，不存在时为 None
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        设置缓存值，超出容量时淘汰最久未使用的值
+        :param key: str, 缓存键
+        :param value: 缓存值
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        删除缓存值
+        :param key: str, 缓存键
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        清空缓存
+        """
+        with self._lock:
+            self._data.clear()
+
+
+class PolicyCache:
+    """
+    用户有效策略列表的缓存，包括进程内 LRU 和 redis 两级，
+    通过全局版本号和用户版本号判断缓存是否失效
+    """
+
+    _global_version_key = 'auth:policy:version'
+    _user_version_key = 'auth:policy:version:%s'
+    _policies_key = 'auth:policy:policies:%s'
+
+    _local_cache = LRUCache(settings.AUTH_POLICY_LRU_SIZE)
+
+    @classmethod
+    def get_policies(cls, user_uuid, loader):
+        """
+        获取用户的有效策略列表，缓存失效时通过加载函数获取并写入缓存
+        :param user_uuid: str, 用户 uuid
+        :param loader: function, 无参数的加载函数，返回 policy 对象的可迭代对象
+        :return: list, [policy_obj, ...]
+        """
+        versions = cls._get_versions(user_uuid)
+
+        # 进程内缓存命中
+        local_entry = cls._local_cache.get(user_uuid)
+        if local_entry and local_entry[0] == versions:
+            instrumentation.record_cache('policy', True)
+            return local_entry[1]
+
+        # redis 缓存命中，回填进程内缓存
+        shared_entry = cache.get(cls._policies_key % user_uuid)
+        if shared_entry and shared_entry[0] == versions:
+            cls._local_cache.set(user_uuid, shared_entry)
+            instrumentation.record_cache('policy', True)
+            return shared_entry[1]
+
+        # 缓存失效，加载后写入两级缓存
+        instrumentation.record_cache('policy', False)
+        entry = (versions, list(loader()))
+        cache.set(cls._policies_key % user_uuid, entry, timeout=settings.AUTH_POLICY_CACHE_TIMEOUT)
+        cls._local_cache.set(user_uuid, entry)
+        return entry[1]
+
+    @classmethod
+    def invalidate_user(cls, user_uuid):
+        """
+        失效单个用户的策略缓存，用于用户与组、角色的关联变更；
+        在事务中调用时，事务提交后才失效，避免其他请求在提交前以新版本号缓存旧数据
+        :param user_uuid: str, 用户 uuid
+        """
+        def invalidate():
+            cache.set(cls._user_version_key % user_uuid, tools.generate_unique_uuid(),
+                      timeout=settings.AUTH_POLICY_CACHE_TIMEOUT)
+            cls._local_cache.delete(user_uuid)
+
+        transaction.on_commit(invalidate)
+
+    @classmethod
+    def invalidate_all(cls):
+        """
+        失效所有用户的策略缓存，用于组、角色、策略及其关联的变更；在事务中调用时，事务提交后才失效
+        """
+        def invalidate():
+            cache.set(cls._global_version_key, tools.generate_unique_uuid(), timeout=None)
+            cls._local_cache.clear()
+
+        transaction.on_commit(invalidate)
+
+    @classmethod
+    def _get_versions(cls, user_uuid):
+        """
+        获取全局版本号和用户版本号，不存在时进行初始化
+        :param user_uuid: str, 用户 uuid
+        :return: tuple, (全局版本号, 用户版本号)
+        """
+        global_key = cls._global_version_key
+        user_key = cls._user_version_key % user_uuid
+        version_dict = cache.get_many([global_key, user_key])
+
+        for key, timeout in ((global_key, None), (user_key, settings.AUTH_POLICY_CACHE_TIMEOUT)):
+            if key not in version_dict:
+                version = tools.generate_unique_uuid()
+                cache.add(key, version, timeout=timeout)
+                version_dict[key] = cache.get(key) or version
+
+        return version_dict[global_key], version_dict[user_key]
+
+
+class CompiledAction:
+    """
+    预处理后的动作，url 正则预先编译，method 预先展开为集合
+    """
+
+    __slots__ = ('uuid', 'name', 'service', 'url', 'method', 'pattern', 'methods')
+
+    # 方法别名与其包含的请求方法
+    _method_buckets = {
+        'modify': frozenset(['post', 'put']),
+        'manage': frozenset(['post', 'put', 'delete'])
+    }
+
+    def __init__(self, action_obj):
+        self.uuid = action_obj.uuid
+        self.name = action_obj.name
+        self.service = action_obj.service
+        self.url = action_obj.url
+        self.method = action_obj.method
+
+        # url 为 * 时匹配所有，正则无效时不匹配任何 url
+        self.pattern = None
+        if self.url != '*':
+            try:
+                self.pattern = re.compile(self.url)
+            except re.error:
+                self.pattern = re.compile(r'(?!)')
+
+        # method 为 * 时匹配所有方法
+        self.methods = None
+        if self.method != '*':
+            self.methods = self._method_buckets.get(self.method, frozenset([self.method]))
+
+    def match(self, url, method):
+        """
+        判断请求的 url 和 method 是否匹配动作
+        :param url: str, 请求路径
+        :param method: str, 小写的请求方法
+        :return: bool
+        """
+        if self.pattern and not self.pattern.match(url):
+            return False
+        if self.methods and method not in self.methods:
+            return False
+        return True
+
+
+class ActionIndex:
+    """
+    动作和服务的进程内索引，动作按服务分组，通过版本号判断是否需要重建
+    """
+
+    _version_key = 'auth:action:version'
+
+    _lock = Lock()
+    _version = None
+    _actions = {}
+    _service_actions = {}
+    _service_uuids = {}
+    _service_names = {}
+
+    @classmethod
+    def get_action(cls, action_uuid):
+        """
+        获取预处理后的动作
+        :param action_uuid: str, 动作 uuid
+        :return: CompiledAction object，不存在时为 None
+        """
+        cls._ensure_fresh()
+        return cls._actions.get(action_uuid)
+
+    @classmethod
+    def get_service_actions(cls, service_uuid):
+        """
+        获取服务下所有预处理后的动作
+        :param service_uuid: str, 服务 uuid
+        :return: dict, {action_uuid: CompiledAction, ...}
+        """
+        cls._ensure_fresh()
+        return cls._service_actions.get(service_uuid, {})
+
+    @classmethod
+    def get_service_uuid(cls, service_name):
+        """
+        通过服务名获取服务的 uuid
+        :param service_name: str, 服务名
+        :return: str，不存在时为 None
+        """
+        cls._ensure_fresh()
+        return cls._service_uuids.get(service_name)
+
+    @classmethod
+    def get_service_name(cls, service_uuid):
+        """
+        通过服务 uuid 获取服务名
+        :param service_uuid: str, 服务 uuid
+        :return: str，不存在时为 None
+        """
+        cls._ensure_fresh()
+        return cls._service_names.get(service_uuid)
+
+    @classmethod
+    def invalidate(cls):
+        """
+        失效所有进程的索引，用于动作和服务的变更；在事务中调用时，事务提交后才失效，
+        避免其他请求在提交前以新版本号重建旧数据的索引
+        """
+        def invalidate():
+            cache.set(cls._version_key, tools.generate_unique_uuid(), timeout=None)
+            with cls._lock:
+                cls._version = None
+
+        transaction.on_commit(invalidate)
+
+    @classmethod
+    def _ensure_fresh(cls):
+        """
+        检查共享版本号，版本变化时重建索引
+        """
+        version = cache.get(cls._version_key)
+        if version is not None and version == cls._version:
+            return
+
+        with cls._lock:
+            if version is not None and version == cls._version:
+                return
+            if version is None:
+                version = tools.generate_unique_uuid()
+                cache.add(cls._version_key, version, timeout=None)
+                version = cache.get(cls._version_key) or version
+            cls._rebuild(version)
+
+    @classmethod
+    def _rebuild(cls, version):
+        """
+        从数据库加载所有动作和服务，重建索引
+        :param version: str, 重建时的版本号
+        """
+        action_model = tools.import_string('assignment.models.Action')
+        service_model = tools.import_string('catalog.models.Service')
+
+        actions = {}
+        service_actions = {}
+        for action_obj in action_model.objects.all():
+            compiled_action = CompiledAction(action_obj)
+            actions[compiled_action.uuid] = compiled_action
+            service_actions.setdefault(compiled_action.service, {})[compiled_action.uuid] = compiled_action
+
+        service_uuids = {}
+        service_names = {}
+        for service_obj in service_model.objects.all():
+            service_names[service_obj.uuid] = service_obj.name
+            service_uuids[service_obj.name] = service_obj.uuid
+
+        cls._actions = actions
+        cls._service_actions = service_actions
+        cls._service_uuids = service_uuids
+        cls._service_names = service_names
+        cls._version = version
+
+
+class Principal:
+    """
+    登录用户的快照，作为请求的 user 使用，鉴权时无需查询用户和域
+    """
+
+    def __init__(self, uuid, name, domain, is_main, level, enable=True, domain_enable=True):
+        self.uuid = uuid
+        self.name = name
+        self.domain = domain
+        self.is_main = is_main
+        self.level = level
+        self.enable = enable
+        self.domain_enable = domain_enable
+
+    @classmethod
+    def from_user(cls, user_obj, domain_enable=True):
+        """
+        通过已判定级别的 user 对象生成快照
+        :param user_obj: user object
+        :param domain_enable: bool, 所属域是否启用
+        :return: Principal object
+        """
+        return cls(user_obj.uuid, user_obj.name, user_obj.domain, user_obj.is_main,
+                   user_obj.level, user_obj.enable, domain_enable)
+
+
+class PrincipalCache:
+    """
+    access token 到用户快照的缓存，缓存时间不超过 token 的过期时间
+    """
+
+    _token_key = 'auth:token:%s'
+
+    @classmethod
+    def get(cls, token):
+        """
+        获取 token 对应的用户快照
+        :param token: str, access token
+        :return: Principal object，不存在时为 None
+        """
+        principal = cache.get(cls._token_key % token)
+        instrumentation.record_cache('principal', principal is not None)
+        return principal
+
+    @classmethod
+    def set(cls, token, principal, expire_date):
+        """
+        缓存 token 对应的用户快照
+        :param token: str, access token
+        :param principal: Principal object
+        :param expire_date: datetime object, token 过期时间
+        """
+        now = tools.get_datetime_with_tz()
+        remain_seconds = int((tools.get_datetime_with_tz(expire_date) - now).total_seconds())
+        timeout = min(settings.AUTH_PRINCIPAL_CACHE_TIMEOUT, remain_seconds)
+        if timeout <= 0:
+            return
+        cache.set(cls._token_key % token, principal, timeout=timeout)
+
+    @classmethod
+    def invalidate_tokens(cls, *tokens):
+        """
+        失效指定 token 的用户快照
+        :param tokens: str, access token
+        """
+        cache.delete_many([cls._token_key % token for token in tokens if token])
+
+    @classmethod
+    def invalidate_users(cls, *user_uuids):
+        """
+        失效指定用户所有 token 的用户快照，用于用户的修改、禁用和删除
+        :param user_uuids: str, 用户 uuid
+        """
+        token_model = tools.import_string('credence.models.Token')
+        token_list = token_model.objects.filter(carrier__in=user_uuids, type=0).values_list('token', flat=True)
+        cls.invalidate_tokens(*token_list)
+
+    @classmethod
+    def invalidate_domain(cls, domain_uuid):
+        """
+        失效域下所有用户 token 的用户快照，用于域的修改、禁用和删除
+        :param domain_uuid: str, 域 uuid
+        """
+        user_model = tools.import_string('identity.models.User')
+        token_model = tools.import_string('credence.models.Token')
+        user_uuid_qs = user_model.objects.filter(domain=domain_uuid).values('uuid')
+        token_list = token_model.objects.filter(carrier__in=user_uuid_qs, type=0).values_list('token', flat=True)
+        cls.invalidate_tokens(*token_list)
+
+
+class TokenRevocation:
+    """
+    签名 token 的吊销列表，记录用户或域的吊销时间，早于该时间签发的 token 无效
+    """
+
+    _user_key = 'auth:revoked:user:%s'
+    _domain_key = 'auth:revoked:domain:%s'
+
+    @classmethod
+    def revoke_user(cls, user_uuid):
+        """
+        吊销用户已签发的所有 token，用于登出、修改密码、禁用和删除用户
+        :param user_uuid: str, 用户 uuid
+        """
+        cache.set(cls._user_key % user_uuid, tools.datetime_to_timestamp(), timeout=cls._timeout())
+
+    @classmethod
+    def revoke_domain(cls, domain_uuid):
+        """
+        吊销域下所有用户已签发的 token，用于禁用和删除域
+        :param domain_uuid: str, 域 uuid
+        """
+        cache.set(cls._domain_key % domain_uuid, tools.datetime_to_timestamp(), timeout=cls._timeout())
+
+    @classmethod
+    def is_revoked(cls, user_uuid, domain_uuid, issued_timestamp):
+        """
+        判断 token 是否已被吊销
+        :param user_uuid: str, 用户 uuid
+        :param domain_uuid: str, 域 uuid
+        :param issued_timestamp: float, token 签发时间戳
+        :return: bool
+        """
+        revoked_dict = cache.get_many([cls._user_key % user_uuid, cls._domain_key % domain_uuid])
+        for revoked_timestamp in revoked_dict.values():
+            if issued_timestamp <= revoked_timestamp:
+                return True
+        return False
+
+    @staticmethod
+    def _timeout():
+        """
+        吊销记录保留时间，超过 access token 有效期后签名 token 已自然过期
+        :return: int, 秒数
+        """
+        return settings.ACCESS_TOKEN_VALID_TIME * 60
@@ -1,7 +1,9 @@
-import re
 from op_keystone.exceptions import CustomException
 from utils import tools
 from utils.dao import DAO
+from django.db.models import Q
+from op_keystone.auth_cache import PolicyCache, ActionIndex, Principal, PrincipalCache, TokenRevocation
+from django.conf import settings
 
 
 class AuthTools:
@@ -14,7 +16,7 @@ class AuthTools:
     _group_model = DAO('identity.models.Group')
     _role_model = DAO('assignment.models.Role')
     _policy_model = DAO('assignment.models.Policy')
-    _action_model = DAO('assignment.models.Action')
+    _token_model = DAO('credence.models.Token')
 
     _m2m_user_role_model = DAO('identity.models.M2MUserRole')
     _m2m_user_group_model = DAO('identity.models.M2MUserGroup')
@@ -52,42 +54,123 @@ class AuthTools:
 
         return user_obj
 
+    def get_principal_of_token(self, token_obj):
+        """
+        通过 token 对象获取对应的用户快照，并写入缓存
+        :param token_obj: token object
+        :return: Principal object
+        """
+        user_obj = self.get_user_of_token(token_obj)
+        principal = Principal.from_user(user_obj)
+        PrincipalCache.set(token_obj.token, principal, token_obj.expire_date)
+        return principal
+
+    @staticmethod
+    def is_signed_token(rq_token):
+        """
+        判断请求的 token 是否为签名 token，仅在签名模式下有效
+        :param rq_token: str, access token
+        :return: bool
+        """
+        return settings.ACCESS_TOKEN_MODE == 'signed' and '.' in rq_token
+
+    @staticmethod
+    def generate_signed_token(user_obj, expire_date):
+        """
+        为已判定级别的 user 对象签发签名 access token
+        :param user_obj: user object 或 Principal object
+        :param expire_date: datetime object, 过期时间
+        :return: str, 签名 token
+        """
+        payload = {
+            'uuid': user_obj.uuid,
+            'name': user_obj.name,
+            'domain': user_obj.domain,
+            'is_main': user_obj.is_main,
+            'level': user_obj.level,
+            'iat': tools.datetime_to_timestamp(),
+            'exp': expire_date.timestamp()
+        }
+        return tools.sign_token(payload, settings.SIGNED_TOKEN_SECRET)
+
+    @staticmethod
+    def get_principal_of_signed_token(rq_token):
+        """
+        在本地校验签名 token 的签名、过期时间和吊销列表，获取用户快照，无需查询 token 表
+        :param rq_token: str, 签名 token
+        :return: Principal object
+        """
+        payload = tools.load_signed_token(rq_token, settings.SIGNED_TOKEN_SECRET)
+        if not payload:
+            raise CustomException()
+
+        try:
+            if payload['exp'] < tools.datetime_to_timestamp():
+                raise CustomException()
+            if TokenRevocation.is_revoked(payload['uuid'], payload['domain'], payload['iat']):
+                raise CustomException()
+            return Principal(payload['uuid'], payload['name'], payload['domain'],
+                             payload['is_main'], payload['level'])
+        except (KeyError, TypeError):
+            raise CustomException()
+
+    def get_principal_of_access_token(self, rq_token):
+        """
+        通过 access token 字符串获取用户快照，依次通过签名校验、缓存和数据库获取
+        :param rq_token: str, access token
+        :return: Principal object
+        """
+        if self.is_signed_token(rq_token):
+            return self.get_principal_of_signed_token(rq_token)
+
+        principal = PrincipalCache.get(rq_token)
+        if principal:
+            return principal
+
+        token_obj = self._token_model.get_obj(token=rq_token, type=0)
+        return self.get_principal_of_token(token_obj)
+
     def get_policies_of_user(self, user_obj):
         """
-        通过 user 对象获取包含对应 policy 对象的查询集
+        通过 user 对象获取对应的有效 policy 对象列表，优先从缓存获取
+        :param user_obj: user object
+        :return: list，[policy_obj, ...]
+        """
+        return PolicyCache.get_policies(user_obj.uuid, lambda: self._load_policies_of_user(user_obj))
+
+    def _load_policies_of_user(self, user_obj):
+        """
+        通过 user 对象从数据库获取对应的有效 policy 对象列表，并预先拆分资源列表
         :param user_obj: user object
-        :return: query_set，query_set(policy_obj, ...)
+        :return: list，[policy_obj, ...]
         """
-        # 用于存放 role 和 policy 的集合
-        role_uuid_set = set([])
-        policy_uuid_set = set([])
+        # 用户直接关联的 role 的 uuid 子查询
+        user_role_qs = self._m2m_user_role_model.get_obj_qs(user=user_obj.uuid).values('role')
 
-        # 将 user 对应的 role 的 uuid 放入集合
-        role_uuid_list = self._m2m_user_role_model.get_field_list('role', user=user_obj.uuid)
-        role_uuid_set |= set(role_uuid_list)
+        # 用户所属的可用 group 所关联的 role 的 uuid 子查询
+        user_group_qs = self._m2m_user_group_model.get_obj_qs(user=user_obj.uuid).values('group')
+        group_qs = self._group_model.get_obj_qs(uuid__in=user_group_qs, enable=True).values('uuid')
+        group_role_qs = self._m2m_group_role_model.get_obj_qs(group__in=group_qs).values('role')
 
-        # 将 user 对应的 group 所对应的 role 的 uuid 放入集合
-        group_uuid_list = self._m2m_user_group_model.get_field_list('group', user=user_obj.uuid)
-        for group_uuid in group_uuid_list:
-            if not self._group_model.get_obj(uuid=group_uuid).enable:
-                continue
-            g_role_uuid_list = self._m2m_group_role_model.get_field_list('role', group=group_uuid)
-            role_uuid_set |= set(g_role_uuid_list)
+        # 可用 role 所关联的 policy 的 uuid 子查询
+        role_qs = self._role_model.get_obj_qs(
+            Q(uuid__in=user_role_qs) | Q(uuid__in=group_role_qs), enable=True).values('uuid')
+        policy_uuid_qs = self._m2m_role_policy_model.get_obj_qs(role__in=role_qs).values('policy')
 
-        # 分别集合中 role 对应的 policy 的 uuid 放入集合
-        for role_uuid in role_uuid_set:
-            if not self._role_model.get_obj(uuid=role_uuid).enable:
-                continue
-            policy_uuid_list = self._m2m_role_policy_model.get_field_list('policy', role=role_uuid)
-            policy_uuid_set |= set(policy_uuid_list)
+        # 所有 policy 查询，子查询合并为单条 sql，查询数与 group、role 数量无关
+        policy_obj_list = list(self._policy_model.get_obj_qs(uuid__in=policy_uuid_qs, enable=True))
 
-        # 所有 policy 列表并返回
-        return self._policy_model.get_obj_qs(uuid__in=policy_uuid_set, enable=True)
+        # 预先拆分 policy 的资源列表，鉴权时不再重复处理
+        for policy_obj in policy_obj_list:
+            policy_obj.res_list = policy_obj.res.split(',')
+            policy_obj.res_set = frozenset(policy_obj.res_list)
 
-    def judge_policies(self, policy_obj_qs, service_uuid, request_info):
+        return policy_obj_list
+
+    def judge_policies(self, policy_obj_list, service_uuid, request_info):
         """
         判断请求是否匹配，若匹配返回 policy 的反馈字典
-        :param policy_obj_qs: policy query set
+        :param policy_obj_list: list, 由 get_policies_of_user 获取的 policy 对象列表
         :param service_uuid: str, 服务 uuid
         :param request_info: tuple, 请求信息
         :return: tuple, access 标记和两个条件列表
@@ -95,41 +178,31 @@ class AuthTools:
         allow_condition_list = []
         deny_condition_list = []
 
+        # 获取服务下预处理的动作，以及请求信息
+        service_actions = ActionIndex.get_service_actions(service_uuid)
+        url = request_info['url']
+        method = request_info['method']
+        res = request_info['routing_params'].get('uuid')
+
         access = False
-        for policy_obj in policy_obj_qs:
-            # 获取 policy 对象对应的 action 对象, 若 service 不符合，退出当次循环
-            action_obj = self._action_model.get_obj(uuid=policy_obj.action)
-            if action_obj.service != service_uuid:
+        for policy_obj in policy_obj_list:
+            # 获取 policy 对象对应的动作, 若 service 不符合，退出当次循环
+            action = service_actions.get(policy_obj.action)
+            if not action:
                 continue
 
-            # 请求 view 不匹配期望 view，退出当次循环
-            url = request_info['url']
-            exp_url = action_obj.url
-            if exp_url != '*' and not re.match(exp_url, url):
+            # 请求 view 或 method 不匹配期望，退出当次循环
+            if not action.match(url, method):
                 continue
 
-            # 请求 method 不匹配期望 method，退出当次循环
-            method = request_info['method']
-            exp_method = action_obj.method
-            if exp_method != '*':
-                if exp_method == 'modify':
-                    if method != 'post' and method != 'put':
-                        continue
-                elif exp_method == 'manage':
-                    if method != 'post' and method != 'put' and method != 'delete':
-                        continue
-                elif method != exp_method:
-                    continue
-
             # 请求 res 不匹配期望 res，退出当次循环
-            res = request_info['routing_params'].get('uuid')
-            exp_res_list = policy_obj.res.split(',')
+            exp_res_list = policy_obj.res_list
 
             if policy_obj.effect == 'allow':
                 if exp_res_list[0] == '*':
                     access = True
                     allow_condition_list.append(policy_obj.condition)
-                elif res and res in exp_res_list:
+                elif res and res in policy_obj.res_set:
                     access = True
 
             else:
@@ -141,7 +214,7 @@ class AuthTools:
                         access = False
                         break
                 elif res:
-                    if res in exp_res_list:
+                    if res in policy_obj.res_set:
                         access = False
                         break
                 else:
@@ -2,6 +2,7 @@ from django.db import models
 from utils import tools
 from django.core.exceptions import FieldDoesNotExist
 from django.db.models import Q
+from op_keystone.exceptions import RequestParamsError
 
 
 class BaseModel(models.Model):
@@ -46,6 +47,69 @@ class BaseModel(models.Model):
         """
         pass
 
+    @classmethod
+    def pre_bulk_create(cls, obj_list):
+        """
+        批量创建前的检查和操作，默认逐个调用创建前钩子，子类可重写为批量检查
+        :param obj_list: list, 对象列表
+        """
+        for obj in obj_list:
+            obj.pre_create()
+
+    @classmethod
+    def post_bulk_create(cls, obj_list):
+        """
+        批量创建后的检查和操作，默认逐个调用创建后钩子
+        :param obj_list: list, 对象列表
+        """
+        for obj in obj_list:
+            obj.post_create()
+
+    @classmethod
+    def pre_bulk_update(cls, obj_list):
+        """
+        批量更新前的检查和操作，默认逐个调用更新前钩子
+        :param obj_list: list, 对象列表
+        """
+        for obj in obj_list:
+            obj.pre_update()
+
+    @classmethod
+    def post_bulk_update(cls, obj_list):
+        """
+        批量更新后的检查和操作，默认逐个调用更新后钩子
+        :param obj_list: list, 对象列表
+        """
+        for obj in obj_list:
+            obj.post_update()
+
+    @classmethod
+    def pre_bulk_delete(cls, obj_list):
+        """
+        批量删除前的检查和操作，默认逐个调用删除前钩子
+        :param obj_list: list, 对象列表
+        """
+        for obj in obj_list:
+            obj.pre_delete()
+
+    @classmethod
+    def validate_bulk_delete(cls, obj_list):
+        """
+        批量删除前，使用分组查询检查不允许删除的对象，子类可重写
+        :param obj_list: list, 对象列表
+        :return: dict, {pk: exception object, ...}, 不允许删除的对象及原因
+        """
+        return {}
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后的检查和操作，默认逐个调用删除后钩子
+        :param obj_list: list, 对象列表
+        """
+        for obj in obj_list:
+            obj.post_delete()
+
     @classmethod
     def get_field(cls, field_name):
         """
@@ -80,19 +144,62 @@ class ResourceModel(BaseModel):
         if not self.uuid:
             self.uuid = tools.generate_unique_uuid()
 
-    def serialize(self):
+    def serialize(self, fields=None):
         """
         对象序列化
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
         :return: dict
         """
         d = self.__dict__.copy()
         del d['_state']
 
         for i in ('created_time', 'updated_time'):
-            if not d[i] is None:
+            if d.get(i) is not None:
                 d[i] = tools.datetime_to_humanized(d[i])
+
+        if fields is not None:
+            d = {k: v for k, v in d.items() if k in fields}
         return d
 
+    @classmethod
+    def serialize_list(cls, obj_list, fields=None):
+        """
+        对象列表序列化，子类可重写以批量查询附加信息
+        :param obj_list: list|query set, 对象列表
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: list, [dict, ...]
+        """
+        return [obj.serialize(fields) for obj in obj_list]
+
+    @classmethod
+    def get_extra_fields(cls):
+        """
+        获取序列化时附加计算的字段，这些字段不存在于数据库中
+        :return: list
+        """
+        return []
+
+    @classmethod
+    def get_column_fields(cls, fields):
+        """
+        校验需要返回的字段列表，获取需要从数据库读取的字段列表
+        :param fields: list, 需要返回的字段列表
+        :return: list, 数据库字段列表
+        """
+        extra_fields = cls.get_extra_fields()
+
+        # 主键和创建时间用于附加信息查询和游标分页，始终读取
+        column_fields = ['uuid', 'created_time']
+        for f in fields:
+            if f in extra_fields:
+                continue
+            field_obj = cls.get_field(f)
+            if not field_obj or not field_obj.concrete:
+                raise RequestParamsError(opt='fields', invalid=True)
+            if f not in column_fields:
+                column_fields.append(f)
+        return column_fields
+
     @classmethod
     def get_default_query_keys(cls):
         """
@@ -101,6 +208,14 @@ class ResourceModel(BaseModel):
         """
         return ['uuid']
 
+    @classmethod
+    def get_search_index_keys(cls):
+        """
+        获取维护后缀索引的查询字段，自由文本查询这些字段时通过索引解析为主键
+        :return: list
+        """
+        return []
+
     @classmethod
     def get_custom_query_keys(cls):
         """
@@ -1,6 +1,9 @@
 from op_keystone.exceptions import *
 from django.views import View
-from django.http import JsonResponse, QueryDict
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse, QueryDict
+from django.core.serializers.json import DjangoJSONEncoder
+import json
 from utils import tools
 from utils.dao import DAO
 import re
@@ -79,6 +82,21 @@ class ParamsProcessMixin:
                 raise RequestParamsError(opt=opt)
         return extract_dict
 
+    @staticmethod
+    def parsing_fields(fields_str):
+        """
+        解析逗号分隔的字段投影参数
+        :param fields_str: str, 字段参数
+        :return: list, 字段列表，参数不存在时为 None
+        """
+        if fields_str is None:
+            return None
+
+        fields = [f.strip() for f in fields_str.split(',') if f.strip()]
+        if not fields:
+            raise RequestParamsError(opt='fields', invalid=True)
+        return fields
+
 
 class BaseView(View, ParamsProcessMixin):
     """
@@ -103,6 +121,28 @@ class BaseView(View, ParamsProcessMixin):
         }
         return JsonResponse(res_dict)
 
+    @staticmethod
+    def stream_response(data_iter, framing='json'):
+        """
+        生成流式响应对象，逐条输出数据，json 格式与标准响应结构一致，ndjson 格式每行一条数据
+        :param data_iter: iterable, 数据迭代器
+        :param framing: str, 输出格式，json 或 ndjson
+        :return: StreamingHttpResponse object, 流式响应对象
+        """
+        encoder = DjangoJSONEncoder()
+
+        if framing == 'ndjson':
+            content = (encoder.encode(d) + '\n' for d in data_iter)
+            return StreamingHttpResponse(content, content_type='application/x-ndjson')
+
+        def json_content():
+            yield '{"code": 200, "data": ['
+            for index, d in enumerate(data_iter):
+                yield (', ' if index else '') + encoder.encode(d)
+            yield '], "message": null}'
+
+        return StreamingHttpResponse(json_content(), content_type='application/json')
+
     def dispatch(self, request, *args, **kwargs):
         """
         根据请求的方法，分发视图函数
@@ -112,16 +152,59 @@ class BaseView(View, ParamsProcessMixin):
         :return: Response object, 响应对象
         """
         try:
-            if request.method.lower() in self.http_method_names:
-                try:
-                    handler = getattr(self, request.method.lower())
-                except AttributeError:
-                    raise MethodNotAllowed(request.method.lower(), request.path)
-                else:
-                    return handler(request, *args, **kwargs)
+            if request.method.lower() not in self.http_method_names:
+                raise MethodNotAllowed(request.method.lower(), request.path)
+            try:
+                handler = getattr(self, request.method.lower())
+            except AttributeError:
+                raise MethodNotAllowed(request.method.lower(), request.path)
+            else:
+                return handler(request, *args, **kwargs)
         except MethodNotAllowed as e:
             return self.exception_to_response(e)
 
+    @staticmethod
+    def get_page_list(model, page_opts_dict, *query_obj, **kwargs):
+        """
+        根据分页参数获取当前页数据，存在 cursor 参数时使用游标分页，否则使用页数分页
+        :param model: DAO object, 数据访问对象
+        :param page_opts_dict: dict, 分页参数字典
+        :param query_obj: Q object, 查询对象
+        :param kwargs: dict, 过滤参数
+        :return: dict, 当前页数据
+        """
+        if 'cursor' in page_opts_dict:
+            cursor_opts = {
+                'cursor': page_opts_dict['cursor'],
+                'with_total': page_opts_dict.get('with_total') in ('1', 'true', True)
+            }
+            if page_opts_dict.get('page_size'):
+                cursor_opts['page_size'] = page_opts_dict['page_size']
+            return model.get_cursor_dict(*query_obj, **cursor_opts, **kwargs)
+
+        page_opts = {k: v for k, v in page_opts_dict.items() if k in ('page', 'page_size')}
+        return model.get_page_dict(*query_obj, **page_opts, **kwargs)
+
+    @staticmethod
+    def is_async(opts_dict):
+        """
+        根据 async 参数判断是否以后台任务模式执行
+        :param opts_dict: dict, 参数字典
+        :return: bool
+        """
+        return opts_dict.get('async') in ('1', 'true', True, 1)
+
+    def submit_job(self, request, name, params):
+        """
+        提交后台任务，返回任务信息
+        :param request: request object, 请求
+        :param name: str, 任务处理函数路径
+        :param params: dict, 任务参数
+        :return: Response object, 响应对象，返回码为 202
+        """
+        job_obj = tools.import_string('job.models.Job').submit(name, params, request)
+        return self.standard_response(job_obj.serialize(), code=202)
+
     def exception_to_response(self, exception):
         """
         接收异常对象，转化为 json 响应对象并返回
@@ -145,26 +228,37 @@ class ResourceView(BaseView):
     def get(self, request, uuid=None):
         try:
             # 结合请求信息，设置到 model 属性
-            self._model.combine_request(request)
-
-            # 存在 uuid 路由参数，返回单个对象
-            if uuid:
-                obj = self._model.get_obj(uuid=uuid)
-                return self.standard_response(obj.serialize())
+            self._model = self._model.scoped(request)
 
             # 定义参数提取列表
-            extra_opts = ['query', 'query-type' , 'page', 'page-size']
+            extra_opts = ['query', 'query-type' , 'page', 'page-size', 'cursor', 'with-total', 'fields',
+                          {'key': 'stream', 'values': ['json', 'ndjson'], 'white': True}]
             request_params = self.get_params_dict(request, nullable=True)
             extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
 
+            # 字段投影参数解析
+            fields = self.parsing_fields(extra_opts_dict.pop('fields', None))
+
+            # 存在 uuid 路由参数，返回单个对象
+            if uuid:
+                obj_qs = self._model.only_fields(self._model.get_obj_qs(uuid=uuid), fields)
+                obj = obj_qs.first()
+                if not obj:
+                    raise ObjectNotExist(self._model.model.__name__)
+                return self.standard_response(obj.serialize(fields))
+
             # 查询对象生成
             query_str = extra_opts_dict.pop('query', None)
             query_type = extra_opts_dict.pop('query_type', None)
             query_obj = self._model.parsing_query_str(query_str, query_type, url_params=True)
 
-            # 当前页数据获取
-            total_list = self._model.get_dict_list(query_obj)
-            page_list = tools.paging_list(total_list, **extra_opts_dict)
+            # 不分页且指定 stream 参数时，流式返回所有数据
+            stream = extra_opts_dict.pop('stream', None)
+            if stream and not extra_opts_dict.get('page_size') and 'cursor' not in extra_opts_dict:
+                return self.stream_response(self._model.iter_serialize(query_obj, fields=fields), stream)
+
+            # 当前页数据获取，存在 cursor 参数时使用游标分页
+            page_list = self.get_page_list(self._model, extra_opts_dict, query_obj, fields=fields)
 
             # 返回数据
             return self.standard_response(page_list)
@@ -175,7 +269,7 @@ class ResourceView(BaseView):
     def post(self, request, uuid=None):
         try:
             # 结合请求信息，设置到 model 属性
-            self._model.combine_request(request)
+            self._model = self._model.scoped(request)
 
             # 校验创建对象权限
             self._model.validate_create()
@@ -201,7 +295,7 @@ class ResourceView(BaseView):
     def put(self, request, uuid=None):
         try:
             # 结合请求信息，设置到 model 属性
-            self._model.combine_request(request)
+            self._model = self._model.scoped(request)
 
             # 若 uuid 不存在，发生路由参数异常，否则获取对象，并校验对象权限
             if not uuid:
@@ -230,7 +324,7 @@ class ResourceView(BaseView):
     def delete(self, request, uuid=None):
         try:
             # 结合请求信息，设置 model 属性
-            self._model.combine_request(request)
+            self._model = self._model.scoped(request)
 
             # 若 uuid 不存在，发生路由参数异常，否则获取对象，并校验对象权限
             if not uuid:
@@ -262,26 +356,27 @@ class M2MRelationView(BaseView):
     def get(self, request, uuid):
         try:
             # 结合请求信息，设置 model 查询参数
-            self._from_model.combine_request(request)
-            self._to_model.combine_request(request)
+            self._from_model = self._from_model.scoped(request)
+            self._to_model = self._to_model.scoped(request)
 
             # 保证来源对象存在
             self._from_model.get_obj(uuid=uuid)
 
             # 参数提取
-            extra_opts = ['query', 'page', 'page-size']
+            extra_opts = ['query', 'page', 'page-size', 'cursor', 'with-total', 'fields']
             request_params = self.get_params_dict(request, nullable=True)
             extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
+            fields = self.parsing_fields(extra_opts_dict.pop('fields', None))
 
             # 查询对象生成
             query_str = extra_opts_dict.pop('query', None)
             query_type = extra_opts_dict.pop('query_type', None)
             query_obj = self._to_model.parsing_query_str(query_str, query_type, url_params=True)
 
-            # 获取目的对象列表，并获取当前页数据
-            to_uuid_list = self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid})
-            to_dict_list = self._to_model.get_dict_list(query_obj, uuid__in=to_uuid_list)
-            page_list = tools.paging_list(to_dict_list, **extra_opts_dict)
+            # 获取目的对象的当前页数据，存在 cursor 参数时使用游标分页
+            to_uuid_qs = self._m2m_model.get_obj_qs(**{self._from_field: uuid}).values(self._to_field)
+            page_list = self.get_page_list(self._to_model, extra_opts_dict, query_obj, fields=fields,
+                                           uuid__in=to_uuid_qs)
 
             # 返回数据
             return self.standard_response(page_list)
@@ -292,8 +387,8 @@ class M2MRelationView(BaseView):
     def post(self, request, uuid):
         try:
             # 结合请求信息，设置 model 查询参数
-            self._from_model.combine_request(request)
-            self._to_model.combine_request(request)
+            self._from_model = self._from_model.scoped(request)
+            self._to_model = self._to_model.scoped(request)
 
             # 保证源对象存在，校验对象权限合法性
             from_obj = self._from_model.get_obj(uuid=uuid)
@@ -309,20 +404,9 @@ class M2MRelationView(BaseView):
             old_to_opts_set = set(self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid}))
             add_to_opts_list = list(to_opts_set - old_to_opts_set)
 
-            # 保证每个目标对象存在，然后添加多对多关系
-            for to_uuid in add_to_opts_list:
-                to_obj = self._to_model.get_obj(uuid=to_uuid)
-                if request.user.level != 1:
-                    if self._from_field == 'role' or self._from_field == 'policy':
-                        self._to_model.validate_obj(to_obj)
-                        if (self._to_field == 'role' and to_obj.builtin) or \
-                                (self._to_field == 'policy' and from_obj.builtin):
-                            raise PermissionDenied()
-
-                self._m2m_model.create_obj(**{
-                    self._from_field: uuid,
-                    self._to_field: to_uuid
-                })
+            # 保证每个目标对象存在，然后在事务中批量添加多对多关系
+            with transaction.atomic():
+                self.add_relations(request, from_obj, add_to_opts_list)
 
             # 获取最新目标对象列表，不分页获取列表所有数据
             to_uuid_list = self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid})
@@ -337,77 +421,69 @@ class M2MRelationView(BaseView):
 
     def put(self, request, uuid):
         try:
-            # 结合请求信息，设置 model 查询参数
-            self._from_model.combine_request(request)
-            self._to_model.combine_request(request)
-
-            # 保证源对象存在，校验对象权限合法性
-            from_obj = self._from_model.get_obj(uuid=uuid)
-            self._from_model.validate_obj(from_obj, m2m=True)
-
             # 参数提取
             necessary_opts = ['uuid_list']
             request_params = self.get_params_dict(request)
             necessary_opts_dict = self.extract_opts(request_params, necessary_opts)
 
-            # 获取需要添加和删除的目标对象 uuid 列表
-            to_opts_set = set(necessary_opts_dict['uuid_list'])
-            old_to_opts_set = set(self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid}))
-            add_to_opts_list = list(to_opts_set - old_to_opts_set)
-            del_to_opts_list = list(old_to_opts_set - to_opts_set)
-
-            # 保证每个目标对象存在，然后添加多对多关系
-            for to_uuid in add_to_opts_list:
-                to_obj = self._to_model.get_obj(uuid=to_uuid)
-                if request.user.level != 1:
-                    if self._from_field == 'role' or self._from_field == 'policy':
-                        self._to_model.validate_obj(to_obj)
-                        if (self._to_field == 'role' and to_obj.builtin) or \
-                                (self._to_field == 'policy' and from_obj.builtin):
-                            raise PermissionDenied()
-
-                self._m2m_model.create_obj(**{
-                    self._from_field: uuid,
-                    self._to_field: to_uuid
-                })
-
-            # 删除多对多关系
-            for to_uuid in del_to_opts_list:
-                try:
-                    to_obj = self._to_model.get_obj(uuid=to_uuid)
-                except CustomException:
-                    self._m2m_model.delete_obj_qs(**{
-                        self._from_field: uuid,
-                        self._to_field: to_uuid
-                    })
-                else:
-                    if request.user.level != 1:
-                        if self._from_field == 'role' or self._from_field == 'policy':
-                            self._to_model.validate_obj(to_obj)
-                            if (self._to_field == 'role' and to_obj.builtin) or \
-                                    (self._to_field == 'policy' and from_obj.builtin):
-                                raise PermissionDenied()
-                    self._m2m_model.delete_obj_qs(**{
-                        self._from_field: uuid,
-                        self._to_field: to_uuid
-                    })
+            extra_opts = ['async']
+            extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
 
-            # 获取最新目标对象列表，不分页获取列表所有数据
-            to_uuid_list = self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid})
-            to_dict_list = self._to_model.get_dict_list(uuid__in=to_uuid_list)
-            page_list = tools.paging_list(to_dict_list)
+            # 后台任务模式，校验源对象后提交任务，返回任务信息
+            if self.is_async(extra_opts_dict):
+                self._from_model = self._from_model.scoped(request)
+                from_obj = self._from_model.get_obj(uuid=uuid)
+                self._from_model.validate_obj(from_obj, m2m=True)
+                return self.submit_job(request, 'op_keystone.jobs.replace_relations', {
+                    'view': '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+                    'uuid': uuid,
+                    'uuid_list': necessary_opts_dict['uuid_list']
+                })
 
-            # 返回数据
+            # 替换多对多关系，返回最新目标对象列表
+            page_list = self.replace_relations(request, uuid, necessary_opts_dict['uuid_list'])
             return self.standard_response(page_list)
 
         except CustomException as e:
             return self.exception_to_response(e)
 
+    def replace_relations(self, request, uuid, uuid_list):
+        """
+        将来源对象的多对多关系替换为指定的目标对象
+        :param request: request object, 请求
+        :param uuid: str, 来源对象 uuid
+        :param uuid_list: list, 目标对象 uuid 列表
+        :return: dict, 最新目标对象列表
+        """
+        # 结合请求信息，设置 model 查询参数
+        self._from_model = self._from_model.scoped(request)
+        self._to_model = self._to_model.scoped(request)
+
+        # 保证源对象存在，校验对象权限合法性
+        from_obj = self._from_model.get_obj(uuid=uuid)
+        self._from_model.validate_obj(from_obj, m2m=True)
+
+        # 获取需要添加和删除的目标对象 uuid 列表
+        to_opts_set = set(uuid_list)
+        old_to_opts_set = set(self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid}))
+        add_to_opts_list = list(to_opts_set - old_to_opts_set)
+        del_to_opts_list = list(old_to_opts_set - to_opts_set)
+
+        # 保证每个目标对象存在，然后在事务中批量添加和删除多对多关系
+        with transaction.atomic():
+            self.add_relations(request, from_obj, add_to_opts_list)
+            self.delete_relations(request, from_obj, del_to_opts_list)
+
+        # 获取最新目标对象列表，不分页获取列表所有数据
+        to_uuid_list = self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid})
+        to_dict_list = self._to_model.get_dict_list(uuid__in=to_uuid_list)
+        return tools.paging_list(to_dict_list)
+
     def delete(self, request, uuid):
         try:
             # 结合请求信息，设置 model 查询参数
-            self._from_model.combine_request(request)
-            self._to_model.combine_request(request)
+            self._from_model = self._from_model.scoped(request)
+            self._to_model = self._to_model.scoped(request)
 
             # 保证源对象存在，校验对象权限合法性
             from_obj = self._from_model.get_obj(uuid=uuid)
@@ -423,26 +499,9 @@ class M2MRelationView(BaseView):
             old_to_uuid_set = set(self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid}))
             del_to_uuid_list = list(to_uuid_set & old_to_uuid_set)
 
-            # 删除多对多关系
-            for to_uuid in del_to_uuid_list:
-                try:
-                    to_obj = self._to_model.get_obj(uuid=to_uuid)
-                except CustomException:
-                    self._m2m_model.delete_obj_qs(**{
-                        self._from_field: uuid,
-                        self._to_field: to_uuid
-                    })
-                else:
-                    if request.user.level != 1:
-                        if self._from_field == 'role' or self._from_field == 'policy':
-                            self._to_model.validate_obj(to_obj)
-                            if (self._to_field == 'role' and to_obj.builtin) or \
-                                    (self._to_field == 'policy' and from_obj.builtin):
-                                raise PermissionDenied()
-                    self._m2m_model.delete_obj_qs(**{
-                        self._from_field: uuid,
-                        self._to_field: to_uuid
-                    })
+            # 在事务中批量删除多对多关系
+            with transaction.atomic():
+                self.delete_relations(request, from_obj, del_to_uuid_list)
 
             # 获取最新目标对象列表，不分页获取列表所有数据
             to_uuid_list = self._m2m_model.get_field_list(self._to_field, **{self._from_field: uuid})
@@ -455,6 +514,60 @@ class M2MRelationView(BaseView):
         except CustomException as e:
             return self.exception_to_response(e)
 
+    def validate_to_obj(self, request, from_obj, to_obj):
+        """
+        校验对目标对象进行多对多操作的权限，非全局用户不允许操作内置角色，或为内置策略关联对象
+        :param request: request object, 请求
+        :param from_obj: model object, 来源对象
+        :param to_obj: model object, 目标对象
+        """
+        if request.user.level != 1:
+            if self._from_field == 'role' or self._from_field == 'policy':
+                self._to_model.validate_obj(to_obj)
+                if (self._to_field == 'role' and to_obj.builtin) or \
+                        (self._to_field == 'policy' and from_obj.builtin):
+                    raise PermissionDenied()
+
+    def add_relations(self, request, from_obj, to_uuid_list):
+        """
+        一次性查询并校验所有目标对象，批量添加多对多关系
+        :param request: request object, 请求
+        :param from_obj: model object, 来源对象
+        :param to_uuid_list: list, 需要添加的目标对象 uuid 列表
+        """
+        if not to_uuid_list:
+            return
+
+        # 保证每个目标对象存在
+        to_obj_dict = {obj.uuid: obj for obj in self._to_model.get_obj_qs(uuid__in=to_uuid_list)}
+        for to_uuid in to_uuid_list:
+            to_obj = to_obj_dict.get(to_uuid)
+            if not to_obj:
+                raise ObjectNotExist(self._to_model.model.__name__)
+            self.validate_to_obj(request, from_obj, to_obj)
+
+        self._m2m_model.bulk_create_objs([
+            {self._from_field: from_obj.uuid, self._to_field: to_uuid} for to_uuid in to_uuid_list
+        ])
+
+    def delete_relations(self, request, from_obj, to_uuid_list):
+        """
+        一次性查询并校验存在的目标对象，批量删除多对多关系，不存在的目标对象直接删除关系
+        :param request: request object, 请求
+        :param from_obj: model object, 来源对象
+        :param to_uuid_list: list, 需要删除的目标对象 uuid 列表
+        """
+        if not to_uuid_list:
+            return
+
+        for to_obj in self._to_model.get_obj_qs(uuid__in=to_uuid_list):
+            self.validate_to_obj(request, from_obj, to_obj)
+
+        self._m2m_model.delete_obj_qs(**{
+            self._from_field: from_obj.uuid,
+            self._to_field + '__in': to_uuid_list
+        })
+
 
 class MultiDeleteView(BaseView):
     """
@@ -468,21 +581,51 @@ class MultiDeleteView(BaseView):
     def post(self, request):
         try:
             # 结合请求信息，设置 model 查询参数
-            self._model.combine_request(request)
+            self._model = self._model.scoped(request)
 
             # 参数提取
             necessary_opts = ['uuid_list']
             request_params = self.get_params_dict(request)
             necessary_opts_dict = self.extract_opts(request_params, necessary_opts)
 
-            # 检验并删除对象
-            for uuid in necessary_opts_dict['uuid_list']:
-                obj = self._model.get_obj(uuid=uuid)
-                self._model.validate_obj(obj)
-                self._model.delete_obj(obj)
-
-            # 返回删除信息
-            return self.standard_response('succeed to delete multi objects ')
+            extra_opts = ['partial']
+            extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
+            partial = extra_opts_dict.get('partial') in ('1', 'true', True)
+
+            # 一次性获取所有对象，在内存中校验对象存在和权限合法性，记录失败原因
+            uuid_list = list(dict.fromkeys(necessary_opts_dict['uuid_list']))
+            obj_dict = {obj.uuid: obj for obj in self._model.get_obj_qs(uuid__in=uuid_list)}
+            failed_dict = {}
+            for uuid in uuid_list:
+                obj = obj_dict.get(uuid)
+                try:
+                    if not obj:
+                        raise ObjectNotExist(self._model.model.__name__)
+                    self._model.validate_obj(obj)
+                except CustomException as e:
+                    failed_dict[uuid] = e
+
+            # 分组查询进行删除前检查
+            obj_list = [obj_dict[uuid] for uuid in uuid_list if uuid not in failed_dict]
+            failed_dict.update(self._model.model.validate_bulk_delete(obj_list))
+
+            # 非部分删除模式，存在失败则不进行删除
+            if failed_dict and not partial:
+                raise failed_dict[next(uuid for uuid in uuid_list if uuid in failed_dict)]
+
+            # 在事务中分批删除对象
+            obj_list = [obj for obj in obj_list if obj.uuid not in failed_dict]
+            with transaction.atomic():
+                for i in range(0, len(obj_list), 1000):
+                    self._model.bulk_delete_objs(obj_list[i:i + 1000])
+
+            # 返回删除信息，部分删除模式返回每个对象的失败原因
+            if not partial:
+                return self.standard_response('succeed to delete multi objects ')
+            return self.standard_response({
+                'deleted': [obj.uuid for obj in obj_list],
+                'failed': {uuid: e.__message__() for uuid, e in failed_dict.items()}
+            })
 
         except CustomException as e:
             return self.exception_to_response(e)
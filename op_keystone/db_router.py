@@ -0,0 +1,100 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+import random
+import threading
+
+# 当前线程处理的请求的路由状态，线程间互不影响
+_local = threading.local()
+
+
+def reset():
+    """
+    清空当前线程的路由状态，请求开始和结束、后台任务开始时调用
+    """
+    _local.pinned = False
+    _local.user_uuid = None
+
+
+def get_state():
+    """
+    获取当前线程的路由状态，用于流式响应在请求中间件返回后恢复
+    :return: tuple, (是否使用主库, 用户 uuid)
+    """
+    return is_pinned(), getattr(_local, 'user_uuid', None)
+
+
+def set_state(state):
+    """
+    恢复当前线程的路由状态
+    :param state: tuple, get_state 返回的路由状态
+    """
+    _local.pinned, _local.user_uuid = state
+
+
+def set_user(user_uuid):
+    """
+    设置当前请求的用户，用户在读写窗口内写过数据时，本次请求的读操作使用主库
+    :param user_uuid: str, 用户 uuid
+    """
+    _local.user_uuid = user_uuid
+    if not is_pinned() and user_uuid and settings.DATABASE_REPLICAS:
+        if cache.get(_user_key(user_uuid)):
+            _local.pinned = True
+
+
+def pin_primary():
+    """
+    标记当前请求已写入数据，之后的读操作使用主库，并在读写窗口内对同一用户的后续请求生效
+    """
+    if is_pinned():
+        return
+    _local.pinned = True
+
+    user_uuid = getattr(_local, 'user_uuid', None)
+    if user_uuid and settings.DATABASE_REPLICAS:
+        cache.set(_user_key(user_uuid), 1, timeout=settings.DATABASE_READ_YOUR_WRITES_WINDOW)
+
+
+def is_pinned():
+    """
+    判断当前请求的读操作是否使用主库
+    :return: bool
+    """
+    return getattr(_local, 'pinned', False)
+
+
+def _user_key(user_uuid):
+    return 'db_router:primary:%s' % user_uuid
+
+
+class ReplicaRouter:
+    """
+    读写分离的数据库路由，写操作使用主库，读操作随机使用 DATABASE_REPLICAS 中的从库；
+    请求写入后，本次请求和同一用户在读写窗口内的请求，读操作使用主库，保证读到自己的写入
+    """
+
+    primary = 'default'
+
+    # 读操作始终使用主库的模型，token 签发后立即用于鉴权，而鉴权时请求的用户尚未确定，无法按用户选择主库
+    primary_models = {'credence.Token'}
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas or is_pinned() or model._meta.label in self.primary_models:
+            return self.primary
+
+        # 事务中的读操作与写操作使用同一连接
+        if connections[self.primary].in_atomic_block:
+            return self.primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        pin_primary()
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == self.primary
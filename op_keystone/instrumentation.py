@@ -0,0 +1,207 @@
+from django.conf import settings
+from django.db import connections
+from utils import tools
+from collections import Counter
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 当前线程处理的请求的统计，线程间互不影响
+_local = threading.local()
+
+# 进程内按视图汇总的统计
+_stats_lock = threading.Lock()
+_stats_dict = {}
+
+# 合并 IN 列表中数量不同的参数占位符，得到查询的形状
+_in_params_re = re.compile(r'\((?:%s, )*%s\)')
+
+
+class RequestRecorder:
+    """
+    单个请求的 sql 数量、数据库耗时、重复查询形状和缓存命中统计
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.view = None
+        self.query_count = 0
+        self.db_time = 0.0
+        self.shape_counter = Counter()
+        self.cache_counter = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        数据库连接的 execute wrapper，记录每条 sql 的耗时和形状
+        """
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start_time
+            self.query_count += 1
+            self.shape_counter[_in_params_re.sub('(...)', sql)] += 1
+
+    def get_total_time(self):
+        """
+        获取请求开始至今的耗时，单位秒
+        :return: float
+        """
+        return time.perf_counter() - self.start_time
+
+    def get_repeated_shapes(self, threshold):
+        """
+        获取重复次数超过阈值的查询形状
+        :param threshold: int, 重复次数阈值
+        :return: list, [(查询形状, 次数), ...]
+        """
+        return [(shape, count) for shape, count in self.shape_counter.most_common() if count > threshold]
+
+    def get_server_timing(self):
+        """
+        生成 Server-Timing 响应头
+        :return: str
+        """
+        timing_list = [
+            'total;dur=%.1f' % (self.get_total_time() * 1000),
+            'db;dur=%.1f;desc="%s queries"' % (self.db_time * 1000, self.query_count),
+        ]
+        for name in sorted(set(key[0] for key in self.cache_counter)):
+            timing_list.append('cache-%s;desc="hit %s miss %s"' % (
+                name, self.cache_counter[(name, True)], self.cache_counter[(name, False)]))
+        return ', '.join(timing_list)
+
+    def to_dict(self):
+        """
+        生成结构化的请求统计，用于慢请求日志
+        :return: dict
+        """
+        return {
+            'view': self.view,
+            'total_ms': round(self.get_total_time() * 1000, 1),
+            'db_ms': round(self.db_time * 1000, 1),
+            'query_count': self.query_count,
+            'repeated_shapes': self.get_repeated_shapes(1)[:5],
+            'cache': {'%s_%s' % (name, 'hit' if hit else 'miss'): count
+                      for (name, hit), count in self.cache_counter.items()},
+        }
+
+
+def start_request():
+    """
+    开始记录当前线程的请求
+    :return: RequestRecorder object
+    """
+    return attach(RequestRecorder())
+
+
+def attach(recorder):
+    """
+    将请求统计绑定到当前线程，并记录当前线程所有数据库连接执行的 sql
+    :param recorder: RequestRecorder object
+    :return: RequestRecorder object
+    """
+    _local.recorder = recorder
+    for alias in connections:
+        execute_wrappers = connections[alias].execute_wrappers
+        if recorder not in execute_wrappers:
+            execute_wrappers.append(recorder)
+    return recorder
+
+
+def detach():
+    """
+    解除当前线程绑定的请求统计，停止记录 sql
+    :return: RequestRecorder object，未绑定时为 None
+    """
+    recorder = getattr(_local, 'recorder', None)
+    _local.recorder = None
+    if not recorder:
+        return None
+
+    for alias in connections:
+        execute_wrappers = connections[alias].execute_wrappers
+        if recorder in execute_wrappers:
+            execute_wrappers.remove(recorder)
+    return recorder
+
+
+def end_request(recorder):
+    """
+    结束记录请求，汇总到进程内统计
+    :param recorder: RequestRecorder object
+    :return: RequestRecorder object
+    """
+    total_time = recorder.get_total_time()
+    with _stats_lock:
+        view_stats = _stats_dict.setdefault(recorder.view or 'unresolved', {
+            'requests': 0, 'queries': 0, 'max_queries': 0, 'db_ms': 0.0, 'total_ms': 0.0, 'max_total_ms': 0.0,
+            'cache_hit': 0, 'cache_miss': 0
+        })
+        view_stats['requests'] += 1
+        view_stats['queries'] += recorder.query_count
+        view_stats['max_queries'] = max(view_stats['max_queries'], recorder.query_count)
+        view_stats['db_ms'] += recorder.db_time * 1000
+        view_stats['total_ms'] += total_time * 1000
+        view_stats['max_total_ms'] = max(view_stats['max_total_ms'], total_time * 1000)
+        for (name, hit), count in recorder.cache_counter.items():
+            view_stats['cache_hit' if hit else 'cache_miss'] += count
+    return recorder
+
+
+def set_view(view):
+    """
+    设置当前请求的视图名
+    :param view: str, 视图名
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder:
+        recorder.view = view
+
+
+def record_cache(name, hit):
+    """
+    记录当前请求的一次缓存命中或未命中
+    :param name: str, 缓存名
+    :param hit: bool, 是否命中
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder:
+        recorder.cache_counter[(name, bool(hit))] += 1
+
+
+def get_stats_dict():
+    """
+    获取进程内按视图汇总的统计，附加平均值
+    :return: dict, {视图名: {统计项: 值, ...}, ...}
+    """
+    with _stats_lock:
+        stats_dict = {view: view_stats.copy() for view, view_stats in _stats_dict.items()}
+
+    for view_stats in stats_dict.values():
+        requests = view_stats['requests']
+        view_stats['avg_queries'] = round(view_stats['queries'] / requests, 1)
+        view_stats['avg_db_ms'] = round(view_stats['db_ms'] / requests, 1)
+        view_stats['avg_total_ms'] = round(view_stats['total_ms'] / requests, 1)
+        view_stats['db_ms'] = round(view_stats['db_ms'], 1)
+        view_stats['total_ms'] = round(view_stats['total_ms'], 1)
+        view_stats['max_total_ms'] = round(view_stats['max_total_ms'], 1)
+    return stats_dict
+
+
+def log_request(recorder):
+    """
+    请求结束时，记录慢请求日志和 N+1 查询警告
+    :param recorder: RequestRecorder object
+    """
+    total_ms = recorder.get_total_time() * 1000
+    if settings.SLOW_REQUEST_THRESHOLD and total_ms >= settings.SLOW_REQUEST_THRESHOLD:
+        logger.warning('slow request %s', tools.json_dumper(recorder.to_dict()))
+
+    threshold = settings.N_PLUS_ONE_THRESHOLD
+    if threshold:
+        for shape, count in recorder.get_repeated_shapes(threshold):
+            logger.warning('query repeated %s times in %s: %s', count, recorder.view, shape)
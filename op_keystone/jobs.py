@@ -0,0 +1,14 @@
+from utils import tools
+
+
+def replace_relations(job, request):
+    """
+    后台任务，替换来源对象的多对多关系
+    :param job: job object, 任务对象
+    :param request: JobRequest object, 还原的请求对象
+    :return: dict, 目标对象数量
+    """
+    params = job.get_params()
+    view = tools.import_string(params['view'])()
+    page_list = view.replace_relations(request, params['uuid'], params['uuid_list'])
+    return {'total': page_list['total']}
@@ -4,6 +4,104 @@ from op_keystone.base_view import BaseView
 from utils.dao import DAO
 from django.conf import settings
 from .auth_tools import AuthTools
+from .auth_cache import ActionIndex, PrincipalCache
+from . import db_router
+from . import instrumentation
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    """
+    记录请求的 sql 数量、数据库耗时、重复查询形状和缓存命中，通过 Server-Timing 响应头返回，
+    汇总到进程内统计，记录慢请求日志和 N+1 查询警告，需要位于中间件首位
+    """
+
+    def process_request(self, request):
+        if not settings.INSTRUMENTATION_ENABLED:
+            return
+        instrumentation.start_request()
+
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        view_name = getattr(callback, '__name__', callback.__class__.__name__)
+        instrumentation.set_view('%s %s.%s' % (request.method, callback.__module__, view_name))
+
+    def process_response(self, request, response):
+        recorder = instrumentation.detach()
+        if not recorder:
+            return response
+
+        # 流式响应的数据在中间件返回后才生成，统计在数据生成结束后汇总，不返回 Server-Timing 响应头
+        if response.streaming:
+            response.streaming_content = self.record_stream(response.streaming_content, recorder)
+            return response
+
+        instrumentation.end_request(recorder)
+        response['Server-Timing'] = recorder.get_server_timing()
+        instrumentation.log_request(recorder)
+        return response
+
+    @staticmethod
+    def record_stream(streaming_content, recorder):
+        """
+        生成流式响应的每块数据时重新绑定请求统计，数据生成结束或响应关闭时汇总统计
+        :param streaming_content: iterable, 流式响应内容
+        :param recorder: RequestRecorder object
+        :return: generator
+        """
+        iterator = iter(streaming_content)
+        try:
+            while True:
+                instrumentation.attach(recorder)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    instrumentation.detach()
+                yield chunk
+        finally:
+            instrumentation.end_request(recorder)
+            instrumentation.log_request(recorder)
+
+
+class ReplicaRouterMiddleware(MiddlewareMixin):
+    """
+    读写分离路由的请求中间件，请求开始时清空路由状态，路由前根据用户的读写窗口选择读库，需要位于鉴权中间件之前
+    """
+
+    def process_request(self, request):
+        db_router.reset()
+
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        user = getattr(request, 'user', None)
+        if user:
+            db_router.set_user(user.uuid)
+
+    def process_response(self, request, response):
+        # 流式响应的数据在中间件返回后才查询，生成每块数据时恢复本次请求的路由状态
+        if response.streaming:
+            response.streaming_content = self.route_stream(response.streaming_content, db_router.get_state())
+        db_router.reset()
+        return response
+
+    @staticmethod
+    def route_stream(streaming_content, state):
+        """
+        生成流式响应的每块数据时恢复请求的路由状态，生成后清空，保留生成过程中的主库标记
+        :param streaming_content: iterable, 流式响应内容
+        :param state: tuple, 请求的路由状态
+        :return: generator
+        """
+        iterator = iter(streaming_content)
+        while True:
+            db_router.set_state(state)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                state = db_router.get_state()
+                db_router.reset()
+            yield chunk
 
 
 class AuthMiddleware(MiddlewareMixin):
@@ -31,6 +129,20 @@ class AuthMiddleware(MiddlewareMixin):
             if not rq_token:
                 raise CredenceInvalid(empty=True)
 
+            # 签名 token 在本地校验，无需查询 token 表
+            if self._auth_tools.is_signed_token(rq_token):
+                try:
+                    request.user = self._auth_tools.get_principal_of_signed_token(rq_token)
+                except CustomException:
+                    raise CredenceInvalid()
+                return
+
+            # 优先从缓存获取 token 对应的用户快照，命中时无需查询数据库
+            principal = PrincipalCache.get(rq_token)
+            if principal:
+                request.user = principal
+                return
+
             try:
                 # 获取 token 对象，若为 service token 则返回
                 query_obj = self._token_model.parsing_query_str('type:0|2')
@@ -39,8 +151,8 @@ class AuthMiddleware(MiddlewareMixin):
                     request.service = self._service_model.get_obj(uuid=token_obj.carrier, enable=True)
                     return
 
-                # 获取 user 对象，并设置到请求对象中
-                request.user = self._auth_tools.get_user_of_token(token_obj)
+                # 获取用户快照，并设置到请求对象中
+                request.user = self._auth_tools.get_principal_of_token(token_obj)
 
             except CustomException:
                 raise CredenceInvalid()
@@ -67,7 +179,9 @@ class AuthMiddleware(MiddlewareMixin):
                 return
 
             # 整合服务和请求信息
-            service_uuid = self._service_model.get_obj(name='keystone').uuid
+            service_uuid = ActionIndex.get_service_uuid('keystone')
+            if not service_uuid:
+                raise CustomException()
             request_info = {
                 'url': request.path,
                 'method': request.method.lower(),
@@ -0,0 +1,87 @@
+from django.db import connection
+from django.db.models import Q
+from op_keystone.auth_tools import AuthTools
+from search.models import SearchSuffix
+from utils.dao import DAO
+from utils import tools
+
+
+def get_hot_queries():
+    """
+    构造 AuthMiddleware、AuthTools 和 DAO 实际发出的热点查询，只生成 sql 不执行
+    :return: list, [(名字, 查询集), ...]
+    """
+    token_model = DAO('credence.models.Token')
+    user_model = DAO('identity.models.User')
+    auth_tools = AuthTools()
+    uuid = '0' * 32
+
+    # 用户有效策略的合并查询，与 AuthTools 加载策略时的查询一致
+    user_role_qs = auth_tools._m2m_user_role_model.get_obj_qs(user=uuid).values('role')
+    user_group_qs = auth_tools._m2m_user_group_model.get_obj_qs(user=uuid).values('group')
+    group_qs = auth_tools._group_model.get_obj_qs(uuid__in=user_group_qs, enable=True).values('uuid')
+    group_role_qs = auth_tools._m2m_group_role_model.get_obj_qs(group__in=group_qs).values('role')
+    role_qs = auth_tools._role_model.get_obj_qs(
+        Q(uuid__in=user_role_qs) | Q(uuid__in=group_role_qs), enable=True).values('uuid')
+    policy_uuid_qs = auth_tools._m2m_role_policy_model.get_obj_qs(role__in=role_qs).values('policy')
+
+    hot_query_list = [
+        ('middleware token', token_model.get_obj_qs(token_model.parsing_query_str('type:0|2'), token=uuid)),
+        ('access token', token_model.get_obj_qs(token=uuid, type=0)),
+        ('user of token', user_model.get_obj_qs(uuid=uuid)),
+        ('users of domain', user_model.get_obj_qs(domain=uuid)),
+        ('policies of user', auth_tools._policy_model.get_obj_qs(uuid__in=policy_uuid_qs, enable=True)),
+        ('groups of user', DAO('identity.models.M2MUserGroup').get_obj_qs(user=uuid)),
+        ('users of group', DAO('identity.models.M2MUserGroup').get_obj_qs(group=uuid)),
+        ('roles of user', DAO('identity.models.M2MUserRole').get_obj_qs(user=uuid)),
+        ('users of role', DAO('identity.models.M2MUserRole').get_obj_qs(role=uuid)),
+        ('roles of group', DAO('identity.models.M2MGroupRole').get_obj_qs(group=uuid)),
+        ('groups of role', DAO('identity.models.M2MGroupRole').get_obj_qs(role=uuid)),
+        ('policies of role', DAO('assignment.models.M2MRolePolicy').get_obj_qs(role=uuid)),
+        ('roles of policy', DAO('assignment.models.M2MRolePolicy').get_obj_qs(policy=uuid)),
+        ('policies of action', DAO('assignment.models.Policy').get_obj_qs(action=uuid)),
+        ('policies of tpl role', DAO('assignment.models.Policy').get_obj_qs(role_based_tpl=uuid)),
+        ('roles of tpl', DAO('assignment.models.Role').get_obj_qs(tpl=uuid)),
+    ]
+
+    # 游标分页和流式响应按 (created_time, uuid) 查询游标之后的一页
+    cursor_time = tools.get_datetime_with_tz()
+    for label in ('identity.models.User', 'identity.models.Group', 'assignment.models.Role',
+                  'assignment.models.Policy', 'partition.models.Project', 'job.models.Job'):
+        model = DAO(label)
+        obj_qs = model.get_keyset_qs(model.get_obj_qs(), cursor_time, uuid)[:21]
+        hot_query_list.append(('cursor page of %s' % model.model.__name__, obj_qs))
+
+    # 启用后缀索引时，用户的自由文本查询也不应全表扫描
+    if SearchSuffix.is_enabled(user_model.model):
+        query_obj = user_model.parsing_query_str('abc', 'contains', url_params=True)
+        hot_query_list.append(('free text users', user_model.get_obj_qs(query_obj)))
+    return hot_query_list
+
+
+def explain(obj_qs):
+    """
+    获取查询集的执行计划
+    :param obj_qs: query set, 查询集
+    :return: list, mysql 为 [{列名: 值, ...}, ...]，sqlite 为 [计划描述, ...]
+    """
+    sql, params = obj_qs.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        if connection.vendor == 'sqlite':
+            return [row[-1] for row in cursor.fetchall()]
+
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def is_full_scan(plan):
+    """
+    判断执行计划的一行是否为全表扫描
+    :param plan: dict or str, 执行计划的一行
+    :return: bool
+    """
+    if connection.vendor == 'sqlite':
+        return plan.startswith('SCAN') and not plan.startswith(('SCAN SUBQUERY', 'SCAN CONSTANT'))
+    return plan.get('type') == 'ALL'
@@ -41,14 +41,18 @@ INSTALLED_APPS = [
     'partition',
     'credence',
     'catalog',
-    'assignment'
+    'assignment',
+    'job',
+    'search'
 ]
 
 MIDDLEWARE = [
+    'op_keystone.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'op_keystone.middleware.ReplicaRouterMiddleware',
     'op_keystone.middleware.AuthMiddleware',
 ]
 
@@ -61,6 +65,14 @@ ASGI_APPLICATION = 'op_keystone.routing.application'
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 DATABASES = MYSQL_CONFIG
 
+# Read replicas, aliases in DATABASES that serve reads, writes always go to 'default'.
+# After a request writes, reads of that request and of the same user within the window use 'default'.
+# e.g. two local sqlite databases, 'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'replica.sqlite3',
+# 'TEST': {'MIRROR': 'default'}} next to a sqlite 'default', the test mirror lets tests see the writes on reads
+DATABASE_ROUTERS = ['op_keystone.db_router.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_READ_YOUR_WRITES_WINDOW = 5
+
 # Cache
 CACHES = REDIS_CONFIG
 
@@ -142,3 +154,45 @@ POLICY_WHITE_LIST = [
     ('/identity/privilege-for-manage-actions/', 'get'),
     ('/identity/privilege-for-describe-actions/', 'get')
 ]
+
+# auth policy cache setting, timeout unit seconds
+AUTH_POLICY_CACHE_TIMEOUT = 5 * 60
+AUTH_POLICY_LRU_SIZE = 1024
+
+# auth principal cache setting, capped by the token expire date, unit seconds
+AUTH_PRINCIPAL_CACHE_TIMEOUT = 5 * 60
+
+# access token mode, 'opaque' checks the token table on every request,
+# 'signed' issues hmac signed tokens which are verified without the token table
+ACCESS_TOKEN_MODE = 'opaque'
+SIGNED_TOKEN_SECRET = SECRET_KEY
+
+# domain resource counts, 'counter' reads the domain_stats table kept by model hooks,
+# 'aggregate' computes counts with one grouped query per resource type
+DOMAIN_STATS_MODE = 'counter'
+
+# background job worker, poll interval, heartbeat interval of the running job, and requeue timeout of
+# running jobs without heartbeat, unit seconds
+# workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED on MySQL >= 8.0.1, on older MySQL and on
+# MariaDB they fall back to plain row locks and claim one after another
+JOB_WORKER_POLL_INTERVAL = 2
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_STALE_TIMEOUT = 5 * 60
+
+# soft deleted users older than these days are moved to the user_archive table in batches,
+# the job worker archives every USER_ARCHIVE_INTERVAL seconds, 0 to disable
+USER_ARCHIVE_DAYS = 90
+USER_ARCHIVE_BATCH_SIZE = 1000
+USER_ARCHIVE_INTERVAL = 0
+
+# free text queries on models with search index keys resolve through the search_suffix table and match
+# only the indexed keys, other keys are still queried with key:value, the index is not maintained while
+# disabled, run the rebuild_search_index command before enabling
+SEARCH_INDEX_ENABLED = False
+
+# per request query count, db time and cache hit instrumentation, returned in the Server-Timing header,
+# requests slower than SLOW_REQUEST_THRESHOLD milliseconds are logged, 0 to disable,
+# a query shape repeated more than N_PLUS_ONE_THRESHOLD times in one request is warned, 0 to disable
+INSTRUMENTATION_ENABLED = True
+SLOW_REQUEST_THRESHOLD = 1000
+N_PLUS_ONE_THRESHOLD = 0
@@ -0,0 +1,407 @@
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.conf import settings
+from credence.models import Token
+from identity.models import User, Group, M2MUserGroup, M2MUserRole, M2MGroupRole
+from assignment.models import Role, Policy, Action, M2MRolePolicy
+from catalog.models import Service
+from utils.dao import DAO
+from utils import tools
+from unittest import mock
+from .auth_tools import AuthTools
+from .auth_cache import ActionIndex, Principal, TokenRevocation
+from .base_view import BaseView
+from .exceptions import CustomException
+from .views import StatsView
+from .middleware import InstrumentationMiddleware, ReplicaRouterMiddleware
+from . import db_router
+from . import instrumentation
+from . import query_plans
+import os
+import shutil
+import tempfile
+
+
+class ReplicaRouterTestCase(TransactionTestCase):
+    """
+    读写分离路由，default 为主库，另配置一个 sqlite 从库，从库不同步主库的写入
+    """
+
+    def setUp(self):
+        cache.clear()
+        db_router.reset()
+
+        # 配置从库，并建立用户和 token 表
+        self.replica_dir = tempfile.mkdtemp()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(self.replica_dir, 'replica.sqlite3')
+        }
+        with connections['replica'].schema_editor() as editor:
+            editor.create_model(User)
+            editor.create_model(Token)
+
+        replica_settings = override_settings(DATABASE_REPLICAS=['replica'])
+        replica_settings.enable()
+        self.addCleanup(replica_settings.disable)
+
+    def tearDown(self):
+        db_router.reset()
+        connections['replica'].close()
+        del connections.databases['replica']
+        delattr(connections._connections, 'replica')
+        shutil.rmtree(self.replica_dir)
+
+    @staticmethod
+    def create_user(name):
+        return User.objects.create(uuid=tools.generate_unique_uuid(), email='%s@test.com' % name, phone=name,
+                                   username=name, domain='0' * 32, password='p', name=name, created_by='test')
+
+    def test_read_routing(self):
+        self.assertEqual(User.objects.all().db, 'replica')
+        self.assertEqual(Token.objects.all().db, 'default')
+
+        # 事务中的读操作使用主库
+        with transaction.atomic():
+            self.assertEqual(User.objects.all().db, 'default')
+
+    def test_token_read_from_primary(self):
+        # 登录请求签发 token，只写入主库
+        token = tools.generate_unique_uuid()
+        DAO(Token).create_obj(carrier='0' * 32, token=token, type=0,
+                              expire_date=tools.get_datetime_with_tz(minutes=10))
+        self.assertFalse(Token.objects.using('replica').filter(token=token).exists())
+
+        # 下一个请求鉴权时，用户尚未确定，token 查询使用主库
+        db_router.reset()
+        self.assertEqual(DAO(Token).get_obj(token=token).carrier, '0' * 32)
+
+    def test_read_your_writes(self):
+        # 用户的请求写入后，本次请求的读操作使用主库
+        db_router.set_user('a' * 32)
+        user_obj = self.create_user('u')
+        self.assertTrue(db_router.is_pinned())
+        self.assertTrue(User.objects.filter(uuid=user_obj.uuid).exists())
+
+        # 读写窗口内，同一用户的请求读主库，其他用户的请求读从库
+        db_router.reset()
+        db_router.set_user('a' * 32)
+        self.assertTrue(User.objects.filter(uuid=user_obj.uuid).exists())
+
+        db_router.reset()
+        db_router.set_user('b' * 32)
+        self.assertFalse(User.objects.filter(uuid=user_obj.uuid).exists())
+
+        # 读写窗口过期后，同一用户的请求读从库
+        cache.clear()
+        db_router.reset()
+        db_router.set_user('a' * 32)
+        self.assertFalse(User.objects.filter(uuid=user_obj.uuid).exists())
+
+
+class ActionIndexTestCase(TransactionTestCase):
+    """
+    动作索引的失效在事务提交后进行，回滚时不失效
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.service = Service.objects.create(uuid=tools.generate_unique_uuid(), name='keystone', function='f',
+                                              created_by='test')
+        # 预先建立进程内索引
+        ActionIndex.get_action('0' * 32)
+
+    def create_action(self):
+        action = Action.objects.create(uuid=tools.generate_unique_uuid(), name='a', service=self.service.uuid,
+                                       url='^/a/$', method='get', created_by='test')
+        ActionIndex.invalidate()
+        return action
+
+    def test_invalidate_commit(self):
+        with transaction.atomic():
+            action = self.create_action()
+            self.assertIsNone(ActionIndex.get_action(action.uuid))
+        self.assertEqual(ActionIndex.get_action(action.uuid).name, 'a')
+
+    def test_invalidate_rollback(self):
+        version = cache.get(ActionIndex._version_key)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.create_action()
+                raise RuntimeError()
+        self.assertEqual(cache.get(ActionIndex._version_key), version)
+
+
+class LoadPoliciesTestCase(TestCase):
+    """
+    加载用户有效策略的查询数与组、角色数量无关
+    """
+
+    def setUp(self):
+        self.domain_uuid = '0' * 32
+        self.user = User.objects.create(uuid=tools.generate_unique_uuid(), email='u@test.com', phone='1',
+                                        username='u', domain=self.domain_uuid, password='p', name='u',
+                                        created_by='test')
+
+    def create(self, model, **field_opts):
+        return model.objects.create(uuid=tools.generate_unique_uuid(), domain=self.domain_uuid,
+                                    created_by='test', **field_opts)
+
+    def create_role(self, enable=True):
+        role_obj = self.create(Role, name=tools.generate_unique_uuid(), enable=enable)
+        policy_obj = self.create(Policy, name=tools.generate_unique_uuid(), action='a', res='x,y', effect='allow')
+        M2MRolePolicy.objects.create(role=role_obj.uuid, policy=policy_obj.uuid)
+        return role_obj
+
+    def grant(self, count):
+        """
+        为用户直接关联角色，并通过组关联角色，每个角色关联一个策略
+        :param count: int, 直接关联的角色数和组数
+        """
+        for i in range(count):
+            M2MUserRole.objects.create(user=self.user.uuid, role=self.create_role().uuid)
+
+            group_obj = self.create(Group, name=tools.generate_unique_uuid())
+            M2MUserGroup.objects.create(user=self.user.uuid, group=group_obj.uuid)
+            M2MGroupRole.objects.create(group=group_obj.uuid, role=self.create_role().uuid)
+
+        # 禁用的组和角色不生效
+        group_obj = self.create(Group, name=tools.generate_unique_uuid(), enable=False)
+        M2MUserGroup.objects.create(user=self.user.uuid, group=group_obj.uuid)
+        M2MGroupRole.objects.create(group=group_obj.uuid, role=self.create_role().uuid)
+        M2MUserRole.objects.create(user=self.user.uuid, role=self.create_role(enable=False).uuid)
+
+    def assert_policies(self, count):
+        with self.assertNumQueries(1):
+            policy_obj_list = AuthTools()._load_policies_of_user(self.user)
+        self.assertEqual(len(policy_obj_list), count * 2)
+        self.assertEqual(policy_obj_list[0].res_set, frozenset(['x', 'y']))
+
+    def test_one_group_and_role(self):
+        self.grant(1)
+        self.assert_policies(1)
+
+    def test_many_groups_and_roles(self):
+        self.grant(10)
+        self.assert_policies(10)
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    鉴权和 DAO 的热点查询在测试数据库上不进行全表扫描
+    """
+
+    def assert_no_full_scan(self):
+        for name, obj_qs in query_plans.get_hot_queries():
+            plan_list = query_plans.explain(obj_qs)
+            scan_list = [plan for plan in plan_list if query_plans.is_full_scan(plan)]
+            self.assertFalse(scan_list, '%s: %s' % (name, plan_list))
+
+    def test_hot_queries(self):
+        self.assert_no_full_scan()
+
+    @override_settings(SEARCH_INDEX_ENABLED=True)
+    def test_hot_queries_with_search_index(self):
+        self.assertIn('free text users', [name for name, _ in query_plans.get_hot_queries()])
+        self.assert_no_full_scan()
+
+
+@override_settings(INSTRUMENTATION_ENABLED=True)
+class StreamResponseTestCase(TestCase):
+    """
+    流式响应在中间件返回后生成数据，生成时仍使用请求的路由状态并计入请求统计
+    """
+
+    def setUp(self):
+        domain_uuid = tools.generate_unique_uuid()
+        for i in range(5):
+            Group.objects.create(uuid=tools.generate_unique_uuid(), name='g%s' % i, domain=domain_uuid,
+                                 created_by='test')
+        self.pinned_list = []
+
+    def view(self, request):
+        # 请求中写入数据后，本次请求的读操作使用主库
+        db_router.pin_primary()
+
+        def data_iter():
+            for d in DAO(Group).iter_serialize(chunk_size=2):
+                self.pinned_list.append(db_router.is_pinned())
+                yield d
+        return BaseView.stream_response(data_iter(), 'ndjson')
+
+    def test_stream(self):
+        request = RequestFactory().get('/groups/')
+        middleware = InstrumentationMiddleware(ReplicaRouterMiddleware(self.view))
+        requests = instrumentation.get_stats_dict().get('unresolved', {}).get('requests', 0)
+
+        response = middleware(request)
+        self.assertTrue(response.streaming)
+        self.assertNotIn('Server-Timing', response)
+        self.assertFalse(db_router.is_pinned())
+        self.assertEqual(self.pinned_list, [])
+
+        # 读取响应内容时生成数据，5 条数据分 3 次查询
+        with self.assertNumQueries(3):
+            content = b''.join(response.streaming_content)
+        self.assertEqual(len(content.splitlines()), 5)
+        self.assertEqual(self.pinned_list, [True] * 5)
+        self.assertFalse(db_router.is_pinned())
+
+        view_stats = instrumentation.get_stats_dict()['unresolved']
+        self.assertEqual(view_stats['requests'], requests + 1)
+        self.assertGreaterEqual(view_stats['max_queries'], 3)
+
+
+@override_settings(ACCESS_TOKEN_MODE='signed')
+class SignedTokenTestCase(TestCase):
+    """
+    签名 token 在本地校验签名、过期时间和吊销列表，无需查询数据库
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.principal = Principal(tools.generate_unique_uuid(), 'u', tools.generate_unique_uuid(), False, 3)
+        self.expire_date = tools.get_datetime_with_tz(minutes=10)
+
+    def sign(self, secret=None, **payload_opts):
+        payload = {
+            'uuid': self.principal.uuid,
+            'name': self.principal.name,
+            'domain': self.principal.domain,
+            'is_main': self.principal.is_main,
+            'level': self.principal.level,
+            'iat': tools.datetime_to_timestamp(),
+            'exp': self.expire_date.timestamp()
+        }
+        payload.update(payload_opts)
+        return tools.sign_token(payload, secret or settings.SIGNED_TOKEN_SECRET)
+
+    def assert_invalid(self, rq_token):
+        with self.assertRaises(CustomException):
+            AuthTools().get_principal_of_access_token(rq_token)
+
+    def test_principal(self):
+        rq_token = AuthTools.generate_signed_token(self.principal, self.expire_date)
+        self.assertTrue(AuthTools.is_signed_token(rq_token))
+        with self.assertNumQueries(0):
+            principal = AuthTools().get_principal_of_access_token(rq_token)
+        for field in ('uuid', 'name', 'domain', 'is_main', 'level'):
+            self.assertEqual(getattr(principal, field), getattr(self.principal, field))
+
+    @override_settings(ACCESS_TOKEN_MODE='opaque')
+    def test_opaque_mode(self):
+        self.assertFalse(AuthTools.is_signed_token(self.sign()))
+
+    def test_invalid(self):
+        rq_token = self.sign()
+        payload_str, signature_str = rq_token.split('.')
+        self.assert_invalid(self.sign(secret='other secret'))
+        self.assert_invalid(payload_str + '.' + signature_str[::-1])
+        self.assert_invalid(self.sign(level=1).split('.')[0] + '.' + signature_str)
+        self.assert_invalid(rq_token + '.x')
+        self.assert_invalid(tools.sign_token(['x'], settings.SIGNED_TOKEN_SECRET))
+        self.assert_invalid(tools.sign_token({'uuid': self.principal.uuid}, settings.SIGNED_TOKEN_SECRET))
+
+    def test_expired(self):
+        self.assert_invalid(self.sign(exp=tools.datetime_to_timestamp() - 1))
+
+    def test_revoke_user(self):
+        issued_timestamp = tools.datetime_to_timestamp() - 1
+        TokenRevocation.revoke_user(self.principal.uuid)
+
+        # 吊销前签发的 token 无效，吊销后签发的 token 有效，其他用户不受影响
+        self.assert_invalid(self.sign(iat=issued_timestamp))
+        AuthTools().get_principal_of_access_token(self.sign(iat=issued_timestamp + 2))
+        AuthTools().get_principal_of_access_token(self.sign(iat=issued_timestamp, uuid=tools.generate_unique_uuid()))
+
+    def test_revoke_domain(self):
+        issued_timestamp = tools.datetime_to_timestamp() - 1
+        TokenRevocation.revoke_domain(self.principal.domain)
+        self.assert_invalid(self.sign(iat=issued_timestamp))
+        self.assert_invalid(self.sign(iat=issued_timestamp, uuid=tools.generate_unique_uuid()))
+        AuthTools().get_principal_of_access_token(self.sign(iat=issued_timestamp + 2))
+        AuthTools().get_principal_of_access_token(self.sign(iat=issued_timestamp,
+                                                            domain=tools.generate_unique_uuid()))
+
+
+@override_settings(INSTRUMENTATION_ENABLED=True, SLOW_REQUEST_THRESHOLD=0, N_PLUS_ONE_THRESHOLD=0)
+class InstrumentationTestCase(TestCase):
+    """
+    请求的 sql 数量、重复查询形状和缓存命中统计，Server-Timing 响应头，以及按视图汇总的统计接口
+    """
+
+    def setUp(self):
+        patcher = mock.patch.dict(instrumentation._stats_dict, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        domain_uuid = tools.generate_unique_uuid()
+        self.uuid_list = [Group.objects.create(uuid=tools.generate_unique_uuid(), name='g%s' % i,
+                                               domain=domain_uuid, created_by='test').uuid for i in range(3)]
+
+    def view(self, request):
+        # 逐个查询组，IN 列表中数量不同的查询属于同一形状
+        for uuid in self.uuid_list:
+            Group.objects.get(uuid=uuid)
+        list(Group.objects.filter(uuid__in=self.uuid_list[:1]))
+        list(Group.objects.filter(uuid__in=self.uuid_list))
+        instrumentation.record_cache('policy', True)
+        instrumentation.record_cache('policy', False)
+        instrumentation.record_cache('principal', True)
+        return BaseView.standard_response('success')
+
+    def request(self):
+        request = RequestFactory().get('/groups/')
+        middleware = InstrumentationMiddleware(self.view)
+        middleware.process_request(request)
+        middleware.process_view(request, self.view, (), {})
+        return middleware.process_response(request, self.view(request))
+
+    def test_server_timing(self):
+        response = self.request()
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="5 queries"', response['Server-Timing'])
+        self.assertIn('cache-policy;desc="hit 1 miss 1"', response['Server-Timing'])
+        self.assertIn('cache-principal;desc="hit 1 miss 0"', response['Server-Timing'])
+
+        # 请求结束后不再记录当前线程的 sql
+        self.assertFalse(any(isinstance(w, instrumentation.RequestRecorder)
+                             for w in connections['default'].execute_wrappers))
+
+    def test_stats(self):
+        for _ in range(2):
+            self.request()
+        view_stats = instrumentation.get_stats_dict()['GET %s.view' % __name__]
+        self.assertEqual(view_stats['requests'], 2)
+        self.assertEqual(view_stats['queries'], 10)
+        self.assertEqual(view_stats['max_queries'], 5)
+        self.assertEqual(view_stats['avg_queries'], 5)
+        self.assertEqual((view_stats['cache_hit'], view_stats['cache_miss']), (4, 2))
+
+        res = tools.json_loader(StatsView.as_view()(RequestFactory().get('/stats/')).content)
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(res['data']['GET %s.view' % __name__], view_stats)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0.001, N_PLUS_ONE_THRESHOLD=2)
+    def test_log(self):
+        with self.assertLogs(instrumentation.logger, 'WARNING') as logs:
+            self.request()
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('slow request', logs.output[0])
+        self.assertIn('"query_count": 5', logs.output[0])
+        self.assertIn('query repeated 3 times', logs.output[1])
+
+    def test_repeated_shapes(self):
+        recorder = instrumentation.start_request()
+        try:
+            self.view(None)
+        finally:
+            instrumentation.detach()
+        self.assertEqual([count for _, count in recorder.get_repeated_shapes(1)], [3, 2])
+
+    @override_settings(INSTRUMENTATION_ENABLED=False)
+    def test_disabled(self):
+        response = self.request()
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(instrumentation.get_stats_dict(), {})
@@ -1,12 +1,15 @@
 from django.urls import path, include
 from .base_view import BaseView
+from .views import StatsView
 from .exceptions import *
 
 urlpatterns = [
     path(r'identity/', include('identity.urls')),
     path(r'partition/', include('partition.urls')),
     path(r'catalog/', include('catalog.urls')),
-    path(r'assignment/', include('assignment.urls'))
+    path(r'assignment/', include('assignment.urls')),
+    path(r'job/', include('job.urls')),
+    path(r'stats/', StatsView.as_view())
 ]
 
 
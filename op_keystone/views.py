@@ -0,0 +1,16 @@
+from .base_view import BaseView
+from .exceptions import CustomException
+from . import instrumentation
+
+
+class StatsView(BaseView):
+    """
+    当前进程按视图汇总的请求数、sql 数量、耗时和缓存命中统计
+    """
+
+    def get(self, request):
+        try:
+            return self.standard_response(instrumentation.get_stats_dict())
+
+        except CustomException as e:
+            return self.exception_to_response(e)
@@ -0,0 +1,91 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.utils import Error
+from op_keystone.auth_cache import PolicyCache
+from op_keystone.exceptions import DatabaseError
+from utils.dao import DAO
+from utils import tools
+
+
+class DomainCascade:
+    """
+    域删除的级联计划，预先计算每个表受影响的数据，在一个事务中按表批量进行软删除和硬删除
+    """
+
+    def __init__(self, domain_uuid):
+        """
+        初始化级联计划
+        :param domain_uuid: str, 被删除的域 uuid
+        """
+        self.domain_uuid = domain_uuid
+
+    def get_plan(self):
+        """
+        生成级联计划，关联关系表在资源表之前删除
+        :return: list, [(表名, 查询集, 是否软删除), ...]
+        """
+        user_qs = DAO('identity.models.User').get_obj_qs(domain=self.domain_uuid)
+        group_qs = DAO('identity.models.Group').get_obj_qs(domain=self.domain_uuid)
+        role_qs = DAO('assignment.models.Role').get_obj_qs(domain=self.domain_uuid)
+        policy_qs = DAO('assignment.models.Policy').get_obj_qs(domain=self.domain_uuid)
+
+        user_uuid_qs = user_qs.values('uuid')
+        group_uuid_qs = group_qs.values('uuid')
+        role_uuid_qs = role_qs.values('uuid')
+        policy_uuid_qs = policy_qs.values('uuid')
+
+        return [
+            ('m2m_user_group', DAO('identity.models.M2MUserGroup').get_obj_qs(
+                Q(user__in=user_uuid_qs) | Q(group__in=group_uuid_qs)), False),
+            ('m2m_user_role', DAO('identity.models.M2MUserRole').get_obj_qs(
+                Q(user__in=user_uuid_qs) | Q(role__in=role_uuid_qs)), False),
+            ('m2m_group_role', DAO('identity.models.M2MGroupRole').get_obj_qs(
+                Q(group__in=group_uuid_qs) | Q(role__in=role_uuid_qs)), False),
+            ('m2m_role_policy', DAO('assignment.models.M2MRolePolicy').get_obj_qs(
+                Q(role__in=role_uuid_qs) | Q(policy__in=policy_uuid_qs)), False),
+            ('project', DAO('partition.models.Project').get_obj_qs(domain=self.domain_uuid), False),
+            ('user', user_qs, True),
+            ('group', group_qs, False),
+            ('role', role_qs, False),
+            ('policy', policy_qs, False),
+            ('role_tpl', DAO('assignment.models.RoleTpl').get_obj_qs(domain=self.domain_uuid), False),
+        ]
+
+    @staticmethod
+    def soft_delete(obj_qs):
+        """
+        软删除查询集中的对象，与批量删除一致同时更新修改时间，并调用模型的批量删除后钩子，
+        域下的主用户一并删除，因此不进行批量删除前的检查
+        :param obj_qs: query set, 查询集
+        :return: int, 删除数量
+        """
+        obj_list = list(obj_qs.only('uuid', 'domain'))
+        if not obj_list:
+            return 0
+
+        deleted_time = tools.get_datetime_with_tz()
+        deleted_count = obj_qs.update(deleted_time=deleted_time, updated_time=deleted_time)
+        obj_qs.model.post_bulk_delete(obj_list)
+        return deleted_count
+
+    def execute(self):
+        """
+        在一个事务中执行级联计划，用户进行软删除，其余表进行硬删除，域下的主用户一并删除
+        :return: dict, {表名: 删除数量, ...}
+        """
+        count_dict = {}
+
+        try:
+            with transaction.atomic():
+                for table, obj_qs, soft in self.get_plan():
+                    if soft:
+                        count_dict[table] = self.soft_delete(obj_qs)
+                    else:
+                        count_dict[table] = obj_qs.delete()[0]
+        except Error as e:
+            msg = e.args[1]
+            raise DatabaseError(msg, 'Domain') from e
+
+        # 角色、策略和关联关系变化，失效所有用户的策略缓存，在外层事务中调用时于提交后进行
+        PolicyCache.invalidate_all()
+        return count_dict
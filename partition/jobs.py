@@ -0,0 +1,11 @@
+from .views import DomainsView
+
+
+def delete_domain(job, request):
+    """
+    后台任务，级联删除域
+    :param job: job object, 任务对象
+    :param request: JobRequest object, 还原的请求对象
+    :return: dict, {表名: 删除数量, ...}
+    """
+    return DomainsView().delete_domain(request, job.get_params()['uuid'])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from partition.models import DomainStats
+
+
+class Command(BaseCommand):
+    """
+    通过聚合查询重新计算域的资源计数，修正增量计数的偏差，可定期执行
+    """
+    help = 'Recompute the resource counts in the domain_stats table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('domain', nargs='*', help='domain uuid list, all domains if empty')
+
+    def handle(self, *args, **options):
+        domain_uuid_list = options['domain'] or None
+        reconciled_count = DomainStats.reconcile(domain_uuid_list)
+        self.stdout.write('reconciled stats of %s domains' % reconciled_count)
@@ -1,7 +1,11 @@
-from op_keystone.base_model import ResourceModel
+from op_keystone.base_model import BaseModel, ResourceModel
+from op_keystone.auth_cache import PrincipalCache, TokenRevocation
 from django.db import models
+from django.db.models import F, Count
+from django.conf import settings
 from op_keystone.exceptions import *
 from utils.dao import DAO
+from partition.cascade import DomainCascade
 
 
 class Domain(ResourceModel):
@@ -9,6 +13,9 @@ class Domain(ResourceModel):
     class Meta:
         verbose_name = '域'
         db_table = 'domain'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='domain_created_uuid_idx')
+        ]
         ordering=('-is_main',)
 
     # 必要字段
@@ -21,6 +28,9 @@ class Domain(ResourceModel):
     enable = models.BooleanField(default=True, verbose_name='是否启用')
     comment = models.CharField(max_length=512, null=True, verbose_name='备注信息')
 
+    # 签名 token 中用户快照依赖的域字段，变化时需要吊销域下已签发的 token
+    snapshot_fields = ('is_main', 'enable')
+
     def pre_create(self):
         """
         创建前，检查是否为 main domain 的存在，不存在则自动创建，存在自动阻止创建，存在多个则报错
@@ -38,9 +48,11 @@ class Domain(ResourceModel):
 
     def pre_update(self):
         """
-        更新前，main domain 的 enable 只为 true ，检查是否 main domain 的存在
+        更新前，main domain 的 enable 只为 true ，检查是否 main domain 的存在，记录用户快照依赖字段的原值
         :return:
         """
+        self.snapshot_origin_dict = Domain.objects.filter(pk=self.pk).values(*self.snapshot_fields).first() or {}
+
         main_domain_qs = DAO('partition.models.Domain').get_obj_qs(is_main=True)
         main_domain_count = main_domain_qs.count()
         if main_domain_count < 1:
@@ -52,33 +64,80 @@ class Domain(ResourceModel):
 
     def pre_delete(self):
         """
-        删除前，检查是否为 main 对象，删除对象的对外关联
+        删除前，检查是否为 main 对象，通过级联计划批量删除对象的对外关联，记录每个表的删除数量
         :return:
         """
         if self.is_main:
             raise DatabaseError('this is main domain', self.__class__.__name__)
-        DAO('partition.models.Project').delete_obj_qs(domain=self.uuid)
-        DAO('identity.models.User').delete_obj_qs(domain=self.uuid)
-        DAO('identity.models.Group').delete_obj_qs(domain=self.uuid)
-        DAO('assignment.models.Role').delete_obj_qs(domain=self.uuid)
-        DAO('assignment.models.Policy').delete_obj_qs(domain=self.uuid)
+        self.cascade_count_dict = DomainCascade(self.uuid).execute()
 
-    def serialize(self):
+    @classmethod
+    def validate_bulk_delete(cls, obj_list):
+        """
+        批量删除前，检查是否为主域
+        """
+        return {obj.uuid: DatabaseError('this is main domain', cls.__name__) for obj in obj_list if obj.is_main}
+
+    def post_create(self):
+        """
+        创建后，创建域的资源计数对象
+        """
+        DomainStats.objects.get_or_create(domain=self.uuid)
+
+    def post_update(self):
+        """
+        更新后，失效域下用户 token 的用户快照缓存，域的启用状态和是否为主影响用户，变化时吊销签名 token
+        """
+        PrincipalCache.invalidate_domain(self.uuid)
+        origin_dict = getattr(self, 'snapshot_origin_dict', {})
+        if any(getattr(self, k) != v for k, v in origin_dict.items()):
+            TokenRevocation.revoke_domain(self.uuid)
+
+    def post_delete(self):
+        """
+        删除后，失效域下用户 token 的用户快照缓存，吊销签名 token
+        """
+        PrincipalCache.invalidate_domain(self.uuid)
+        TokenRevocation.revoke_domain(self.uuid)
+        DomainStats.objects.filter(domain=self.uuid).delete()
+
+    def serialize(self, fields=None, stats=None):
         """
         对象序列化
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :param stats: dict, 已查询的资源计数字典，为空时单独查询
         :return: dict
         """
-        d = super().serialize()
+        d = super().serialize(fields)
 
-        # 附加信息
-        d['project_count'] = Project.objects.filter(domain=self.uuid).count()
-        d['user_count'] = DAO('identity.models.User').get_obj_qs(domain=self.uuid).count()
-        d['group_count'] = DAO('identity.models.Group').get_obj_qs(domain=self.uuid).count()
-        d['custom_role_count'] = DAO('assignment.models.Role').get_obj_qs(domain=self.uuid, builtin=False).count()
-        d['custom_policy_count'] = DAO('assignment.models.Policy').get_obj_qs(domain=self.uuid, builtin=False).count()
-        d['custom_role_tpl_count'] = DAO('assignment.models.RoleTpl').get_obj_qs(domain=self.uuid, builtin=False).count()
+        # 附加信息，仅在需要时查询计数
+        count_fields = [f for f in self.get_extra_fields() if fields is None or f in fields]
+        if count_fields:
+            if stats is None:
+                stats = DomainStats.get_stats_dict([self.uuid]).get(self.uuid, {})
+            for f in count_fields:
+                d[f] = stats.get(f, 0)
         return d
 
+    @classmethod
+    def serialize_list(cls, obj_list, fields=None):
+        """
+        对象列表序列化，一次性查询所有域的资源计数
+        :param obj_list: list|query set, 对象列表
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: list, [dict, ...]
+        """
+        if fields is not None and not set(fields) & set(cls.get_extra_fields()):
+            return super().serialize_list(obj_list, fields)
+
+        obj_list = list(obj_list)
+        stats_dict = DomainStats.get_stats_dict([obj.uuid for obj in obj_list])
+        return [obj.serialize(fields, stats=stats_dict.get(obj.uuid, {})) for obj in obj_list]
+
+    @classmethod
+    def get_extra_fields(cls):
+        return DomainStats.get_count_fields()
+
     @staticmethod
     def get_field_opts(create=True):
         """
@@ -104,6 +163,9 @@ class Project(ResourceModel):
     class Meta:
         verbose_name = '项目'
         db_table = 'project'
+        indexes = [
+            models.Index(fields=['created_time', 'uuid'], name='project_created_uuid_idx')
+        ]
         ordering = ('domain',)
         unique_together = ('domain', 'name')
 
@@ -122,11 +184,31 @@ class Project(ResourceModel):
         super().pre_create()
         DAO('partition.models.Domain').get_obj(uuid=self.domain)
 
+    def post_create(self):
+        """
+        创建后，增加域的项目计数
+        """
+        DomainStats.count_obj(self, 1)
+
     def pre_update(self):
         """
-        更新前，检查 domain 是否存在
+        更新前，检查 domain 是否存在，域变化时转移项目计数
         """
         DAO('partition.models.Domain').get_obj(uuid=self.domain)
+        DomainStats.count_update(self)
+
+    def post_delete(self):
+        """
+        删除后，减少域的项目计数
+        """
+        DomainStats.count_obj(self, -1)
+
+    @classmethod
+    def post_bulk_delete(cls, obj_list):
+        """
+        批量删除后，合并减少域的项目计数
+        """
+        DomainStats.count_obj_list(obj_list, -1)
 
     @staticmethod
     def get_field_opts(create=True):
@@ -146,3 +228,220 @@ class Project(ResourceModel):
     @classmethod
     def get_default_query_keys(cls):
         return ['name', 'domain'] + super().get_default_query_keys()
+
+
+class DomainStats(BaseModel):
+
+    class Meta:
+        verbose_name = '域资源计数'
+        db_table = 'domain_stats'
+
+    # 逻辑生成字段
+    domain = models.CharField(max_length=32, primary_key=True, verbose_name='域UUID')
+    project_count = models.IntegerField(default=0, verbose_name='项目数')
+    user_count = models.IntegerField(default=0, verbose_name='用户数')
+    group_count = models.IntegerField(default=0, verbose_name='用户组数')
+    custom_role_count = models.IntegerField(default=0, verbose_name='自定义角色数')
+    custom_policy_count = models.IntegerField(default=0, verbose_name='自定义策略数')
+    custom_role_tpl_count = models.IntegerField(default=0, verbose_name='自定义角色模版数')
+
+    # 计数的资源模型，对应的计数字段，以及是否只计数非内置资源
+    counted_models = {
+        'Project': ('partition.models.Project', 'project_count', False),
+        'User': ('identity.models.User', 'user_count', False),
+        'Group': ('identity.models.Group', 'group_count', False),
+        'Role': ('assignment.models.Role', 'custom_role_count', True),
+        'Policy': ('assignment.models.Policy', 'custom_policy_count', True),
+        'RoleTpl': ('assignment.models.RoleTpl', 'custom_role_tpl_count', True),
+    }
+
+    def serialize(self, fields=None):
+        """
+        对象序列化
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: dict
+        """
+        d = self.__dict__.copy()
+        del d['_state']
+        del d['domain']
+
+        if fields is not None:
+            d = {k: v for k, v in d.items() if k in fields}
+        return d
+
+    @classmethod
+    def get_count_fields(cls):
+        """
+        获取所有计数字段
+        :return: list
+        """
+        return [field for _, field, _ in cls.counted_models.values()]
+
+    @classmethod
+    def get_counted_field(cls, obj):
+        """
+        获取资源对象对应的计数字段，内置资源不计数时返回空
+        :param obj: model object, 资源对象
+        :return: str
+        """
+        _, field, custom_only = cls.counted_models[obj.__class__.__name__]
+        if custom_only and obj.builtin:
+            return None
+        return field
+
+    @classmethod
+    def incr(cls, domain_uuid, field, delta=1):
+        """
+        增量更新域的指定计数，计数对象不存在时跳过，读取时通过聚合查询重建，
+        更新前钩子中调用时资源尚未保存，此时重建会丢失本次增量
+        :param domain_uuid: str, 域 uuid
+        :param field: str, 计数字段
+        :param delta: int, 增量
+        """
+        cls.objects.filter(domain=domain_uuid).update(**{field: F(field) + delta})
+
+    @classmethod
+    def count_obj(cls, obj, delta):
+        """
+        资源对象创建或删除后，更新所属域的计数
+        :param obj: model object, 资源对象
+        :param delta: int, 增量
+        """
+        field = cls.get_counted_field(obj)
+        if field and obj.domain:
+            cls.incr(obj.domain, field, delta)
+
+    @classmethod
+    def count_obj_list(cls, obj_list, sign):
+        """
+        资源对象批量创建或删除后，按域合并后更新计数
+        :param obj_list: list, 资源对象列表
+        :param sign: int, 1 为增加，-1 为减少
+        """
+        delta_dict = {}
+        for obj in obj_list:
+            field = cls.get_counted_field(obj)
+            if field and obj.domain:
+                delta_dict[(obj.domain, field)] = delta_dict.get((obj.domain, field), 0) + sign
+
+        for (domain_uuid, field), delta in delta_dict.items():
+            cls.incr(domain_uuid, field, delta)
+
+    @classmethod
+    def count_update(cls, obj):
+        """
+        资源对象更新前，比较数据库中的原值，域或是否内置变化时转移计数
+        :param obj: model object, 资源对象
+        """
+        _, field, custom_only = cls.counted_models[obj.__class__.__name__]
+        origin_fields = ['domain', 'builtin'] if custom_only else ['domain']
+        origin_dict = obj.__class__.objects.filter(pk=obj.pk).values(*origin_fields).first()
+        if not origin_dict:
+            return
+
+        origin_field = None if custom_only and origin_dict['builtin'] else field
+        new_field = cls.get_counted_field(obj)
+        if (origin_dict['domain'], origin_field) == (obj.domain, new_field):
+            return
+
+        if origin_field:
+            cls.incr(origin_dict['domain'], origin_field, -1)
+        if new_field:
+            cls.incr(obj.domain, new_field, 1)
+
+    @classmethod
+    def count_update_list(cls, obj_list):
+        """
+        资源对象批量更新前，一次性查询数据库中的原值，按域合并转移的计数
+        :param obj_list: list, 资源对象列表
+        """
+        if not obj_list:
+            return
+        model = obj_list[0].__class__
+        _, field, custom_only = cls.counted_models[model.__name__]
+        origin_fields = ['domain', 'builtin'] if custom_only else ['domain']
+        origin_dict = {row.pop('pk'): row for row in model.objects.filter(
+            pk__in=[obj.pk for obj in obj_list]).values('pk', *origin_fields)}
+
+        delta_dict = {}
+        for obj in obj_list:
+            origin = origin_dict.get(obj.pk)
+            if not origin:
+                continue
+
+            origin_field = None if custom_only and origin['builtin'] else field
+            new_field = cls.get_counted_field(obj)
+            if (origin['domain'], origin_field) == (obj.domain, new_field):
+                continue
+
+            if origin_field:
+                delta_dict[(origin['domain'], origin_field)] = delta_dict.get((origin['domain'], origin_field), 0) - 1
+            if new_field:
+                delta_dict[(obj.domain, new_field)] = delta_dict.get((obj.domain, new_field), 0) + 1
+
+        for (domain_uuid, field), delta in delta_dict.items():
+            if delta:
+                cls.incr(domain_uuid, field, delta)
+
+    @classmethod
+    def aggregate_stats_dict(cls, domain_uuid_list=None):
+        """
+        通过每种资源一次分组聚合查询，计算域的资源计数
+        :param domain_uuid_list: list, 域 uuid 列表，为空时计算所有域
+        :return: dict, {domain_uuid: {field: count, ...}, ...}
+        """
+        stats_dict = {}
+        for model, field, custom_only in cls.counted_models.values():
+            obj_qs = DAO(model).get_obj_qs()
+            if custom_only:
+                obj_qs = obj_qs.filter(builtin=False)
+            if domain_uuid_list is not None:
+                obj_qs = obj_qs.filter(domain__in=domain_uuid_list)
+
+            for row in obj_qs.order_by().values('domain').annotate(count=Count('pk')):
+                stats_dict.setdefault(row['domain'], {})[field] = row['count']
+
+        # 补全没有资源的域和计数字段
+        if domain_uuid_list is not None:
+            for domain_uuid in domain_uuid_list:
+                stats_dict.setdefault(domain_uuid, {})
+        for d in stats_dict.values():
+            for field in cls.get_count_fields():
+                d.setdefault(field, 0)
+        return stats_dict
+
+    @classmethod
+    def reconcile(cls, domain_uuid_list=None):
+        """
+        通过聚合查询重新计算并保存域的资源计数，用于修正增量计数的偏差
+        :param domain_uuid_list: list, 域 uuid 列表，为空时修正所有域
+        :return: int, 修正的域数量
+        """
+        if domain_uuid_list is None:
+            domain_uuid_list = list(Domain.objects.values_list('uuid', flat=True))
+            cls.objects.exclude(domain__in=domain_uuid_list).delete()
+
+        stats_dict = cls.aggregate_stats_dict(domain_uuid_list)
+        for domain_uuid in domain_uuid_list:
+            cls.objects.update_or_create(domain=domain_uuid, defaults=stats_dict[domain_uuid])
+        return len(domain_uuid_list)
+
+    @classmethod
+    def get_stats_dict(cls, domain_uuid_list):
+        """
+        获取域的资源计数，根据配置读取计数表或使用分组聚合查询
+        :param domain_uuid_list: list, 域 uuid 列表
+        :return: dict, {domain_uuid: {field: count, ...}, ...}
+        """
+        if settings.DOMAIN_STATS_MODE == 'aggregate':
+            return cls.aggregate_stats_dict(domain_uuid_list)
+
+        stats_dict = {obj.domain: obj.serialize() for obj in cls.objects.filter(domain__in=domain_uuid_list)}
+
+        # 计数对象不存在的域，重建计数
+        missing_domain_list = [u for u in domain_uuid_list if u not in stats_dict]
+        if missing_domain_list:
+            cls.reconcile(missing_domain_list)
+            for obj in cls.objects.filter(domain__in=missing_domain_list):
+                stats_dict[obj.domain] = obj.serialize()
+        return stats_dict
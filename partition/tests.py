@@ -0,0 +1,259 @@
+from django.test import TestCase, RequestFactory, override_settings
+from django.core.cache import cache
+from op_keystone.auth_cache import Principal, TokenRevocation
+from identity.models import User, Group, M2MUserGroup, M2MUserRole, M2MGroupRole
+from assignment.models import Role, Policy, RoleTpl, M2MRolePolicy
+from search.models import SearchSuffix
+from job.models import Job
+from utils.dao import DAO
+from utils import tools
+from .models import Domain, Project, DomainStats
+from .views import DomainsView
+
+
+class DomainsMixin:
+    """
+    域视图的测试数据和请求
+    """
+
+    def setUp(self):
+        self.main_domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c',
+                                                 agent='a', is_main=True, created_by='test')
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='sub', company='c', agent='a',
+                                            created_by='test')
+        User.objects.create(uuid=tools.generate_unique_uuid(), email='u@test.com', phone='1', username='u',
+                            domain=self.domain.uuid, password='p', name='u', is_main=True, created_by='test')
+        self.principal = Principal('0' * 32, 'admin', self.main_domain.uuid, True, 1)
+
+    def delete(self, **params):
+        data = tools.json_dumper(params) if params else ''
+        request = RequestFactory().delete('/partition/domains/%s/' % self.domain.uuid,
+                                          data=data, content_type='application/json')
+        request.user = self.principal
+        response = DomainsView.as_view()(request, uuid=self.domain.uuid)
+        return tools.json_loader(response.content)
+
+
+class DomainsViewTestCase(DomainsMixin, TestCase):
+    """
+    域的级联删除，同步模式和后台任务模式
+    """
+
+    def test_delete(self):
+        res = self.delete()
+        self.assertEqual(res['code'], 200, res['message'])
+        self.assertEqual(res['data']['user'], 1)
+        self.assertFalse(Domain.objects.filter(uuid=self.domain.uuid).exists())
+
+    def test_delete_async(self):
+        res = self.delete(**{'async': '1'})
+        self.assertEqual(res['code'], 202)
+        self.assertEqual(res['data']['name'], 'partition.jobs.delete_domain')
+        self.assertTrue(Domain.objects.filter(uuid=self.domain.uuid).exists())
+
+        job_obj = Job.claim('worker')
+        self.assertEqual(job_obj.uuid, res['data']['uuid'])
+        self.assertTrue(job_obj.run())
+        self.assertEqual(job_obj.status, 'succeed', job_obj.message)
+        self.assertFalse(Domain.objects.filter(uuid=self.domain.uuid).exists())
+
+
+@override_settings(SEARCH_INDEX_ENABLED=True)
+class DomainCascadeTestCase(TestCase):
+    """
+    域的级联删除计划：每个表的删除数量，以及删除后不存在指向被删除对象的关联关系
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.main_domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c',
+                                                 agent='a', is_main=True, created_by='test')
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='sub', company='c', agent='a',
+                                            created_by='test')
+        self.main_user = self.create_user(self.main_domain, 'admin')
+        self.main_role = self.create(Role, self.main_domain, 'main role')
+        self.main_group = self.create(Group, self.main_domain, 'main group')
+
+        self.user_list = [self.create_user(self.domain, 'u%s' % i) for i in range(2)]
+        self.group = self.create(Group, self.domain, 'group')
+        self.role = self.create(Role, self.domain, 'role')
+        self.policy_list = [self.create(Policy, self.domain, 'p%s' % i, action='a', res='*', effect='allow')
+                            for i in range(2)]
+        self.create(Project, self.domain, 'project')
+        self.create(RoleTpl, self.domain, 'tpl', actions='[]')
+
+        user = self.user_list[1]
+        for model, opts in [
+            (M2MUserGroup, {'user': user.uuid, 'group': self.group.uuid}),
+            (M2MUserGroup, {'user': user.uuid, 'group': self.main_group.uuid}),
+            (M2MUserGroup, {'user': self.main_user.uuid, 'group': self.main_group.uuid}),
+            (M2MUserRole, {'user': user.uuid, 'role': self.role.uuid}),
+            (M2MGroupRole, {'group': self.group.uuid, 'role': self.role.uuid}),
+            (M2MRolePolicy, {'role': self.role.uuid, 'policy': self.policy_list[0].uuid}),
+            (M2MRolePolicy, {'role': self.role.uuid, 'policy': self.policy_list[1].uuid}),
+            # 主域角色引用被删除域的策略，关联关系随策略一并删除
+            (M2MRolePolicy, {'role': self.main_role.uuid, 'policy': self.policy_list[1].uuid}),
+        ]:
+            model.objects.create(**opts)
+
+    @staticmethod
+    def create(model, domain, name, **field_opts):
+        return model.objects.create(uuid=tools.generate_unique_uuid(), name=name, domain=domain.uuid,
+                                    created_by='test', **field_opts)
+
+    @staticmethod
+    def create_user(domain, username):
+        return DAO(User).create_obj(username=username, name=username, email='%s@%s.com' % (username, domain.name),
+                                    phone=username + domain.name, domain=domain.uuid, password='Qz7#kLp2vR',
+                                    created_by='test')
+
+    def test_count(self):
+        issued_timestamp = tools.datetime_to_timestamp() - 1
+        DAO(Domain).delete_obj(self.domain)
+        self.assertEqual(self.domain.cascade_count_dict, {
+            'm2m_user_group': 2, 'm2m_user_role': 1, 'm2m_group_role': 1, 'm2m_role_policy': 3,
+            'project': 1, 'user': 2, 'group': 1, 'role': 1, 'policy': 2, 'role_tpl': 1
+        })
+        self.assertTrue(TokenRevocation.is_revoked(self.user_list[0].uuid, self.domain.uuid, issued_timestamp))
+
+    def test_invariants(self):
+        user_uuid_list = [u.uuid for u in self.user_list]
+        DAO(Domain).delete_obj(self.domain)
+
+        # 用户软删除，修改时间与删除时间一致，查询后缀索引一并删除
+        for user in User.objects.filter(uuid__in=user_uuid_list):
+            self.assertNotEqual(user.deleted_time, tools.timestamp_to_datetime(0))
+            self.assertEqual(user.updated_time, user.deleted_time)
+        self.assertFalse(SearchSuffix.objects.filter(obj__in=user_uuid_list).exists())
+
+        # 不存在指向被删除对象的关联关系，其他域的对象和关联不受影响
+        for model in (Group, Role, Policy, Project, RoleTpl):
+            self.assertFalse(model.objects.filter(domain=self.domain.uuid).exists(), model.__name__)
+        self.assertFalse(M2MUserGroup.objects.filter(user__in=user_uuid_list).exists())
+        self.assertEqual(M2MRolePolicy.objects.count(), 0)
+        self.assertEqual(list(M2MUserGroup.objects.values_list('user', flat=True)), [self.main_user.uuid])
+        self.assertTrue(Role.objects.filter(uuid=self.main_role.uuid).exists())
+        self.assertTrue(SearchSuffix.objects.filter(obj=self.main_user.uuid).exists())
+        self.assertEqual(DAO(User).get_obj_qs().count(), 1)
+
+
+class DomainRevocationTestCase(TestCase):
+    """
+    域的用户快照依赖字段变化时吊销域下的签名 token
+    """
+
+    def setUp(self):
+        cache.clear()
+        Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                              is_main=True, created_by='test')
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='sub', company='c', agent='a',
+                                            created_by='test')
+        self.issued_timestamp = tools.datetime_to_timestamp() - 1
+
+    def update(self, **field_opts):
+        DAO(Domain).update_obj(self.domain, **field_opts)
+        return TokenRevocation.is_revoked('0' * 32, self.domain.uuid, self.issued_timestamp)
+
+    def test_comment_changed(self):
+        self.assertFalse(self.update(comment='c'))
+
+    def test_enable_changed(self):
+        self.assertTrue(self.update(enable=False))
+
+
+class DomainStatsTestCase(TestCase):
+    """
+    域资源计数随资源创建、更新、删除增量维护，以及通过聚合查询修正
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.main_domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c',
+                                                 agent='a', is_main=True, created_by='test')
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='sub', company='c', agent='a',
+                                            created_by='test')
+        self.group_model = DAO(Group)
+        self.role_model = DAO(Role)
+
+    def get_stats(self, domain):
+        return DomainStats.get_stats_dict([domain.uuid])[domain.uuid]
+
+    def test_count_on_create_and_delete(self):
+        group_list = [self.group_model.create_obj(name='g%s' % i, domain=self.domain.uuid, created_by='test')
+                      for i in range(3)]
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 3)
+
+        self.group_model.delete_obj(group_list[0])
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 2)
+
+        self.group_model.bulk_delete_objs(group_list[1:])
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 0)
+
+    def test_custom_only(self):
+        # 内置角色归属主域，不计入自定义角色数
+        self.role_model.create_obj(name='builtin', domain=self.domain.uuid, builtin=True, created_by='test')
+        self.role_model.create_obj(name='custom', domain=self.domain.uuid, created_by='test')
+        self.assertEqual(self.get_stats(self.domain)['custom_role_count'], 1)
+        self.assertEqual(self.get_stats(self.main_domain)['custom_role_count'], 0)
+
+    def test_count_update(self):
+        DomainStats.reconcile()
+        group = self.group_model.create_obj(name='g', domain=self.domain.uuid, created_by='test')
+        self.group_model.update_obj(group, comment='c')
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 1)
+
+        # 域变化时计数转移到新域
+        self.group_model.update_obj(group, domain=self.main_domain.uuid)
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 0)
+        self.assertEqual(self.get_stats(self.main_domain)['group_count'], 1)
+
+        # 自定义角色改为内置时减少计数
+        role = self.role_model.create_obj(name='r', domain=self.domain.uuid, created_by='test')
+        self.role_model.update_obj(role, builtin=True)
+        self.assertEqual(self.get_stats(self.domain)['custom_role_count'], 0)
+        self.assertEqual(self.get_stats(self.main_domain)['custom_role_count'], 0)
+
+    def test_count_obj_list(self):
+        group_list = [Group(uuid=tools.generate_unique_uuid(), name='g%s' % i, domain=domain.uuid)
+                      for i, domain in enumerate([self.domain, self.domain, self.main_domain])]
+        role_list = [Role(uuid=tools.generate_unique_uuid(), name='r', domain=self.domain.uuid, builtin=True)]
+
+        # 按域合并，每个域每个计数字段一次更新
+        DomainStats.reconcile([self.domain.uuid, self.main_domain.uuid])
+        with self.assertNumQueries(2):
+            DomainStats.count_obj_list(group_list + role_list, 1)
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 2)
+        self.assertEqual(self.get_stats(self.main_domain)['group_count'], 1)
+        self.assertEqual(self.get_stats(self.domain)['custom_role_count'], 0)
+
+    def test_missing_stats(self):
+        # 计数对象不存在时跳过增量更新，读取时通过聚合查询重建
+        group = Group.objects.create(uuid=tools.generate_unique_uuid(), name='g', domain=self.domain.uuid,
+                                     created_by='test')
+        DomainStats.count_obj(group, 1)
+        self.assertFalse(DomainStats.objects.exists())
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 1)
+
+    def test_reconcile(self):
+        self.group_model.create_obj(name='g', domain=self.domain.uuid, created_by='test')
+        self.role_model.create_obj(name='r', domain=self.domain.uuid, created_by='test')
+        Project.objects.create(uuid=tools.generate_unique_uuid(), name='p', domain=self.domain.uuid,
+                               created_by='test')
+        DomainStats.objects.filter(domain=self.domain.uuid).update(group_count=5, custom_role_count=-1)
+        DomainStats.objects.create(domain=tools.generate_unique_uuid(), group_count=1)
+
+        self.assertEqual(DomainStats.reconcile(), 2)
+        self.assertEqual(self.get_stats(self.domain), dict(DomainStats.aggregate_stats_dict()[self.domain.uuid]))
+        self.assertEqual(self.get_stats(self.domain)['group_count'], 1)
+        self.assertEqual(self.get_stats(self.domain)['custom_role_count'], 1)
+        self.assertEqual(self.get_stats(self.domain)['project_count'], 1)
+        self.assertEqual(DomainStats.objects.count(), 2)
+
+    @override_settings(DOMAIN_STATS_MODE='aggregate')
+    def test_aggregate_mode(self):
+        self.group_model.create_obj(name='g', domain=self.domain.uuid, created_by='test')
+        DomainStats.objects.all().delete()
+        stats_dict = DomainStats.get_stats_dict([self.domain.uuid, self.main_domain.uuid])
+        self.assertEqual(stats_dict[self.domain.uuid]['group_count'], 1)
+        self.assertEqual(stats_dict[self.main_domain.uuid]['group_count'], 0)
+        self.assertFalse(DomainStats.objects.exists())
@@ -1,4 +1,6 @@
 from op_keystone.base_view import ResourceView
+from op_keystone.exceptions import CustomException, RoutingParamsError
+from django.db import transaction
 from ..models import Domain
 
 
@@ -10,3 +12,47 @@ class DomainsView(ResourceView):
     def __init__(self):
         model = Domain
         super().__init__(model)
+
+    def delete(self, request, uuid=None):
+        try:
+            # 若 uuid 不存在，发生路由参数异常
+            if not uuid:
+                raise RoutingParamsError()
+
+            # 参数提取
+            extra_opts = ['async']
+            request_params = self.get_params_dict(request, nullable=True)
+            extra_opts_dict = self.extract_opts(request_params, extra_opts, necessary=False)
+
+            # 后台任务模式，校验对象后提交任务，返回任务信息
+            if self.is_async(extra_opts_dict):
+                self._model = self._model.scoped(request)
+                obj = self._model.get_obj(uuid=uuid)
+                self._model.validate_obj(obj)
+                return self.submit_job(request, 'partition.jobs.delete_domain', {'uuid': uuid})
+
+            # 级联删除域，返回每个表的删除数量
+            count_dict = self.delete_domain(request, uuid)
+            return self.standard_response(count_dict)
+
+        except CustomException as e:
+            return self.exception_to_response(e)
+
+    def delete_domain(self, request, uuid):
+        """
+        校验权限后，在事务中级联删除域下的资源和域
+        :param request: request object, 请求
+        :param uuid: str, 域 uuid
+        :return: dict, {表名: 删除数量, ...}
+        """
+        # 结合请求信息，设置 model 属性
+        self._model = self._model.scoped(request)
+
+        # 获取对象，并校验对象权限
+        obj = self._model.get_obj(uuid=uuid)
+        self._model.validate_obj(obj)
+
+        # 在事务中级联删除域下的资源和域
+        with transaction.atomic():
+            self._model.delete_obj(obj)
+        return obj.cascade_count_dict
@@ -0,0 +1,44 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from search.models import SearchSuffix
+from utils.dao import DAO
+
+
+class Command(BaseCommand):
+    """
+    重建查询后缀索引，启用 SEARCH_INDEX_ENABLED 前或索引字段变化后执行
+    """
+    help = 'Rebuild the search_suffix table of models with search index keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', nargs='*', help='model labels such as identity.User, all indexed models if empty')
+        parser.add_argument('--batch-size', type=int, default=500, help='objects indexed in one batch')
+
+    def handle(self, *args, **options):
+        model_list = [m for m in apps.get_models() if getattr(m, 'get_search_index_keys', None)
+                      and m.get_search_index_keys()]
+        if options['model']:
+            model_dict = {SearchSuffix.get_model_label(m): m for m in model_list}
+            unknown_list = [label for label in options['model'] if label not in model_dict]
+            if unknown_list:
+                raise CommandError('models without search index keys: %s' % ', '.join(unknown_list))
+            model_list = [model_dict[label] for label in options['model']]
+
+        batch_size = options['batch_size']
+        for model in model_list:
+            model_label = SearchSuffix.get_model_label(model)
+            SearchSuffix.objects.filter(model=model_label).delete()
+
+            # 只索引有效对象，软删除的对象不进入索引
+            indexed_count = 0
+            obj_list = []
+            for obj in DAO(model).get_obj_qs().iterator(chunk_size=batch_size):
+                obj_list.append(obj)
+                if len(obj_list) >= batch_size:
+                    SearchSuffix.index_obj_list(obj_list, force=True)
+                    indexed_count += len(obj_list)
+                    obj_list = []
+            SearchSuffix.index_obj_list(obj_list, force=True)
+            indexed_count += len(obj_list)
+
+            self.stdout.write('indexed %s objects of %s' % (indexed_count, model_label))
@@ -0,0 +1,178 @@
+from op_keystone.base_model import BaseModel
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+
+
+class SearchSuffix(BaseModel):
+    """
+    自由文本查询的后缀索引，字段值的每个起始位置一行，只保存后缀的前 suffix_length 个字符，
+    字段值的 startswith、contains、exact 等匹配都转化为后缀列上使用索引的前缀匹配
+    """
+
+    class Meta:
+        verbose_name = '查询后缀索引'
+        db_table = 'search_suffix'
+        indexes = [
+            models.Index(fields=['model', 'field', 'suffix'], name='search_suffix_lookup_idx'),
+            models.Index(fields=['model', 'obj'], name='search_suffix_obj_idx'),
+        ]
+
+    # 后缀的保存长度，更长的后缀截断保存，complete 标记是否完整，
+    # 超过该长度的查询值以截断后的前缀匹配候选对象，再直接查询字段确认
+    suffix_length = 16
+
+    model = models.CharField(max_length=64, verbose_name='模型标识')
+    obj = models.CharField(max_length=32, verbose_name='对象主键')
+    field = models.CharField(max_length=32, verbose_name='字段名')
+    position = models.IntegerField(verbose_name='后缀在字段值中的起始位置')
+    suffix = models.CharField(max_length=16, verbose_name='后缀')
+    complete = models.BooleanField(verbose_name='后缀是否完整')
+
+    @staticmethod
+    def get_model_label(model):
+        """
+        获取模型标识
+        :param model: model class
+        :return: str
+        """
+        return getattr(model, '_meta').label
+
+    @classmethod
+    def is_enabled(cls, model):
+        """
+        判断模型的自由文本查询是否使用后缀索引
+        :param model: model class
+        :return: bool
+        """
+        get_search_index_keys = getattr(model, 'get_search_index_keys', None)
+        return bool(settings.SEARCH_INDEX_ENABLED and get_search_index_keys and get_search_index_keys())
+
+    @classmethod
+    def get_suffix_list(cls, model, obj):
+        """
+        生成对象所有索引字段值的后缀对象，后缀截断为 suffix_length 个字符
+        :param model: model class
+        :param obj: model object
+        :return: list, [search suffix object, ...]
+        """
+        model_label = cls.get_model_label(model)
+        suffix_list = []
+        for field in model.get_search_index_keys():
+            value = getattr(obj, field)
+            if value is None:
+                continue
+
+            value = str(value)
+            for position in range(len(value)):
+                suffix = value[position:]
+                suffix_list.append(cls(
+                    model=model_label, obj=obj.pk, field=field, position=position,
+                    suffix=suffix[:cls.suffix_length], complete=len(suffix) <= cls.suffix_length
+                ))
+        return suffix_list
+
+    @classmethod
+    def index_obj_list(cls, obj_list, batch_size=1000, force=False):
+        """
+        重建对象列表的后缀索引，用于模型的创建后、更新后钩子，未启用索引时不维护
+        :param obj_list: list, 对象列表
+        :param batch_size: int, 每条插入语句的后缀数量
+        :param force: bool, 未启用索引时是否仍然建立，用于启用前重建索引
+        """
+        obj_list = list(obj_list)
+        if not obj_list:
+            return
+        model = obj_list[0].__class__
+        if not force and not cls.is_enabled(model):
+            return
+
+        cls.remove_obj_list(obj_list)
+        suffix_list = []
+        for obj in obj_list:
+            suffix_list += cls.get_suffix_list(model, obj)
+        cls.objects.bulk_create(suffix_list, batch_size=batch_size)
+
+    @classmethod
+    def remove_obj_list(cls, obj_list):
+        """
+        删除对象列表的后缀索引，用于模型的删除后钩子，未启用索引时不维护，启用前需要重建索引
+        :param obj_list: list, 对象列表
+        """
+        obj_list = list(obj_list)
+        if not obj_list:
+            return
+        model = obj_list[0].__class__
+        if not cls.is_enabled(model):
+            return
+        model_label = cls.get_model_label(model)
+        cls.objects.filter(model=model_label, obj__in=[obj.pk for obj in obj_list]).delete()
+
+    @classmethod
+    def get_match_q(cls, value, query_type):
+        """
+        将字段值的匹配转化为后缀的匹配，查询值不超过后缀保存长度时匹配语义与直接查询字段一致，
+        超过时匹配截断后的前缀，结果需要直接查询字段确认
+        :param value: str, 查询值
+        :param query_type: str, 查询类型
+        :return: Q object，查询类型不支持时为 None
+        """
+        if len(value) > cls.suffix_length:
+            prefix = value[:cls.suffix_length]
+            match_dict = {
+                'exact': Q(position=0, suffix=prefix),
+                'iexact': Q(position=0, suffix__iexact=prefix),
+                'startswith': Q(position=0, suffix=prefix),
+                'istartswith': Q(position=0, suffix__iexact=prefix),
+                'contains': Q(suffix=prefix),
+                'icontains': Q(suffix__iexact=prefix),
+                'endswith': Q(suffix=prefix),
+                'iendswith': Q(suffix__iexact=prefix),
+            }
+            return match_dict.get(query_type)
+
+        match_dict = {
+            'exact': Q(position=0, complete=True, suffix=value),
+            'iexact': Q(position=0, complete=True, suffix__iexact=value),
+            'startswith': Q(position=0, suffix__startswith=value),
+            'istartswith': Q(position=0, suffix__istartswith=value),
+            'contains': Q(suffix__startswith=value),
+            'icontains': Q(suffix__istartswith=value),
+            'endswith': Q(complete=True, suffix=value),
+            'iendswith': Q(complete=True, suffix__iexact=value),
+        }
+        return match_dict.get(query_type)
+
+    @classmethod
+    def get_search_q(cls, model, keys, value_list, query_type):
+        """
+        生成多个字段、多个值的或查询，索引字段合并为一条主键子查询，其余字段直接查询，
+        超过后缀保存长度的查询值通过索引过滤候选对象后直接查询字段确认
+        :param model: model class
+        :param keys: list, 字段名列表
+        :param value_list: list, 查询值列表
+        :param query_type: str, 查询类型
+        :return: Q object
+        """
+        index_keys = model.get_search_index_keys() if cls.is_enabled(model) else []
+        model_label = cls.get_model_label(model)
+
+        q = Q()
+        suffix_q = Q()
+        suffix_keys = []
+        for key in keys:
+            for value in value_list:
+                match_q = cls.get_match_q(value, query_type) if key in index_keys else None
+                if match_q is None:
+                    q |= Q(**{key + '__' + query_type: value})
+                elif len(value) > cls.suffix_length:
+                    obj_qs = cls.objects.filter(match_q, model=model_label, field=key)
+                    q |= Q(pk__in=obj_qs.values('obj'), **{key + '__' + query_type: value})
+                else:
+                    suffix_q |= Q(field=key) & match_q
+                    suffix_keys.append(key)
+
+        if suffix_keys:
+            obj_qs = cls.objects.filter(suffix_q, model=model_label, field__in=set(suffix_keys))
+            q |= Q(pk__in=obj_qs.values('obj'))
+        return q
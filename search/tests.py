@@ -0,0 +1,103 @@
+from django.test import TestCase, override_settings
+from django.db.models import Q
+from identity.models import User
+from partition.models import Domain
+from utils.dao import DAO
+from utils import tools
+from .models import SearchSuffix
+
+
+@override_settings(SEARCH_INDEX_ENABLED=True)
+class SearchSuffixTestCase(TestCase):
+    """
+    用户自由文本查询通过后缀索引解析，以及用户创建、更新、删除时的索引维护
+    """
+
+    query_type_list = ['exact', 'iexact', 'contains', 'icontains',
+                       'startswith', 'istartswith', 'endswith', 'iendswith']
+
+    def setUp(self):
+        self.domain = Domain.objects.create(uuid=tools.generate_unique_uuid(), name='main', company='c', agent='a',
+                                            is_main=True, created_by='test')
+        self.user_model = DAO('identity.models.User')
+        self.main_user = self.create_user('admin', 'Administrator', 'admin@example.com', '13800000000')
+        self.user_list = [
+            self.create_user('alice', 'Alice Liddell', 'alice.liddell@wonderland.example.com', '13800000001'),
+            self.create_user('bob', 'Bob Alison', 'bob@example.com', '13900000002'),
+            self.create_user('carol', 'Carol', 'CAROL@EXAMPLE.ORG', '13700000003'),
+        ]
+
+    def create_user(self, username, name, email, phone):
+        return self.user_model.create_obj(username=username, name=name, email=email, phone=phone,
+                                          domain=self.domain.uuid, password='Qz7#kLp2vR', created_by='test')
+
+    def search(self, query_str, query_type):
+        query_obj = self.user_model.parsing_query_str(query_str, query_type, url_params=True)
+        return set(self.user_model.get_obj_qs(query_obj).values_list('uuid', flat=True))
+
+    @staticmethod
+    def baseline(value, query_type):
+        q = Q()
+        for key in User.get_search_index_keys():
+            q |= Q(**{key + '__' + query_type: value})
+        return set(User.objects.filter(q).values_list('uuid', flat=True))
+
+    def get_suffix_qs(self, user):
+        return SearchSuffix.objects.filter(model=SearchSuffix.get_model_label(User), obj=user.uuid)
+
+    def test_match_baseline(self):
+        value_list = ['a', 'ali', 'ALI', 'example', 'example.com', '0000000', '13800000001', 'Alice Liddell',
+                      'alice.liddell@wonderland.example.com', 'liddell@wonderland.example.com', 'none']
+        for value in value_list:
+            for query_type in self.query_type_list:
+                self.assertEqual(self.search(value, query_type), self.baseline(value, query_type),
+                                 '%s %s' % (query_type, value))
+
+    def test_match_icontains(self):
+        self.assertEqual(self.search('ali', 'icontains'), {self.user_list[0].uuid, self.user_list[1].uuid})
+        self.assertEqual(self.search('example.org', 'icontains'), {self.user_list[2].uuid})
+        self.assertEqual(self.search('wonderland.example', 'icontains'), {self.user_list[0].uuid})
+        self.assertEqual(self.search('ali|carol', 'icontains'), {u.uuid for u in self.user_list})
+
+    def test_free_text_keys(self):
+        # 自由文本只查询索引字段，其他字段通过 key:value 查询
+        self.assertEqual(self.search(self.domain.uuid, 'exact'), set())
+        self.assertEqual(len(self.search('domain:%s' % self.domain.uuid, 'exact')), 4)
+
+    def test_index_on_create(self):
+        user = self.user_list[0]
+        suffix_qs = self.get_suffix_qs(user)
+        self.assertEqual(set(suffix_qs.values_list('field', flat=True)), set(User.get_search_index_keys()))
+        self.assertEqual(suffix_qs.count(), sum(len(getattr(user, k)) for k in User.get_search_index_keys()))
+        self.assertTrue(all(len(s) <= SearchSuffix.suffix_length for s in suffix_qs.values_list('suffix', flat=True)))
+
+    def test_index_on_update(self):
+        user = self.user_list[0]
+        self.user_model.update_obj(user, name='Alice Pleasance')
+        self.assertEqual(self.search('pleasance', 'icontains'), {user.uuid})
+        self.assertEqual(self.search('liddell', 'icontains'), {user.uuid})
+        self.assertEqual(self.search('Alice Liddell', 'iexact'), set())
+
+    def test_update_without_indexed_field(self):
+        user = self.user_list[0]
+        pk_set = set(self.get_suffix_qs(user).values_list('pk', flat=True))
+        self.user_model.update_obj(user, title='manager', comment='no indexed field changed')
+        self.assertEqual(set(self.get_suffix_qs(user).values_list('pk', flat=True)), pk_set)
+
+    def test_index_on_delete(self):
+        user = self.user_list[1]
+        self.user_model.delete_obj(user)
+        self.assertFalse(self.get_suffix_qs(user).exists())
+        self.assertEqual(self.search('bob', 'icontains'), set())
+
+    def test_index_on_bulk_delete(self):
+        self.user_model.bulk_delete_objs(self.user_list)
+        self.assertFalse(SearchSuffix.objects.filter(obj__in=[u.uuid for u in self.user_list]).exists())
+
+    @override_settings(SEARCH_INDEX_ENABLED=False)
+    def test_disabled(self):
+        user = self.create_user('dave', 'Dave', 'dave@example.com', '13600000004')
+        self.assertFalse(self.get_suffix_qs(user).exists())
+        self.user_model.update_obj(self.user_list[0], name='Alice Pleasance')
+        self.assertEqual(self.get_suffix_qs(self.user_list[0]).filter(field='name', position=0).get().suffix,
+                         'Alice Liddell')
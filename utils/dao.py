@@ -1,9 +1,13 @@
 from op_keystone.base_model import BaseModel, ResourceModel
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.utils import Error
+from django.db import transaction
 from op_keystone.exceptions import *
 from utils import tools
 from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from search.models import SearchSuffix
+import base64
 
 
 class DAO:
@@ -30,9 +34,20 @@ class DAO:
             self.query_obj = Q(deleted_time=valid_datetime)
         self.init_opts_dict = {}
 
+    def scoped(self, request):
+        """
+        获取融合了请求信息的新 dao 对象，请求的用户、查询条件和选项字典只属于新对象，
+        原 dao 对象保持不变，可以在多个请求、多个线程间共享
+        :param request: 请求对象
+        :return: dao object
+        """
+        scoped_dao = self.__class__(self.model)
+        scoped_dao.combine_request(request)
+        return scoped_dao
+
     def combine_request(self, request):
         """
-        融合请求信息，更新 dao 对象的相关属性
+        融合请求信息，更新 dao 对象的相关属性，会修改 dao 对象本身，请求中应使用 scoped 获取新的 dao 对象
         :param request:  请求对象
         :return:
         """
@@ -237,7 +252,7 @@ class DAO:
         query_type_list = [
             'exact', 'iexact', 'contains',
             'icontains', 'startswith', 'istartswith',
-            'endswith', 'iendswith '
+            'endswith', 'iendswith'
         ]
         if query_type not in query_type_list:
             query_type = 'startswith'
@@ -246,15 +261,13 @@ class DAO:
         for sub_query_str in query_list:
             if ':' not in sub_query_str:
                 if url_params:
-                    sub_q = Q()
-                    for key in getattr(self.model, 'get_default_query_keys')():
-                        value_list = sub_query_str.split('|')
-                        inside_q = Q()
-                        if url_params:
-                            key = key + '__' + query_type
-                        for value in value_list:
-                            inside_q |= Q(**{key: value})
-                        sub_q |= inside_q
+                    # 自由文本查询所有默认字段，启用后缀索引时只查询索引字段，通过索引解析为主键
+                    if SearchSuffix.is_enabled(self.model):
+                        keys = self.model.get_search_index_keys()
+                    else:
+                        keys = getattr(self.model, 'get_default_query_keys')()
+                    value_list = sub_query_str.split('|')
+                    sub_q = SearchSuffix.get_search_q(self.model, keys, value_list, query_type)
                 else:
                     continue
             else:
@@ -267,11 +280,12 @@ class DAO:
                     continue
                 else:
                     value_list = value_str.split('|')
-                    sub_q = Q()
                     if url_params:
-                        key = key + '__' + query_type
-                    for value in value_list:
-                        sub_q |= Q(**{key: value})
+                        sub_q = SearchSuffix.get_search_q(self.model, [key], value_list, query_type)
+                    else:
+                        sub_q = Q()
+                        for value in value_list:
+                            sub_q |= Q(**{key: value})
             q &= sub_q
         return q
 
@@ -304,10 +318,218 @@ class DAO:
         :return: list, [dict, ...]
         """
         obj_qs = self.get_obj_qs(*query_obj, **kwargs)
-        dict_list = []
-        for obj in obj_qs:
-            dict_list.append(obj.serialize())
-        return dict_list
+        return self.serialize_list(obj_qs)
+
+    def serialize_list(self, obj_list, fields=None):
+        """
+        序列化对象列表，资源模型使用模型的批量序列化方法
+        :param obj_list: list|query set, 对象列表
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :return: list, [dict, ...]
+        """
+        if issubclass(self.model, ResourceModel):
+            return self.model.serialize_list(obj_list, fields)
+        return [obj.serialize(fields) for obj in obj_list]
+
+    def only_fields(self, obj_qs, fields):
+        """
+        根据需要返回的字段列表，限制查询集从数据库读取的字段
+        :param obj_qs: query set, 查询集
+        :param fields: list, 需要返回的字段列表，为空时不做限制
+        :return: query set
+        """
+        if fields is None:
+            return obj_qs
+        if not issubclass(self.model, ResourceModel):
+            raise RequestParamsError(opt='fields', invalid=True)
+        return obj_qs.only(*self.model.get_column_fields(fields))
+
+    def get_page_dict(self, *query_obj, page=1, page_size=None, fields=None, **kwargs):
+        """
+        从模型中过滤并获取指定页的对象序列化字典，分页和计数在数据库中进行，用于返回响应
+        :param query_obj: Q object, 查询对象
+        :param page: int, 页数
+        :param page_size: int, 页大小，为空时获取所有数据
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :param kwargs: dict, 过滤参数
+        :return: dict, 包含数据总数、当前页数据列表的字典
+        """
+        obj_qs = self.get_obj_qs(*query_obj, **kwargs)
+        obj_qs = self.only_fields(obj_qs, fields)
+
+        # 排序追加主键，保证分页结果稳定
+        ordering = list(obj_qs.query.order_by or getattr(self.model, '_meta').ordering)
+        if 'pk' not in ordering and '-pk' not in ordering:
+            ordering.append('pk')
+        obj_qs = obj_qs.order_by(*ordering)
+
+        try:
+            page = int(page)
+        except (TypeError, ValueError):
+            raise RequestParamsError(opt='page', invalid=True)
+        if page < 1:
+            raise RequestParamsError(opt='page', invalid=True)
+
+        # 未指定页大小时，所有数据作为第一页，之后的页为空，与 tools.paging_list 一致
+        if not page_size:
+            if page > 1:
+                return {
+                    'total': obj_qs.count(),
+                    'data': []
+                }
+            dict_list = self.serialize_list(obj_qs, fields)
+            return {
+                'total': len(dict_list),
+                'data': dict_list
+            }
+
+        try:
+            page_size = int(page_size)
+        except (TypeError, ValueError):
+            raise RequestParamsError(opt='page-size', invalid=True)
+        if page_size < 1:
+            raise RequestParamsError(opt='page-size', invalid=True)
+
+        # 数据库中计数和分页
+        start_index = (page - 1) * page_size
+        end_index = start_index + page_size
+        dict_list = self.serialize_list(obj_qs[start_index:end_index], fields)
+        return {
+            'total': obj_qs.count(),
+            'data': dict_list
+        }
+
+    def iter_serialize(self, *query_obj, chunk_size=500, fields=None, **kwargs):
+        """
+        从模型中过滤并逐个生成对象序列化字典，按 (created_time, uuid) 分块查询，用于流式返回响应
+        :param query_obj: Q object, 查询对象
+        :param chunk_size: int, 每次查询的数据条数
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :param kwargs: dict, 过滤参数
+        :return: generator, 对象序列化字典生成器
+        """
+        obj_qs = self.get_obj_qs(*query_obj, **kwargs)
+        obj_qs = self.only_fields(obj_qs, fields)
+
+        # 非资源模型没有稳定的排序键，直接使用查询集迭代器
+        if not issubclass(self.model, ResourceModel):
+            for obj in obj_qs.iterator(chunk_size=chunk_size):
+                yield obj.serialize(fields)
+            return
+
+        # 每次从上一块的最后一条数据之后查询，避免驱动一次性缓存整个结果集
+        chunk_qs = self.get_keyset_qs(obj_qs)
+        while True:
+            obj_list = list(chunk_qs[:chunk_size])
+            for d in self.serialize_list(obj_list, fields):
+                yield d
+            if len(obj_list) < chunk_size:
+                return
+
+            last_obj = obj_list[-1]
+            chunk_qs = self.get_keyset_qs(obj_qs, last_obj.created_time, last_obj.uuid)
+
+    def get_cursor_dict(self, *query_obj, cursor=None, page_size=20, with_total=False, fields=None, **kwargs):
+        """
+        从模型中过滤并获取游标之后一页的对象序列化字典，按 (created_time, uuid) 进行键集分页，用于返回响应
+        :param query_obj: Q object, 查询对象
+        :param cursor: str, 上一页返回的游标，为空时获取第一页
+        :param page_size: int, 页大小
+        :param with_total: bool, 是否计算数据总数
+        :param fields: list, 需要返回的字段列表，为空时返回所有字段
+        :param kwargs: dict, 过滤参数
+        :return: dict, 包含数据总数、当前页数据列表、下一页游标的字典
+        """
+        if not issubclass(self.model, ResourceModel):
+            raise RequestParamsError(opt='cursor', invalid=True)
+
+        try:
+            page_size = int(page_size)
+        except (TypeError, ValueError):
+            raise RequestParamsError(opt='page-size', invalid=True)
+        if page_size < 1:
+            raise RequestParamsError(opt='page-size', invalid=True)
+
+        obj_qs = self.get_obj_qs(*query_obj, **kwargs)
+        total_count = obj_qs.count() if with_total else None
+
+        # 从游标位置之后开始查询
+        if cursor:
+            obj_qs = self.get_keyset_qs(obj_qs, *self._load_cursor(cursor))
+        else:
+            obj_qs = self.get_keyset_qs(obj_qs)
+
+        # 多查询一条数据，用于判断是否存在下一页
+        obj_qs = self.only_fields(obj_qs, fields)
+        obj_list = list(obj_qs[:page_size + 1])
+        next_cursor = None
+        if len(obj_list) > page_size:
+            obj_list = obj_list[:page_size]
+            next_cursor = self._dump_cursor(obj_list[-1])
+
+        return {
+            'total': total_count,
+            'data': self.serialize_list(obj_list, fields),
+            'next': next_cursor
+        }
+
+    @staticmethod
+    def get_keyset_qs(obj_qs, created_time=None, uuid=None):
+        """
+        获取按 (created_time, uuid) 排序、位于指定排序键之后的查询集，用于键集分页，
+        条件写为 created_time 的范围查询，可以使用以 (created_time, uuid) 结尾的联合索引
+        :param obj_qs: query set, 查询集
+        :param created_time: datetime, 上一条数据的创建时间，为空时从第一条数据开始
+        :param uuid: str, 上一条数据的 uuid
+        :return: query set
+        """
+        if created_time is not None:
+            obj_qs = obj_qs.filter(Q(created_time__gte=created_time),
+                                   Q(created_time__gt=created_time) | Q(uuid__gt=uuid))
+        return obj_qs.order_by('created_time', 'uuid')
+
+    @staticmethod
+    def _dump_cursor(obj):
+        """
+        将对象的排序键编码为不透明的游标
+        :param obj: model object
+        :return: str, 游标
+        """
+        cursor_json = tools.json_dumper([obj.created_time.isoformat(), obj.uuid])
+        return base64.urlsafe_b64encode(cursor_json.encode('utf8')).decode('ascii')
+
+    @staticmethod
+    def _load_cursor(cursor):
+        """
+        将游标解码为排序键
+        :param cursor: str, 游标
+        :return: tuple, (created_time, uuid)
+        """
+        try:
+            cursor_json = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')
+            created_time_str, uuid = tools.json_loader(cursor_json)
+            created_time = parse_datetime(created_time_str)
+        except (ValueError, TypeError, UnicodeEncodeError):
+            raise RequestParamsError(opt='cursor', invalid=True)
+        if not created_time or not isinstance(uuid, str):
+            raise RequestParamsError(opt='cursor', invalid=True)
+        return created_time, uuid
+
+    def get_field_dict(self, uuid_list, *fields):
+        """
+        一次性获取指定 uuid 对象的字段值字典，存在对象不存在时抛出异常
+        :param uuid_list: list, 对象 uuid 列表
+        :param fields: str, 字段名
+        :return: dict, {uuid: {field: value, ...}, ...}
+        """
+        uuid_set = set(uuid_list)
+        field_dict = {}
+        for row in self.get_obj_qs(uuid__in=uuid_set).values('uuid', *fields):
+            field_dict[row.pop('uuid')] = row
+
+        if len(field_dict) != len(uuid_set):
+            raise ObjectNotExist(self.model.__name__)
+        return field_dict
 
     def get_field_list(self, field, **kwargs):
         """
@@ -381,19 +603,121 @@ class DAO:
         obj.post_delete()
         return 'success to delete object'
 
-    def delete_obj_qs(self, *query_obj, **kwargs):
+    def delete_obj_qs(self, *query_obj, chunk_size=1000, **kwargs):
         """
-        从模型中删除符合条件的所有对象，自动区分并进行软删除
+        从模型中删除符合条件的所有对象，按块批量执行钩子和删除，自动区分并进行软删除，
+        所有块在同一事务中，任一块失败时全部回滚
         :param query_obj: Q object, 查询对象
+        :param chunk_size: int, 每批删除的对象数量
         :param kwargs: dict, 过滤参数
         :return: str, 成功删除信息
         """
-        obj_qs = self.get_obj_qs(*query_obj, **kwargs)
-
-        for obj in obj_qs:
-            self.delete_obj(obj)
+        # 只预先查询主键，每块删除时再查询该块的对象
+        with transaction.atomic():
+            pk_list = list(self.get_obj_qs(*query_obj, **kwargs).values_list('pk', flat=True))
+            for i in range(0, len(pk_list), chunk_size):
+                self.bulk_delete_objs(self.model.objects.filter(pk__in=pk_list[i:i + chunk_size]))
 
         return 'success to delete object query set'
 
+    def bulk_create_objs(self, field_opts_list, batch_size=1000):
+        """
+        在模型中批量创建对象，调用批量创建钩子，一次事务中分批插入
+        :param field_opts_list: list, 列参数字典列表
+        :param batch_size: int, 每条插入语句的对象数量
+        :return: list, 创建的对象列表
+        """
+        obj_list = [self.model(**field_opts) for field_opts in field_opts_list]
+        if not obj_list:
+            return obj_list
+
+        # 钩子与创建语句在同一事务中，钩子失败时回滚创建
+        with transaction.atomic():
+            self.model.pre_bulk_create(obj_list)
+
+            try:
+                self.model.objects.bulk_create(obj_list, batch_size=batch_size)
+            except Error as e:
+                msg = e.args[1]
+                raise DatabaseError(msg, self.model.__name__) from e
+
+            self.model.post_bulk_create(obj_list)
+        return obj_list
+
+    def bulk_update_objs(self, obj_list, **field_opts):
+        """
+        从模型中批量修改指定对象的相同字段，调用批量更新钩子，字段值相同的对象使用一条更新语句
+        :param obj_list: list, 对象列表
+        :param field_opts: dict, 字段参数
+        :return: list, 更新后的对象列表
+        """
+        obj_list = list(obj_list)
+        if not obj_list:
+            return obj_list
+
+        for obj in obj_list:
+            for i in field_opts:
+                setattr(obj, i, field_opts[i])
+
+        # 钩子与更新语句在同一事务中，钩子失败时回滚更新
+        with transaction.atomic():
+            self.model.pre_bulk_update(obj_list)
+
+            # 钩子可能修改字段值，按更新后的字段值分组
+            update_fields = list(field_opts)
+            if self.model.get_field('updated_time'):
+                now = tools.get_datetime_with_tz()
+                for obj in obj_list:
+                    obj.updated_time = now
+                update_fields.append('updated_time')
+
+            group_dict = {}
+            for obj in obj_list:
+                values = tuple(getattr(obj, f) for f in update_fields)
+                group_dict.setdefault(values, []).append(obj.pk)
+
+            try:
+                for values, pk_list in group_dict.items():
+                    self.model.objects.filter(pk__in=pk_list).update(**dict(zip(update_fields, values)))
+            except Error as e:
+                msg = e.args[1]
+                raise DatabaseError(msg, self.model.__name__) from e
+
+            self.model.post_bulk_update(obj_list)
+        return obj_list
+
+    def bulk_delete_objs(self, obj_list):
+        """
+        从模型中批量删除指定对象，调用批量删除钩子，使用一条语句删除，自动区分并进行软删除
+        :param obj_list: list, 对象列表
+        :return: str, 成功删除信息
+        """
+        obj_list = list(obj_list)
+        if not obj_list:
+            return 'success to delete objects'
+
+        # 钩子与删除语句在同一事务中，钩子失败时回滚删除
+        with transaction.atomic():
+            self.model.pre_bulk_delete(obj_list)
+
+            pk_list = [obj.pk for obj in obj_list]
+            try:
+                if self.model.get_field('deleted_time'):
+                    # 软删除与单个删除一致，同时更新修改时间
+                    deleted_time = tools.get_datetime_with_tz()
+                    self.model.objects.filter(pk__in=pk_list).update(deleted_time=deleted_time,
+                                                                     updated_time=deleted_time)
+                    for obj in obj_list:
+                        obj.deleted_time = deleted_time
+                        obj.updated_time = deleted_time
+                else:
+                    self.model.objects.filter(pk__in=pk_list).delete()
+            except Error as e:
+                msg = e.args[1]
+                raise DatabaseError(msg, self.model.__name__) from e
+
+            self.model.post_bulk_delete(obj_list)
+        return 'success to delete objects'
+
 
 
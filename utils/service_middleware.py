@@ -3,6 +3,13 @@ from django.http.response import JsonResponse
 import requests
 from requests.exceptions import RequestException
 from django.db.models import Q
+from requests.adapters import HTTPAdapter
+from threading import Lock, Event
+import base64
+import hashlib
+import hmac
+import json
+import time
 
 
 class AuthMiddleware(MiddlewareMixin):
@@ -11,8 +18,29 @@ class AuthMiddleware(MiddlewareMixin):
     """
 
     _keystone_url = 'http://192.168.1.250:8888/identity/auth/'
+    _keystone_batch_url = 'http://192.168.1.250:8888/identity/auth-batch/'
     _auth_header = 'HTTP_X_JUNHAI_TOKEN'
     _service_token = None
+    _signed_token_secret = None
+
+    # 连接池大小，请求超时时间 (连接, 读取)，单位秒
+    _pool_size = 10
+    _request_timeout = (3, 10)
+
+    # 鉴权结果缓存时间，单位秒，以及最大缓存数量
+    _decision_cache_ttl = 5
+    _decision_cache_size = 10000
+
+    # 批量鉴权的收集窗口，单位秒，为 0 时不进行批量鉴权
+    _batch_window = 0
+
+    _session = None
+    _session_lock = Lock()
+    _batch_pending_list = None
+    _batch_lock = Lock()
+    _decision_cache = {}
+    _inflight_dict = {}
+    _decision_lock = Lock()
 
     def process_view(self, request, callback, callback_args, callback_kwargs):
         # 构造请求信息字典
@@ -32,11 +60,17 @@ class AuthMiddleware(MiddlewareMixin):
             })
         request_info['token'] = rq_token
 
+        # 签名 token 在本地校验签名和过期时间，无效时无需请求 keystone
+        if self._signed_token_secret and '.' in rq_token:
+            if not self.verify_signed_token(rq_token, self._signed_token_secret):
+                return JsonResponse({
+                    'code': 403,
+                    'data': None,
+                    'message': 'CredenceInvalid: the access token in the header is invalid'
+                })
+
         try:
-            auth_header = {
-                "X-Junhai-Token": self._service_token
-            }
-            response = requests.post(self._keystone_url, headers=auth_header, json=request_info).json()
+            response = self.get_auth_decision(request_info)
 
             if response['code'] != 200:
                 return JsonResponse({
@@ -45,7 +79,7 @@ class AuthMiddleware(MiddlewareMixin):
                     'message': response['message']
                 })
 
-        except RequestException():
+        except (RequestException, ValueError, KeyError):
             return JsonResponse({
                 'code': 502,
                 'data': None,
@@ -75,6 +109,172 @@ class AuthMiddleware(MiddlewareMixin):
 
             request.condition_q = condition_q
 
+    @classmethod
+    def get_session(cls):
+        """
+        获取进程内共享的 http 会话，复用连接池中的长连接
+        :return: requests session object
+        """
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls._pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    cls._session = session
+        return cls._session
+
+    @classmethod
+    def request_keystone(cls, request_info):
+        """
+        请求 keystone 的鉴权接口
+        :param request_info: dict, 请求信息
+        :return: dict, 鉴权响应
+        """
+        auth_header = {
+            "X-Junhai-Token": cls._service_token
+        }
+        response = cls.get_session().post(cls._keystone_url, headers=auth_header, json=request_info,
+                                          timeout=cls._request_timeout)
+        return response.json()
+
+    @classmethod
+    def request_keystone_batched(cls, request_info):
+        """
+        收集同一窗口内到达的鉴权请求，合并为一次批量鉴权请求
+        :param request_info: dict, 请求信息
+        :return: dict, 单个请求信息的鉴权响应
+        """
+        slot = {'event': Event(), 'response': None, 'error': None}
+        with cls._batch_lock:
+            leader = cls._batch_pending_list is None
+            if leader:
+                cls._batch_pending_list = []
+            cls._batch_pending_list.append((request_info, slot))
+
+        # 第一个到达的请求等待窗口结束后，发送批量请求并分发结果
+        if leader:
+            time.sleep(cls._batch_window)
+            with cls._batch_lock:
+                pending_list = cls._batch_pending_list
+                cls._batch_pending_list = None
+
+            try:
+                auth_header = {
+                    "X-Junhai-Token": cls._service_token
+                }
+                request_info_list = [info for info, _ in pending_list]
+                response = cls.get_session().post(cls._keystone_batch_url, headers=auth_header,
+                                                  json={'request_info_list': request_info_list},
+                                                  timeout=cls._request_timeout).json()
+                if response['code'] != 200:
+                    for _, pending_slot in pending_list:
+                        pending_slot['response'] = response
+                else:
+                    for (_, pending_slot), item in zip(pending_list, response['data']):
+                        pending_slot['response'] = item
+            except (RequestException, ValueError, KeyError, TypeError) as e:
+                for _, pending_slot in pending_list:
+                    pending_slot['error'] = RequestException(e)
+            finally:
+                for _, pending_slot in pending_list:
+                    pending_slot['event'].set()
+
+        slot['event'].wait(cls._batch_window + sum(cls._request_timeout))
+        if slot['error']:
+            raise slot['error']
+        if slot['response'] is None:
+            raise RequestException()
+        return slot['response']
+
+    @classmethod
+    def get_auth_decision(cls, request_info):
+        """
+        获取鉴权结果，优先使用短时缓存，相同的并发请求只请求一次 keystone
+        :param request_info: dict, 请求信息
+        :return: dict, 鉴权响应
+        """
+        key = (request_info['token'], request_info['url'], request_info['method'],
+               (request_info['routing_params'] or {}).get('uuid'))
+
+        # 缓存命中，或者加入正在进行的相同请求
+        with cls._decision_lock:
+            cached = cls._decision_cache.get(key)
+            if cached and cached[0] > time.time():
+                return cached[1]
+
+            flight = cls._inflight_dict.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': Event(), 'response': None, 'error': None}
+                cls._inflight_dict[key] = flight
+
+        # 等待正在进行的相同请求的结果
+        if not leader:
+            flight['event'].wait(sum(cls._request_timeout))
+            if flight['error']:
+                raise flight['error']
+            if flight['response'] is None:
+                raise RequestException()
+            return flight['response']
+
+        # 请求 keystone，成功的鉴权结果写入缓存
+        try:
+            if cls._batch_window > 0:
+                response = cls.request_keystone_batched(request_info)
+            else:
+                response = cls.request_keystone(request_info)
+            flight['response'] = response
+            if response['code'] == 200:
+                cls._cache_decision(key, response)
+            return response
+        except (RequestException, ValueError, KeyError) as e:
+            flight['error'] = e
+            raise
+        finally:
+            with cls._decision_lock:
+                cls._inflight_dict.pop(key, None)
+            flight['event'].set()
+
+    @classmethod
+    def _cache_decision(cls, key, response):
+        """
+        写入鉴权结果缓存，超出最大数量时清除过期结果
+        :param key: tuple, 缓存键
+        :param response: dict, 鉴权响应
+        """
+        now = time.time()
+        with cls._decision_lock:
+            if len(cls._decision_cache) >= cls._decision_cache_size:
+                expired_keys = [k for k, v in cls._decision_cache.items() if v[0] <= now]
+                for k in expired_keys:
+                    del cls._decision_cache[k]
+                if len(cls._decision_cache) >= cls._decision_cache_size:
+                    cls._decision_cache.clear()
+            cls._decision_cache[key] = (now + cls._decision_cache_ttl, response)
+
+    @staticmethod
+    def verify_signed_token(token, secret):
+        """
+        校验签名 token 的签名和过期时间，吊销状态仍由 keystone 校验
+        :param token: str, 签名 token
+        :param secret: str, 与 keystone 共享的签名密钥
+        :return: bool
+        """
+        try:
+            payload_str, signature_str = token.split('.')
+            signature = hmac.new(secret.encode('utf8'), payload_str.encode('ascii'), hashlib.sha256).digest()
+            expect_signature_str = base64.urlsafe_b64encode(signature).rstrip(b'=').decode('ascii')
+            if not hmac.compare_digest(expect_signature_str, signature_str):
+                return False
+
+            padding = '=' * (-len(payload_str) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(payload_str + padding).decode('utf8'))
+            return payload['exp'] >= time.time()
+        except (ValueError, TypeError, KeyError, UnicodeEncodeError):
+            return False
+
     @staticmethod
     def parsing_query_str(query_str):
         q = Q()
@@ -0,0 +1,232 @@
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from unittest import mock
+from requests.exceptions import RequestException
+from threading import Event, Thread
+from op_keystone.exceptions import RequestParamsError
+from identity.models import Group
+from utils.dao import DAO
+from utils import tools
+from utils.service_middleware import AuthMiddleware
+import time
+
+
+class DAOPageTestCase(TestCase):
+    """
+    页数分页的数据总数、页内容，以及排序字段相同时分页结果稳定
+    """
+
+    def setUp(self):
+        self.group_model = DAO(Group)
+
+        # 所有组的 domain 相同，模型默认排序 -domain 无法区分先后，按主键补充排序
+        domain_uuid = tools.generate_unique_uuid()
+        for i in range(5):
+            Group.objects.create(uuid=tools.generate_unique_uuid(), name='g%s' % i, domain=domain_uuid,
+                                 created_by='test')
+        self.uuid_list = list(Group.objects.order_by('-domain', 'pk').values_list('uuid', flat=True))
+
+    def get_uuid_list(self, **page_opts):
+        page_dict = self.group_model.get_page_dict(**page_opts)
+        self.assertEqual(page_dict['total'], 5)
+        return [d['uuid'] for d in page_dict['data']]
+
+    def test_pages(self):
+        uuid_list = []
+        for page in range(1, 4):
+            uuid_list += self.get_uuid_list(page=str(page), page_size='2')
+        self.assertEqual(uuid_list, self.uuid_list)
+        self.assertEqual(self.get_uuid_list(page=4, page_size=2), [])
+
+    def test_page_queries(self):
+        # 当前页和数据总数各一条查询，不读取其他页的数据
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get_uuid_list(page=2, page_size=2), self.uuid_list[2:4])
+
+    def test_stable_ordering(self):
+        self.assertEqual(self.get_uuid_list(page=2, page_size=2), self.get_uuid_list(page=2, page_size=2))
+
+    def test_without_page_size(self):
+        self.assertEqual(self.get_uuid_list(), self.uuid_list)
+        self.assertEqual(self.get_uuid_list(page=1), self.uuid_list)
+        self.assertEqual(self.get_uuid_list(page=2), [])
+
+    def test_invalid(self):
+        for page_opts in ({'page': 0}, {'page': 'x'}, {'page': 1, 'page_size': -1}, {'page': 1, 'page_size': 'x'}):
+            with self.assertRaises(RequestParamsError, msg=page_opts):
+                self.group_model.get_page_dict(**page_opts)
+
+
+class DAOCursorTestCase(TestCase):
+    """
+    按 (created_time, uuid) 的键集分页和分块迭代，创建时间相同的数据按 uuid 排序
+    """
+
+    def setUp(self):
+        self.group_model = DAO(Group)
+        domain_uuid = tools.generate_unique_uuid()
+        created_time = tools.get_datetime_with_tz()
+        for i in range(7):
+            group = Group.objects.create(uuid=tools.generate_unique_uuid(), name='g%s' % i, domain=domain_uuid,
+                                         created_by='test')
+            # 每两个组的创建时间相同
+            Group.objects.filter(pk=group.pk).update(created_time=tools.get_datetime_with_tz(
+                created_time, seconds=i // 2))
+        self.uuid_list = list(Group.objects.order_by('created_time', 'uuid').values_list('uuid', flat=True))
+
+    def test_cursor_pages(self):
+        uuid_list = []
+        cursor = None
+        while True:
+            page_dict = self.group_model.get_cursor_dict(cursor=cursor, page_size=2, with_total=True)
+            self.assertEqual(page_dict['total'], 7)
+            uuid_list += [d['uuid'] for d in page_dict['data']]
+            cursor = page_dict['next']
+            if not cursor:
+                break
+        self.assertEqual(uuid_list, self.uuid_list)
+
+    def test_iter_serialize(self):
+        uuid_list = [d['uuid'] for d in self.group_model.iter_serialize(chunk_size=2)]
+        self.assertEqual(uuid_list, self.uuid_list)
+
+
+class DAODeleteQsTestCase(TestCase):
+    """
+    按条件分块删除，所有块在同一事务中
+    """
+
+    def setUp(self):
+        self.domain_uuid = tools.generate_unique_uuid()
+        for i in range(5):
+            Group.objects.create(uuid=tools.generate_unique_uuid(), name='g%s' % i, domain=self.domain_uuid,
+                                 created_by='test')
+
+    def test_delete_chunks(self):
+        with mock.patch.object(Group, 'post_bulk_delete') as hook_mock:
+            DAO(Group).delete_obj_qs(domain=self.domain_uuid, chunk_size=2)
+        self.assertEqual([len(c[0][0]) for c in hook_mock.call_args_list], [2, 2, 1])
+        self.assertFalse(Group.objects.exists())
+
+    def test_rollback_all_chunks(self):
+        # 第二块的钩子失败时，第一块的删除一并回滚
+        with mock.patch.object(Group, 'pre_bulk_delete', side_effect=[None, RuntimeError()]):
+            with self.assertRaises(RuntimeError):
+                DAO(Group).delete_obj_qs(domain=self.domain_uuid, chunk_size=2)
+        self.assertEqual(Group.objects.count(), 5)
+
+
+class AuthMiddlewareTestCase(SimpleTestCase):
+    """
+    服务鉴权中间件的鉴权结果短时缓存，以及相同并发请求只请求一次 keystone
+    """
+
+    def setUp(self):
+        for name, value in [('_decision_cache', {}), ('_inflight_dict', {}), ('_batch_window', 0)]:
+            patcher = mock.patch.object(AuthMiddleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.response = {'code': 200, 'data': {'access': True, 'allow_condition_list': [],
+                                               'deny_condition_list': []}, 'message': 'success'}
+        self.request_mock = mock.Mock(return_value=self.response)
+        patcher = mock.patch.object(AuthMiddleware, 'request_keystone', self.request_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def get_request_info(token='t', url='/users/', uuid=None):
+        return {'url': url, 'method': 'get', 'routing_params': {'uuid': uuid} if uuid else {}, 'token': token}
+
+    def test_cache(self):
+        for _ in range(3):
+            self.assertEqual(AuthMiddleware.get_auth_decision(self.get_request_info()), self.response)
+        self.assertEqual(self.request_mock.call_count, 1)
+
+        # token、url 或资源不同时分别鉴权
+        AuthMiddleware.get_auth_decision(self.get_request_info(token='t2'))
+        AuthMiddleware.get_auth_decision(self.get_request_info(url='/groups/'))
+        AuthMiddleware.get_auth_decision(self.get_request_info(uuid='u'))
+        self.assertEqual(self.request_mock.call_count, 4)
+
+    def test_cache_expired(self):
+        AuthMiddleware.get_auth_decision(self.get_request_info())
+        with mock.patch.object(time, 'time', return_value=time.time() + AuthMiddleware._decision_cache_ttl + 1):
+            AuthMiddleware.get_auth_decision(self.get_request_info())
+        self.assertEqual(self.request_mock.call_count, 2)
+
+    def test_failure_not_cached(self):
+        self.request_mock.return_value = {'code': 403, 'data': None, 'message': 'CredenceInvalid'}
+        AuthMiddleware.get_auth_decision(self.get_request_info())
+        self.request_mock.side_effect = RequestException()
+        with self.assertRaises(RequestException):
+            AuthMiddleware.get_auth_decision(self.get_request_info())
+        self.assertEqual(self.request_mock.call_count, 2)
+        self.assertEqual(AuthMiddleware._inflight_dict, {})
+
+    def test_cache_size(self):
+        with mock.patch.object(AuthMiddleware, '_decision_cache_size', 2):
+            for i in range(3):
+                AuthMiddleware.get_auth_decision(self.get_request_info(token='t%s' % i))
+        self.assertEqual(len(AuthMiddleware._decision_cache), 1)
+
+    def run_concurrent(self, count):
+        """
+        第一个请求阻塞在 keystone 请求中时，发起其他相同请求
+        :param count: int, 并发请求数
+        :return: list, 每个请求的鉴权响应或异常
+        """
+        called, release = Event(), Event()
+        request_side_effect = self.request_mock.side_effect
+
+        def side_effect(request_info):
+            called.set()
+            release.wait(5)
+            if request_side_effect:
+                raise request_side_effect
+            return self.response
+        self.request_mock.side_effect = side_effect
+
+        result_list = [None] * count
+
+        def target(i):
+            try:
+                result_list[i] = AuthMiddleware.get_auth_decision(self.get_request_info())
+            except RequestException as e:
+                result_list[i] = e
+
+        thread_list = [Thread(target=target, args=(i, )) for i in range(count)]
+        thread_list[0].start()
+        self.assertTrue(called.wait(5))
+        for thread in thread_list[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in thread_list:
+            thread.join(5)
+        return result_list
+
+    def test_single_flight(self):
+        result_list = self.run_concurrent(5)
+        self.assertEqual(result_list, [self.response] * 5)
+        self.assertEqual(self.request_mock.call_count, 1)
+        self.assertEqual(AuthMiddleware._inflight_dict, {})
+
+    def test_single_flight_error(self):
+        self.request_mock.side_effect = RequestException()
+        result_list = self.run_concurrent(5)
+        self.assertTrue(all(isinstance(e, RequestException) for e in result_list))
+        self.assertEqual(self.request_mock.call_count, 1)
+        self.assertEqual(AuthMiddleware._decision_cache, {})
+
+    def test_invalid_signed_token(self):
+        # 签名无效或已过期的 token 在本地拒绝，不请求 keystone
+        request = RequestFactory().get('/users/', HTTP_X_JUNHAI_TOKEN=tools.sign_token(
+            {'exp': time.time() - 1}, 'secret'))
+        with mock.patch.object(AuthMiddleware, '_signed_token_secret', 'secret'):
+            response = AuthMiddleware().process_view(request, None, (), {})
+        self.assertEqual(tools.json_loader(response.content)['code'], 403)
+        self.assertFalse(self.request_mock.called)
+        self.assertTrue(AuthMiddleware.verify_signed_token(tools.sign_token({'exp': time.time() + 60}, 'secret'),
+                                                           'secret'))
+        self.assertFalse(AuthMiddleware.verify_signed_token(tools.sign_token({'exp': time.time() + 60}, 'other'),
+                                                            'secret'))
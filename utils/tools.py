@@ -4,6 +4,9 @@ from django.conf import settings
 from op_keystone.exceptions import *
 from importlib import import_module
 import hashlib
+import hmac
+import base64
+import binascii
 import json
 import uuid
 import time
@@ -113,6 +116,48 @@ def json_loader(json_str):
         return {}
 
 
+def sign_token(payload, secret):
+    """
+    对载荷进行 hmac-sha256 签名，生成自校验的 token
+    :param payload: dict, 载荷
+    :param secret: str, 签名密钥
+    :return: str, base64url(载荷 json).base64url(签名)
+    """
+    payload_json = json.dumps(payload, separators=(',', ':'))
+    payload_str = base64.urlsafe_b64encode(payload_json.encode('utf8')).rstrip(b'=').decode('ascii')
+    signature = hmac.new(secret.encode('utf8'), payload_str.encode('ascii'), hashlib.sha256).digest()
+    signature_str = base64.urlsafe_b64encode(signature).rstrip(b'=').decode('ascii')
+    return '%s.%s' % (payload_str, signature_str)
+
+
+def load_signed_token(token, secret):
+    """
+    校验自校验 token 的签名，成功则返回载荷
+    :param token: str, 签名 token
+    :param secret: str, 签名密钥
+    :return: dict, 载荷，格式或签名无效时为 None
+    """
+    try:
+        payload_str, signature_str = token.split('.')
+        signature = hmac.new(secret.encode('utf8'), payload_str.encode('ascii'), hashlib.sha256).digest()
+    except (ValueError, UnicodeEncodeError):
+        return None
+
+    expect_signature_str = base64.urlsafe_b64encode(signature).rstrip(b'=').decode('ascii')
+    if not hmac.compare_digest(expect_signature_str, signature_str):
+        return None
+
+    try:
+        padding = '=' * (-len(payload_str) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(payload_str + padding).decode('utf8'))
+    except (ValueError, binascii.Error):
+        return None
+
+    if not isinstance(payload, dict):
+        return None
+    return payload
+
+
 def generate_mapping_uuid(namespace_hex, mapping_str):
     """
     获取命名空间和字符串映射的 uuid